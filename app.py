@@ -31,6 +31,10 @@ def start_channel(channel_name: str):
                         const.FEISHU, const.DINGTALK]:
         PluginManager().load_plugins()
 
+    from bridge.bridge import Bridge
+
+    Bridge().prewarm()
+
     if conf().get("use_linkai"):
         try:
             from common import linkai_client
@@ -15,6 +15,7 @@ from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
+from common.retry_policy import get_retry_after, get_retry_policy
 from common import const
 from config import conf, load_config
 
@@ -70,7 +71,7 @@ class AliQwenBot(Bot):
             session = self.sessions.session_query(query, session_id)
             logger.debug("[QWEN] session query={}".format(session.messages))
 
-            reply_content = self.reply_text(session)
+            reply_content = self.reply_text(session, deadline=context.get("deadline"))
             logger.debug(
                 "[QWEN] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
                     session.messages,
@@ -93,57 +94,51 @@ class AliQwenBot(Bot):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: AliQwenSession, retry_count=0) -> dict:
+    def reply_text(self, session: AliQwenSession, deadline=None) -> dict:
         """
         call bailian's ChatCompletion to get the answer
         :param session: a conversation session
-        :param retry_count: retry count
+        :param deadline: 回复的截止时间，由channel传入，超过后不再重试
         :return: {}
         """
-        try:
-            prompt, history = self.convert_messages_format(session.messages)
-            self.update_api_key_if_expired()
-            # NOTE 阿里百炼的call()函数未提供temperature参数，考虑到temperature和top_p参数作用相同，取两者较小的值作为top_p参数传入，详情见文档 https://help.aliyun.com/document_detail/2587502.htm
-            response = broadscope_bailian.Completions().call(app_id=self.app_id(), prompt=prompt, history=history, top_p=min(self.temperature(), self.top_p()))
-            completion_content = self.get_completion_content(response, self.node_id())
-            completion_tokens, total_tokens = self.calc_tokens(session.messages, completion_content)
-            return {
-                "total_tokens": total_tokens,
-                "completion_tokens": completion_tokens,
-                "content": completion_content,
-            }
-        except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[QWEN] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[QWEN] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIError):
-                logger.warn("[QWEN] Bad Gateway: {}".format(e))
-                result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[QWEN] APIConnectionError: {}".format(e))
-                need_retry = False
-                result["content"] = "我连接不到你的网络"
-            else:
-                logger.exception("[QWEN] Exception: {}".format(e))
-                need_retry = False
-                self.sessions.clear_session(session.session_id)
-
-            if need_retry:
-                logger.warn("[QWEN] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, retry_count + 1)
-            else:
-                return result
+        result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        for attempt in get_retry_policy(const.QWEN).attempts(deadline):
+            try:
+                prompt, history = self.convert_messages_format(session.messages)
+                self.update_api_key_if_expired()
+                # NOTE 阿里百炼的call()函数未提供temperature参数，考虑到temperature和top_p参数作用相同，取两者较小的值作为top_p参数传入，详情见文档 https://help.aliyun.com/document_detail/2587502.htm
+                response = broadscope_bailian.Completions().call(app_id=self.app_id(), prompt=prompt, history=history, top_p=min(self.temperature(), self.top_p()))
+                attempt.succeeded()
+                completion_content = self.get_completion_content(response, self.node_id())
+                completion_tokens, total_tokens = self.calc_tokens(session.messages, completion_content)
+                return {
+                    "total_tokens": total_tokens,
+                    "completion_tokens": completion_tokens,
+                    "content": completion_content,
+                }
+            except Exception as e:
+                result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+                if isinstance(e, openai.error.RateLimitError):
+                    logger.warn("[QWEN] RateLimitError: {}".format(e))
+                    result["content"] = "提问太快啦，请休息一下再问我吧"
+                    attempt.failed(e, retry_after=get_retry_after(getattr(e, "headers", None), 20))
+                elif isinstance(e, openai.error.Timeout):
+                    logger.warn("[QWEN] Timeout: {}".format(e))
+                    result["content"] = "我没有收到你的消息"
+                    attempt.failed(e)
+                elif isinstance(e, openai.error.APIError):
+                    logger.warn("[QWEN] Bad Gateway: {}".format(e))
+                    result["content"] = "请再问我一次"
+                    attempt.failed(e)
+                elif isinstance(e, openai.error.APIConnectionError):
+                    logger.warn("[QWEN] APIConnectionError: {}".format(e))
+                    result["content"] = "我连接不到你的网络"
+                    attempt.failed(e, retry=False)
+                else:
+                    logger.exception("[QWEN] Exception: {}".format(e))
+                    attempt.failed(e, retry=False)
+                    self.sessions.clear_session(session.session_id)
+        return result
 
     def set_api_key(self):
         api_key, expired_time = self.api_key_client().create_token(agent_key=self.agent_key())
@@ -1,18 +1,24 @@
 # encoding:utf-8
 
-import requests
+from common import http_client
+from common.access_token_cache import get_access_token_cache
 import json
+import requests
 from common import const
 from bot.bot import Bot
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
+from common.retry_policy import get_retry_policy
 from config import conf
 from bot.baidu.baidu_wenxin_session import BaiduWenxinSession
 
 BAIDU_API_KEY = conf().get("baidu_wenxin_api_key")
 BAIDU_SECRET_KEY = conf().get("baidu_wenxin_secret_key")
+# 服务暂不可用、QPS超限、服务繁忙以及access_token失效时重试
+TOKEN_ERROR_CODES = [110, 111]
+RETRYABLE_ERROR_CODES = [2, 18, 336100] + TOKEN_ERROR_CODES
 
 class BaiduWenxinBot(Bot):
 
@@ -44,7 +50,7 @@ class BaiduWenxinBot(Bot):
                     reply = Reply(ReplyType.INFO, "所有人记忆已清除")
                 else:
                     session = self.sessions.session_query(query, session_id)
-                    result = self.reply_text(session)
+                    result = self.reply_text(session, deadline=context.get("deadline"))
                     total_tokens, completion_tokens, reply_content = (
                         result["total_tokens"],
                         result["completion_tokens"],
@@ -69,47 +75,70 @@ class BaiduWenxinBot(Bot):
                     reply = Reply(ReplyType.ERROR, retstring)
                 return reply
 
-    def reply_text(self, session: BaiduWenxinSession, retry_count=0):
-        try:
-            logger.info("[BAIDU] model={}".format(session.model))
-            access_token = self.get_access_token()
-            if access_token == 'None':
-                logger.warn("[BAIDU] access token 获取失败")
+    def reply_text(self, session: BaiduWenxinSession, deadline=None):
+        logger.info("[BAIDU] model={}".format(session.model))
+        result = {"total_tokens": 0, "completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        for attempt in get_retry_policy(const.BAIDU).attempts(deadline):
+            try:
+                access_token = self.get_access_token()
+                if access_token == 'None':
+                    logger.warn("[BAIDU] access token 获取失败")
+                    attempt.failed("access token is None", retry=False)
+                    return {
+                        "total_tokens": 0,
+                        "completion_tokens": 0,
+                        "content": 0,
+                        }
+                url = "https://aip.baidubce.com/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/" + session.model + "?access_token=" + access_token
+                headers = {
+                    'Content-Type': 'application/json'
+                }
+                payload = {'messages': session.messages}
+                response = http_client.request("POST", url, headers=headers, data=json.dumps(payload), timeout=attempt.timeout)
+                response_text = json.loads(response.text)
+                logger.info(f"[BAIDU] response text={response_text}")
+                error_code = response_text.get("error_code")
+                if error_code in RETRYABLE_ERROR_CODES:
+                    if error_code in TOKEN_ERROR_CODES:
+                        get_access_token_cache("baidu_wenxin:" + str(BAIDU_API_KEY), self._fetch_access_token).refresh(stale_token=access_token)
+                    attempt.failed("error_code={}".format(error_code))
+                    continue
+                res_content = response_text["result"]
+                total_tokens = response_text["usage"]["total_tokens"]
+                completion_tokens = response_text["usage"]["completion_tokens"]
+                attempt.succeeded()
+                logger.info("[BAIDU] reply={}".format(res_content))
                 return {
-                    "total_tokens": 0,
-                    "completion_tokens": 0,
-                    "content": 0,
-                    }
-            url = "https://aip.baidubce.com/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/" + session.model + "?access_token=" + access_token
-            headers = {
-                'Content-Type': 'application/json'
-            }
-            payload = {'messages': session.messages}
-            response = requests.request("POST", url, headers=headers, data=json.dumps(payload))
-            response_text = json.loads(response.text)
-            logger.info(f"[BAIDU] response text={response_text}")
-            res_content = response_text["result"]
-            total_tokens = response_text["usage"]["total_tokens"]
-            completion_tokens = response_text["usage"]["completion_tokens"]
-            logger.info("[BAIDU] reply={}".format(res_content))
-            return {
-                "total_tokens": total_tokens,
-                "completion_tokens": completion_tokens,
-                "content": res_content,
-            }
-        except Exception as e:
-            need_retry = retry_count < 2
-            logger.warn("[BAIDU] Exception: {}".format(e))
-            need_retry = False
-            self.sessions.clear_session(session.session_id)
-            result = {"total_tokens": 0, "completion_tokens": 0, "content": "出错了: {}".format(e)}
-            return result
+                    "total_tokens": total_tokens,
+                    "completion_tokens": completion_tokens,
+                    "content": res_content,
+                }
+            except requests.exceptions.RequestException as e:
+                logger.warn("[BAIDU] request failed: {}".format(e))
+                attempt.failed(e)
+            except Exception as e:
+                logger.warn("[BAIDU] Exception: {}".format(e))
+                attempt.failed(e, retry=False)
+                self.sessions.clear_session(session.session_id)
+                return {"total_tokens": 0, "completion_tokens": 0, "content": "出错了: {}".format(e)}
+        return result
+
+    def warmup(self):
+        # 获取access_token的同时建立到千帆接口的连接
+        self.get_access_token()
 
     def get_access_token(self):
         """
-        使用 AK，SK 生成鉴权签名（Access Token）
+        使用 AK，SK 生成鉴权签名（Access Token），token缓存到过期前并在后台提前刷新
         :return: access_token，或是None(如果错误)
         """
+        cache = get_access_token_cache("baidu_wenxin:" + str(BAIDU_API_KEY), self._fetch_access_token)
+        return str(cache.get())
+
+    def _fetch_access_token(self):
         url = "https://aip.baidubce.com/oauth/2.0/token"
         params = {"grant_type": "client_credentials", "client_id": BAIDU_API_KEY, "client_secret": BAIDU_SECRET_KEY}
-        return str(requests.post(url, params=params).json().get("access_token"))
+        res = http_client.post(url, params=params).json()
+        if not res.get("access_token"):
+            raise Exception(res.get("error_description") or res)
+        return res["access_token"], res.get("expires_in", 2592000)
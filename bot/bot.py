@@ -15,3 +15,9 @@ class Bot(object):
         :return: reply content
         """
         raise NotImplementedError
+
+    def warmup(self):
+        """
+        预先建立到接口的连接，启动时在后台线程中调用
+        """
+        pass
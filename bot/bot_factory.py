@@ -1,7 +1,54 @@
 """
 channel factory
 """
+import hashlib
+import json
+import threading
+
 from common import const
+from common.log import logger
+from config import conf, record_config_reads
+
+_bots = {}  # bot_type -> (创建时读取的配置项, 配置摘要, bot)
+_bots_lock = threading.RLock()
+
+
+def get_bot(bot_type):
+    """
+    获取bot实例，已创建的bot在其依赖的配置没有变化时直接复用，重置bot路由后不需要重新创建
+    :param bot_type: bot type code
+    :return: bot instance
+    """
+    with _bots_lock:
+        cached = _bots.get(bot_type)
+        if cached is not None and _config_digest(cached[0]) == cached[1]:
+            return cached[2]
+        with record_config_reads() as keys:
+            bot = create_bot(bot_type)
+        _bots[bot_type] = (keys, _config_digest(keys), bot)
+        if cached is not None:
+            logger.info("[BotFactory] config of {} changed, bot recreated".format(bot_type))
+        return bot
+
+
+def prewarm(bot_type):
+    """
+    在后台线程中创建bot，导入模块并预先建立到接口的连接，减少第一条消息的等待时间
+    """
+
+    def _prewarm():
+        try:
+            get_bot(bot_type).warmup()
+            logger.info("[BotFactory] bot {} prewarmed".format(bot_type))
+        except Exception as e:
+            logger.warn("[BotFactory] prewarm bot {} failed: {}".format(bot_type, e))
+
+    threading.Thread(target=_prewarm, daemon=True).start()
+
+
+def _config_digest(keys):
+    values = {key: conf().get(key) for key in keys}
+    return hashlib.md5(json.dumps(values, sort_keys=True, default=str).encode("utf-8")).hexdigest()
 
 
 def create_bot(bot_type):
@@ -1,6 +1,5 @@
 # encoding:utf-8
 
-import time
 from typing import List, Tuple
 
 import requests
@@ -11,7 +10,9 @@ from bot.chatgpt.chat_gpt_session import ChatGPTSession
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import const, http_client
 from common.log import logger
+from common.retry_policy import get_retry_after, get_retry_policy
 from config import conf
 
 class ByteDanceCozeBot(Bot):
@@ -27,7 +28,7 @@ class ByteDanceCozeBot(Bot):
             session_id = context["session_id"]
             session = self.sessions.session_query(query, session_id)
             logger.debug("[COZE] session query={}".format(session.messages))
-            reply_content, err = self._reply_text(session_id, session)
+            reply_content, err = self._reply_text(session_id, session, deadline=context.get("deadline"))
             if err is not None:
                 logger.error("[COZE] reply error={}".format(err))
                 return Reply(ReplyType.ERROR, "我暂时遇到了一些问题，请您稍后重试~")
@@ -61,34 +62,43 @@ class ByteDanceCozeBot(Bot):
             "chat_history": chat_history,
             "stream": False
         }
-    def _reply_text(self, session_id: str, session: ChatGPTSession, retry_count=0):
+    def _reply_text(self, session_id: str, session: ChatGPTSession, deadline=None):
         try:
             query, chat_history = self._convert_messages_format(session.messages)
-            base_url = self._get_api_base_url()
-            chat_url = f'{base_url}/chat'
-            headers = self._get_headers()
-            payload = self._get_payload(session.session_id, query, chat_history)
-            response = requests.post(chat_url, headers=headers, json=payload)
-            if response.status_code != 200:
-                error_info = f"[COZE] response text={response.text} status_code={response.status_code}"
-                logger.warn(error_info)
-                return None, error_info
-            answer, err = self._get_completion_content(response)
-            if err is not None:
-                return None, err
-            completion_tokens, total_tokens = self._calc_tokens(session.messages, answer)
-            return {
-                "total_tokens": total_tokens,
-                "completion_tokens": completion_tokens,
-                "content": answer
-            }, None
         except Exception as e:
-            if retry_count < 2:
-                time.sleep(3)
-                logger.warn(f"[COZE] Exception: {repr(e)} 第{retry_count + 1}次重试")
-                return self._reply_text(session_id, session, retry_count + 1)
-            else:
-                return None, f"[COZE] Exception: {repr(e)} 超过最大重试次数"
+            return None, f"[COZE] Exception: {repr(e)}"
+        base_url = self._get_api_base_url()
+        chat_url = f'{base_url}/chat'
+        headers = self._get_headers()
+        payload = self._get_payload(session.session_id, query, chat_history)
+        error_info = None
+        for attempt in get_retry_policy(const.COZE).attempts(deadline):
+            try:
+                response = http_client.post(chat_url, headers=headers, json=payload, timeout=attempt.timeout)
+                if response.status_code != 200:
+                    error_info = f"[COZE] response text={response.text} status_code={response.status_code}"
+                    logger.warn(error_info)
+                    # 只有限流和服务端错误需要重试
+                    if response.status_code == 429:
+                        attempt.failed(error_info, retry_after=get_retry_after(response.headers))
+                    else:
+                        attempt.failed(error_info, retry=response.status_code >= 500)
+                    continue
+                attempt.succeeded()
+                answer, err = self._get_completion_content(response)
+                if err is not None:
+                    return None, err
+                completion_tokens, total_tokens = self._calc_tokens(session.messages, answer)
+                return {
+                    "total_tokens": total_tokens,
+                    "completion_tokens": completion_tokens,
+                    "content": answer
+                }, None
+            except Exception as e:
+                logger.warn(f"[COZE] Exception: {repr(e)}")
+                error_info = f"[COZE] Exception: {repr(e)} 超过最大重试次数"
+                attempt.failed(e)
+        return None, error_info or "[COZE] 超过最大重试次数"
 
     def _convert_messages_format(self, messages) -> Tuple[str, List[dict]]:
         # [
@@ -0,0 +1,145 @@
+# encoding:utf-8
+
+import threading
+import time
+from collections import deque
+
+from common.log import logger
+
+
+class ApiKey(object):
+    """
+    单个api key的用量，统计最近一分钟的请求数和token数
+    """
+
+    def __init__(self, key, rpm=0, tpm=0):
+        self.key = key
+        self.rpm = rpm  # 每分钟请求数上限，0表示不限制
+        self.tpm = tpm  # 每分钟token数上限，0表示不限制
+        self.requests = deque()  # 最近一分钟的请求时间
+        self.tokens = deque()  # 最近一分钟的(时间, token数)
+        self.token_sum = 0
+        self.total_requests = 0
+        self.total_tokens = 0
+        self.cooldown_until = 0
+
+    def _expire(self, now):
+        while self.requests and now - self.requests[0] >= 60:
+            self.requests.popleft()
+        while self.tokens and now - self.tokens[0][0] >= 60:
+            self.token_sum -= self.tokens.popleft()[1]
+
+    def load(self, now, tokens=0):
+        """
+        返回该key当前的负载(0~1)，超过上限或冷却中返回None
+        """
+        if now < self.cooldown_until:
+            return None
+        self._expire(now)
+        load = 0
+        if self.rpm:
+            if len(self.requests) + 1 > self.rpm:
+                return None
+            load = max(load, len(self.requests) / self.rpm)
+        if self.tpm:
+            if self.token_sum + tokens > self.tpm and self.token_sum > 0:
+                return None
+            load = max(load, self.token_sum / self.tpm)
+        return load
+
+    def masked(self):
+        return self.key[:5] + "***" + self.key[-4:]
+
+
+class ApiKeyPool(object):
+    """
+    多个api key的负载均衡，选择当前负载最低的key，遇到限流的key暂停使用一段时间
+    keys的每一项为key字符串，或{"key": "sk-xxx", "rpm": 3500, "tpm": 90000}
+    """
+
+    def __init__(self, keys):
+        self.keys = []
+        for item in keys:
+            if isinstance(item, dict):
+                self.keys.append(ApiKey(item["key"], item.get("rpm", 0), item.get("tpm", 0)))
+            else:
+                self.keys.append(ApiKey(item))
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=0):
+        """
+        选择负载最低的key并计入一次请求，预扣预估的token数，请求结束后调用record修正
+        :param tokens: 本次请求预估的token数
+        :return: key，所有key都不可用时返回None
+        """
+        with self.lock:
+            now = time.time()
+            best, best_load = None, None
+            for api_key in self.keys:
+                load = api_key.load(now, tokens)
+                if load is not None and (best_load is None or load < best_load):
+                    best, best_load = api_key, load
+            if best is None:
+                return None
+            best.requests.append(now)
+            best.total_requests += 1
+            if tokens:
+                # 预扣，避免并发请求同时选中同一个key后超过tpm
+                best.tokens.append((now, tokens))
+                best.token_sum += tokens
+            return best.key
+
+    def record(self, key, total_tokens, estimated=0):
+        """
+        记录请求实际使用的token数，来自接口返回的usage，请求失败时为0
+        :param estimated: acquire时预扣的token数，按实际用量修正
+        """
+        api_key = self._find(key)
+        diff = (total_tokens or 0) - estimated
+        if api_key is None or (not diff and not total_tokens):
+            return
+        with self.lock:
+            if diff:
+                api_key.tokens.append((time.time(), diff))
+                api_key.token_sum += diff
+            api_key.total_tokens += total_tokens or 0
+
+    def cooldown(self, key, seconds=20):
+        """
+        key被限流后暂停使用
+        """
+        api_key = self._find(key)
+        if api_key is None:
+            return
+        with self.lock:
+            api_key.cooldown_until = time.time() + seconds
+        logger.warn("[ApiKeyPool] key {} rate limited, cooldown {}s".format(api_key.masked(), seconds))
+
+    def available(self):
+        with self.lock:
+            now = time.time()
+            return any(api_key.load(now) is not None for api_key in self.keys)
+
+    def stats(self) -> list:
+        with self.lock:
+            now = time.time()
+            result = []
+            for api_key in self.keys:
+                api_key._expire(now)
+                result.append(
+                    {
+                        "key": api_key.masked(),
+                        "rpm": len(api_key.requests),
+                        "tpm": api_key.token_sum,
+                        "total_requests": api_key.total_requests,
+                        "total_tokens": api_key.total_tokens,
+                        "cooldown": max(api_key.cooldown_until - now, 0),
+                    }
+                )
+            return result
+
+    def _find(self, key):
+        for api_key in self.keys:
+            if api_key.key == key:
+                return api_key
+        return None
@@ -1,19 +1,21 @@
 # encoding:utf-8
 
-import time
 
 import openai
 import openai.error
 import requests
 
 from bot.bot import Bot
+from bot.chatgpt.api_key_pool import ApiKeyPool
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
 from bot.openai.open_ai_image import OpenAIImage
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import const, http_client
 from common.log import logger
-from common.token_bucket import TokenBucket
+from common.retry_policy import get_retry_after, get_retry_policy
+from common.token_bucket import get_chat_limiter
 from config import conf, load_config
 
 
@@ -28,8 +30,8 @@ class ChatGPTBot(Bot, OpenAIImage):
         proxy = conf().get("proxy")
         if proxy:
             openai.proxy = proxy
-        if conf().get("rate_limit_chatgpt"):
-            self.tb4chatgpt = TokenBucket(conf().get("rate_limit_chatgpt", 20))
+        # 配置了多个api key时，按各key的负载分配请求
+        self.key_pool = ApiKeyPool(conf().get("open_ai_api_keys")) if conf().get("open_ai_api_keys") else None
 
         self.sessions = SessionManager(ChatGPTSession, model=conf().get("model") or "gpt-3.5-turbo")
         self.args = {
@@ -75,7 +77,7 @@ class ChatGPTBot(Bot, OpenAIImage):
             #     # reply in stream
             #     return self.reply_text_stream(query, new_query, session_id)
 
-            reply_content = self.reply_text(session, api_key, args=new_args)
+            reply_content = self.reply_text(session, api_key, args=new_args, deadline=context.get("deadline"))
             logger.debug(
                 "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
                     session.messages,
@@ -106,61 +108,87 @@ class ChatGPTBot(Bot, OpenAIImage):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0) -> dict:
+    def reply_text(self, session: ChatGPTSession, api_key=None, args=None, deadline=None) -> dict:
         """
         call openai's ChatCompletion to get the answer
         :param session: a conversation session
-        :param session_id: session id
-        :param retry_count: retry count
+        :param api_key: api key, None means the default or pooled key
+        :param deadline: 回复的截止时间，由channel传入，超过后不再重试
         :return: {}
         """
-        try:
-            if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
-                raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
-            # if api_key == None, the default openai.api_key will be used
-            if args is None:
-                args = self.args
-            response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
-            # logger.debug("[CHATGPT] response={}".format(response))
-            # logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            return {
-                "total_tokens": response["usage"]["total_tokens"],
-                "completion_tokens": response["usage"]["completion_tokens"],
-                "content": response.choices[0]["message"]["content"],
-            }
-        except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[CHATGPT] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[CHATGPT] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIError):
-                logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
-                result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
-                result["content"] = "我连接不到你的网络"
-                if need_retry:
-                    time.sleep(5)
-            else:
-                logger.exception("[CHATGPT] Exception: {}".format(e))
-                need_retry = False
-                self.sessions.clear_session(session.session_id)
-
-            if need_retry:
-                logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, api_key, args, retry_count + 1)
-            else:
+        limiter = get_chat_limiter(const.CHATGPT)
+        estimated_tokens = session.estimate_prompt_tokens()
+        # if api_key == None, the default openai.api_key will be used
+        if args is None:
+            args = self.args
+        result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        for attempt in get_retry_policy(const.CHATGPT).attempts(deadline):
+            pooled_key = None
+            try:
+                # 超出限流时排队等待，而不是直接报错后再sleep重试
+                if limiter and not limiter.acquire(estimated_tokens, timeout=conf().get("rate_limit_wait", 20)):
+                    logger.warn("[CHATGPT] rate limit wait timeout, estimated_tokens={}".format(estimated_tokens))
+                    attempt.failed("rate limit wait timeout", retry=False)
+                    return {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
+                request_key = api_key
+                if request_key is None and self.key_pool:
+                    pooled_key = self.key_pool.acquire(estimated_tokens)
+                    if pooled_key is None:
+                        raise openai.error.RateLimitError("RateLimitError: all api keys are rate limited")
+                    request_key = pooled_key
+                request_args = dict(args, request_timeout=attempt.timeout) if attempt.timeout else args
+                response = openai.ChatCompletion.create(api_key=request_key, messages=session.messages, **request_args)
+                attempt.succeeded()
+                # logger.debug("[CHATGPT] response={}".format(response))
+                # logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
+                result = {
+                    "total_tokens": response["usage"]["total_tokens"],
+                    "completion_tokens": response["usage"]["completion_tokens"],
+                    "content": response.choices[0]["message"]["content"],
+                }
+                # 解析完回复后再结算，解析失败时由except退回预扣的token，不会重复结算
+                if pooled_key:
+                    self.key_pool.record(pooled_key, result["total_tokens"], estimated_tokens)
+                if limiter:
+                    limiter.settle(estimated_tokens, result["total_tokens"])
                 return result
+            except Exception as e:
+                result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+                if limiter:
+                    limiter.settle(estimated_tokens, 0)  # 请求未完成（包括被限流），退回预扣的token，重试时重新预扣
+                if pooled_key:
+                    self.key_pool.record(pooled_key, 0, estimated_tokens)
+                if isinstance(e, openai.error.RateLimitError):
+                    logger.warn("[CHATGPT] RateLimitError: {}".format(e))
+                    result["content"] = "提问太快啦，请休息一下再问我吧"
+                    if pooled_key:
+                        self.key_pool.cooldown(pooled_key, _retry_after(e))
+                    # 还有可用的api key时立即换key重试
+                    attempt.failed(e, retry_after=0 if self.key_pool and self.key_pool.available() else _retry_after(e))
+                elif isinstance(e, openai.error.Timeout):
+                    logger.warn("[CHATGPT] Timeout: {}".format(e))
+                    result["content"] = "我没有收到你的消息"
+                    attempt.failed(e)
+                elif isinstance(e, openai.error.APIError):
+                    logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
+                    result["content"] = "请再问我一次"
+                    attempt.failed(e)
+                elif isinstance(e, openai.error.APIConnectionError):
+                    logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
+                    result["content"] = "我连接不到你的网络"
+                    attempt.failed(e)
+                else:
+                    logger.exception("[CHATGPT] Exception: {}".format(e))
+                    attempt.failed(e, retry=False)
+                    self.sessions.clear_session(session.session_id)
+        return result
+
+
+def _retry_after(e, default=20):
+    """
+    从限流错误的响应头中读取需要等待的秒数
+    """
+    return get_retry_after(getattr(e, "headers", None), default)
 
 
 class AzureChatGPTBot(ChatGPTBot):
@@ -183,13 +211,13 @@ class AzureChatGPTBot(ChatGPTBot):
             headers = {"api-key": api_key, "Content-Type": "application/json"}
             try:
                 body = {"prompt": query, "size": conf().get("image_create_size", "256x256"),"n": 1}
-                submission = requests.post(url, headers=headers, json=body)
+                submission = http_client.post(url, headers=headers, json=body)
                 operation_location = submission.headers['operation-location']
                 status = ""
                 while (status != "succeeded"):
                     if retry_count > 3:
                         return False, "图片生成失败"
-                    response = requests.get(operation_location, headers=headers)
+                    response = http_client.get(operation_location, headers=headers)
                     status = response.json()['status']
                     retry_count += 1
                 image_url = response.json()['result']['data'][0]['url']
@@ -208,7 +236,7 @@ class AzureChatGPTBot(ChatGPTBot):
             headers = {"api-key": api_key, "Content-Type": "application/json"}
             try:
                 body = {"prompt": query, "size": conf().get("image_create_size", "1024x1024"), "quality": conf().get("dalle3_image_quality", "standard")}
-                response = requests.post(url, headers=headers, json=body)
+                response = http_client.post(url, headers=headers, json=body)
                 response.raise_for_status()  # 检查请求是否成功
                 data = response.json()
 
@@ -1,3 +1,5 @@
+import functools
+
 from bot.session_manager import Session
 from common.log import logger
 from common import const
@@ -89,13 +91,24 @@ def num_tokens_from_messages(messages, model):
     for message in messages:
         num_tokens += tokens_per_message
         for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
+            if key == "content" and message.get("role") == "system":
+                # system prompt在会话间共享，token数只计算一次
+                num_tokens += system_prompt_tokens(encoding.name, value)
+            else:
+                num_tokens += len(encoding.encode(value))
             if key == "name":
                 num_tokens += tokens_per_name
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
     return num_tokens
 
 
+@functools.lru_cache(maxsize=256)
+def system_prompt_tokens(encoding_name, system_prompt):
+    import tiktoken
+
+    return len(tiktoken.get_encoding(encoding_name).encode(system_prompt))
+
+
 def num_tokens_by_character(messages):
     """Returns the number of tokens used by a list of messages."""
     tokens = 0
@@ -1,5 +1,4 @@
 import re
-import time
 import json
 import uuid
 from curl_cffi import requests
@@ -9,7 +8,9 @@ from bot.openai.open_ai_image import OpenAIImage
 from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
+from common import const
 from common.log import logger
+from common.retry_policy import get_retry_policy
 from config import conf
 
 
@@ -118,105 +119,105 @@ class ClaudeAIBot(Bot, OpenAIImage):
         # Returns JSON of the newly created conversation information
         return response.json()
         
-    def _chat(self, query, context, retry_count=0) -> Reply:
+    def _chat(self, query, context) -> Reply:
         """
-        发起对话请求
+        发起对话请求，失败时按claude的重试策略重试
         :param query: 请求提示词
         :param context: 对话上下文
-        :param retry_count: 当前递归重试次数
         :return: 回复
         """
-        if retry_count >= 2:
-            # exit from retry 2 times
-            logger.warn("[CLAUDEAI] failed after maximum number of retry times")
-            return Reply(ReplyType.ERROR, "请再问我一次吧")
-
+        session_id = context["session_id"]
+        if self.org_uuid is None:
+            return Reply(ReplyType.ERROR, self.error)
         try:
-            session_id = context["session_id"]
-            if self.org_uuid is None:
-                return Reply(ReplyType.ERROR, self.error)
-
+            # 只在第一次请求前加入会话，重试时不重复追加
             session = self.sessions.session_query(query, session_id)
-            con_uuid = self.conversation_share_check(session_id)
-
             model = conf().get("model") or "gpt-3.5-turbo"
             # remove system message
             if session.messages[0].get("role") == "system":
                 if model == "wenxin" or model == "claude":
                     session.messages.pop(0)
-            logger.info(f"[CLAUDEAI] query={query}")
-
-            # do http request
-            base_url = "https://claude.ai"
-            payload = json.dumps({
-                "completion": {
-                    "prompt": f"{query}",
-                    "timezone": "Asia/Kolkata",
-                    "model": "claude-2"
-                },
-                "organization_uuid": f"{self.org_uuid}",
-                "conversation_uuid": f"{con_uuid}",
-                "text": f"{query}",
-                "attachments": []
-            })
-            headers = {
-                'User-Agent':
-                    'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/115.0',
-                'Accept': 'text/event-stream, text/event-stream',
-                'Accept-Language': 'en-US,en;q=0.5',
-                'Referer': 'https://claude.ai/chats',
-                'Content-Type': 'application/json',
-                'Origin': 'https://claude.ai',
-                'DNT': '1',
-                'Connection': 'keep-alive',
-                'Cookie': f'{self.claude_api_cookie}',
-                'Sec-Fetch-Dest': 'empty',
-                'Sec-Fetch-Mode': 'cors',
-                'Sec-Fetch-Site': 'same-origin',
-                'TE': 'trailers'
-            }
-
-            res = requests.post(base_url + "/api/append_message", headers=headers, data=payload,impersonate="chrome110",proxies= self.proxies,timeout=400)
-            if res.status_code == 200 or "pemission" in res.text:
-                # execute success
-                decoded_data = res.content.decode("utf-8")
-                decoded_data = re.sub('\n+', '\n', decoded_data).strip()
-                data_strings = decoded_data.split('\n')
-                completions = []
-                for data_string in data_strings:
-                    json_str = data_string[6:].strip()
-                    data = json.loads(json_str)
-                    if 'completion' in data:
-                        completions.append(data['completion'])
-
-                reply_content = ''.join(completions)
-
-                if "rate limi" in reply_content:
-                    logger.error("rate limit error: The conversation has reached the system speed limit and is synchronized with Cladue. Please go to the official website to check the lifting time")
-                    return Reply(ReplyType.ERROR, "对话达到系统速率限制，与cladue同步，请进入官网查看解除限制时间")
-                logger.info(f"[CLAUDE] reply={reply_content}, total_tokens=invisible")
-                self.sessions.session_reply(reply_content, session_id, 100)
-                return Reply(ReplyType.TEXT, reply_content)
-            else:
-                flag = self.check_cookie()
-                if flag == None:
-                    return Reply(ReplyType.ERROR, self.error)
-
-                response = res.json()
-                error = response.get("error")
-                logger.error(f"[CLAUDE] chat failed, status_code={res.status_code}, "
-                             f"msg={error.get('message')}, type={error.get('type')}, detail: {res.text}, uuid: {con_uuid}")
-
-                if res.status_code >= 500:
-                    # server error, need retry
-                    time.sleep(2)
-                    logger.warn(f"[CLAUDE] do retry, times={retry_count}")
-                    return self._chat(query, context, retry_count + 1)
-                return Reply(ReplyType.ERROR, "提问太快啦，请休息一下再问我吧")
-
         except Exception as e:
             logger.exception(e)
-            # retry
-            time.sleep(2)
-            logger.warn(f"[CLAUDE] do retry, times={retry_count}")
-            return self._chat(query, context, retry_count + 1)
+            return Reply(ReplyType.ERROR, "请再问我一次吧")
+        logger.info(f"[CLAUDEAI] query={query}")
+
+        for attempt in get_retry_policy(const.CLAUDEAI).attempts(context.get("deadline")):
+            try:
+                con_uuid = self.conversation_share_check(session_id)
+
+                # do http request
+                base_url = "https://claude.ai"
+                payload = json.dumps({
+                    "completion": {
+                        "prompt": f"{query}",
+                        "timezone": "Asia/Kolkata",
+                        "model": "claude-2"
+                    },
+                    "organization_uuid": f"{self.org_uuid}",
+                    "conversation_uuid": f"{con_uuid}",
+                    "text": f"{query}",
+                    "attachments": []
+                })
+                headers = {
+                    'User-Agent':
+                        'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/115.0',
+                    'Accept': 'text/event-stream, text/event-stream',
+                    'Accept-Language': 'en-US,en;q=0.5',
+                    'Referer': 'https://claude.ai/chats',
+                    'Content-Type': 'application/json',
+                    'Origin': 'https://claude.ai',
+                    'DNT': '1',
+                    'Connection': 'keep-alive',
+                    'Cookie': f'{self.claude_api_cookie}',
+                    'Sec-Fetch-Dest': 'empty',
+                    'Sec-Fetch-Mode': 'cors',
+                    'Sec-Fetch-Site': 'same-origin',
+                    'TE': 'trailers'
+                }
+
+                res = requests.post(base_url + "/api/append_message", headers=headers, data=payload,impersonate="chrome110",proxies= self.proxies,timeout=attempt.timeout or 400)
+                if res.status_code == 200 or "pemission" in res.text:
+                    # execute success
+                    attempt.succeeded()
+                    decoded_data = res.content.decode("utf-8")
+                    decoded_data = re.sub('\n+', '\n', decoded_data).strip()
+                    data_strings = decoded_data.split('\n')
+                    completions = []
+                    for data_string in data_strings:
+                        json_str = data_string[6:].strip()
+                        data = json.loads(json_str)
+                        if 'completion' in data:
+                            completions.append(data['completion'])
+
+                    reply_content = ''.join(completions)
+
+                    if "rate limi" in reply_content:
+                        logger.error("rate limit error: The conversation has reached the system speed limit and is synchronized with Cladue. Please go to the official website to check the lifting time")
+                        return Reply(ReplyType.ERROR, "对话达到系统速率限制，与cladue同步，请进入官网查看解除限制时间")
+                    logger.info(f"[CLAUDE] reply={reply_content}, total_tokens=invisible")
+                    self.sessions.session_reply(reply_content, session_id, 100)
+                    return Reply(ReplyType.TEXT, reply_content)
+                else:
+                    flag = self.check_cookie()
+                    if flag == None:
+                        attempt.failed("invalid cookie", retry=False)
+                        return Reply(ReplyType.ERROR, self.error)
+
+                    response = res.json()
+                    error = response.get("error")
+                    logger.error(f"[CLAUDE] chat failed, status_code={res.status_code}, "
+                                 f"msg={error.get('message')}, type={error.get('type')}, detail: {res.text}, uuid: {con_uuid}")
+
+                    if res.status_code >= 500:
+                        # server error, need retry
+                        attempt.failed(f"status_code={res.status_code}")
+                        continue
+                    attempt.failed(f"status_code={res.status_code}", retry=False)
+                    return Reply(ReplyType.ERROR, "提问太快啦，请休息一下再问我吧")
+
+            except Exception as e:
+                logger.exception(e)
+                attempt.failed(e)
+        logger.warn("[CLAUDEAI] failed after maximum number of retry times")
+        return Reply(ReplyType.ERROR, "请再问我一次吧")
@@ -1,7 +1,5 @@
 # encoding:utf-8
 
-import time
-
 import openai
 import openai.error
 import anthropic
@@ -13,7 +11,10 @@ from bot.gemini.google_gemini_bot import GoogleGeminiBot
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import const
 from common.log import logger
+from common.retry_policy import get_retry_after, get_retry_policy
+from common.token_bucket import get_chat_limiter
 from config import conf
 
 user_session = dict()
@@ -50,7 +51,7 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                     reply = Reply(ReplyType.INFO, "所有人记忆已清除")
                 else:
                     session = self.sessions.session_query(query, session_id)
-                    result = self.reply_text(session)
+                    result = self.reply_text(session, deadline=context.get("deadline"))
                     logger.info(result)
                     total_tokens, completion_tokens, reply_content = (
                         result["total_tokens"],
@@ -76,52 +77,65 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                     reply = Reply(ReplyType.ERROR, retstring)
                 return reply
 
-    def reply_text(self, session: ChatGPTSession, retry_count=0):
-        try:
-            actual_model = self._model_mapping(conf().get("model"))
-            response = self.claudeClient.messages.create(
-                model=actual_model,
-                max_tokens=1024,
-                # system=conf().get("system"),
-                messages=GoogleGeminiBot.filter_messages(session.messages)
-            )
-            # response = openai.Completion.create(prompt=str(session), **self.args)
-            res_content = response.content[0].text.strip().replace("<|endoftext|>", "")
-            total_tokens = response.usage.input_tokens+response.usage.output_tokens
-            completion_tokens = response.usage.output_tokens
-            logger.info("[CLAUDE_API] reply={}".format(res_content))
-            return {
-                "total_tokens": total_tokens,
-                "completion_tokens": completion_tokens,
-                "content": res_content,
-            }
-        except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[CLAUDE_API] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[CLAUDE_API] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[CLAUDE_API] APIConnectionError: {}".format(e))
-                need_retry = False
-                result["content"] = "我连接不到你的网络"
-            else:
-                logger.warn("[CLAUDE_API] Exception: {}".format(e))
-                need_retry = False
-                self.sessions.clear_session(session.session_id)
-
-            if need_retry:
-                logger.warn("[CLAUDE_API] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, retry_count + 1)
-            else:
-                return result
+    def reply_text(self, session: ChatGPTSession, deadline=None):
+        limiter = get_chat_limiter(const.CLAUDEAPI)
+        estimated_tokens = session.estimate_prompt_tokens()
+        result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        for attempt in get_retry_policy(const.CLAUDEAPI).attempts(deadline):
+            try:
+                if limiter and not limiter.acquire(estimated_tokens, timeout=conf().get("rate_limit_wait", 20)):
+                    logger.warn("[CLAUDE_API] rate limit wait timeout, estimated_tokens={}".format(estimated_tokens))
+                    attempt.failed("rate limit wait timeout", retry=False)
+                    return {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
+                actual_model = self._model_mapping(conf().get("model"))
+                args = {}
+                if session.system_prompt:
+                    # system prompt放在最前并标记为可缓存，相同人设的请求可复用前缀缓存
+                    args["system"] = [{"type": "text", "text": session.system_prompt, "cache_control": {"type": "ephemeral"}}]
+                if attempt.timeout:
+                    args["timeout"] = attempt.timeout
+                response = self.claudeClient.messages.create(
+                    model=actual_model,
+                    max_tokens=1024,
+                    messages=GoogleGeminiBot.filter_messages(session.messages),
+                    **args
+                )
+                attempt.succeeded()
+                # response = openai.Completion.create(prompt=str(session), **self.args)
+                res_content = response.content[0].text.strip().replace("<|endoftext|>", "")
+                total_tokens = response.usage.input_tokens+response.usage.output_tokens
+                completion_tokens = response.usage.output_tokens
+                if limiter:
+                    limiter.settle(estimated_tokens, total_tokens)
+                logger.info("[CLAUDE_API] reply={}".format(res_content))
+                return {
+                    "total_tokens": total_tokens,
+                    "completion_tokens": completion_tokens,
+                    "content": res_content,
+                }
+            except Exception as e:
+                result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+                if limiter:
+                    limiter.settle(estimated_tokens, 0)  # 请求未完成（包括被限流），退回预扣的token，重试时重新预扣
+                # anthropic sdk抛出自己的异常类型，与openai的异常按同样方式处理
+                if isinstance(e, (openai.error.RateLimitError, anthropic.RateLimitError)):
+                    logger.warn("[CLAUDE_API] RateLimitError: {}".format(e))
+                    result["content"] = "提问太快啦，请休息一下再问我吧"
+                    headers = getattr(getattr(e, "response", None), "headers", None) or getattr(e, "headers", None)
+                    attempt.failed(e, retry_after=get_retry_after(headers, 20))
+                elif isinstance(e, (openai.error.Timeout, anthropic.APITimeoutError)):
+                    logger.warn("[CLAUDE_API] Timeout: {}".format(e))
+                    result["content"] = "我没有收到你的消息"
+                    attempt.failed(e)
+                elif isinstance(e, (openai.error.APIConnectionError, anthropic.APIConnectionError)):
+                    logger.warn("[CLAUDE_API] APIConnectionError: {}".format(e))
+                    result["content"] = "我连接不到你的网络"
+                    attempt.failed(e, retry=False)
+                else:
+                    logger.warn("[CLAUDE_API] Exception: {}".format(e))
+                    attempt.failed(e, retry=False)
+                    self.sessions.clear_session(session.session_id)
+        return result
 
     def _model_mapping(self, model) -> str:
         if model == "claude-3-opus":
@@ -4,7 +4,9 @@ from bot.bot import Bot
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import const
 from common.log import logger
+from common.retry_policy import get_retry_policy
 from config import conf, load_config
 from .dashscope_session import DashscopeSession
 import os
@@ -51,7 +53,7 @@ class DashscopeBot(Bot):
             session = self.sessions.session_query(query, session_id)
             logger.debug("[DASHSCOPE] session query={}".format(session.messages))
 
-            reply_content = self.reply_text(session)
+            reply_content = self.reply_text(session, deadline=context.get("deadline"))
             logger.debug(
                 "[DASHSCOPE] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
                     session.messages,
@@ -73,45 +75,41 @@ class DashscopeBot(Bot):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: DashscopeSession, retry_count=0) -> dict:
+    def reply_text(self, session: DashscopeSession, deadline=None) -> dict:
         """
         call openai's ChatCompletion to get the answer
         :param session: a conversation session
-        :param session_id: session id
-        :param retry_count: retry count
+        :param deadline: 回复的截止时间，由channel传入，超过后不再重试
         :return: {}
         """
-        try:
-            dashscope.api_key = self.api_key
-            response = self.client.call(
-                dashscope_models[self.model_name],
-                messages=session.messages,
-                result_format="message"
-            )
-            if response.status_code == HTTPStatus.OK:
-                content = response.output.choices[0]["message"]["content"]
-                return {
-                    "total_tokens": response.usage["total_tokens"],
-                    "completion_tokens": response.usage["output_tokens"],
-                    "content": content,
-                }
-            else:
-                logger.error('Request id: %s, Status code: %s, error code: %s, error message: %s' % (
-                    response.request_id, response.status_code,
-                    response.code, response.message
-                ))
-                result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-                need_retry = retry_count < 2
-                result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-                if need_retry:
-                    return self.reply_text(session, retry_count + 1)
+        result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        for attempt in get_retry_policy(const.QWEN_DASHSCOPE).attempts(deadline):
+            try:
+                dashscope.api_key = self.api_key
+                args = {"request_timeout": attempt.timeout} if attempt.timeout else {}
+                response = self.client.call(
+                    dashscope_models[self.model_name],
+                    messages=session.messages,
+                    result_format="message",
+                    **args
+                )
+                if response.status_code == HTTPStatus.OK:
+                    attempt.succeeded()
+                    content = response.output.choices[0]["message"]["content"]
+                    return {
+                        "total_tokens": response.usage["total_tokens"],
+                        "completion_tokens": response.usage["output_tokens"],
+                        "content": content,
+                    }
                 else:
-                    return result
-        except Exception as e:
-            logger.exception(e)
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if need_retry:
-                return self.reply_text(session, retry_count + 1)
-            else:
-                return result
+                    logger.error('Request id: %s, Status code: %s, error code: %s, error message: %s' % (
+                        response.request_id, response.status_code,
+                        response.code, response.message
+                    ))
+                    # 只有限流和服务端错误需要重试
+                    retry = response.status_code == HTTPStatus.TOO_MANY_REQUESTS or response.status_code >= 500
+                    attempt.failed("status_code={}".format(response.status_code), retry=retry)
+            except Exception as e:
+                logger.exception(e)
+                attempt.failed(e)
+        return result
@@ -3,7 +3,7 @@
 
 import re
 import time
-import requests
+from common import http_client
 import config
 from bot.bot import Bot
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
@@ -11,9 +11,11 @@ from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
+from common.retry_policy import get_retry_policy
+from common.usage_ledger import UsageLedger
 from config import conf, pconf
 import threading
-from common import memory, utils
+from common import const, memory, utils
 import base64
 import os
 
@@ -27,6 +29,9 @@ class LinkAIBot(Bot):
         self.sessions = LinkAISessionManager(LinkAISession, model=conf().get("model") or "gpt-3.5-turbo")
         self.args = {}
 
+    def warmup(self):
+        http_client.warmup(conf().get("linkai_api_base", "https://api.link-ai.tech") + "/v1/chat/completions")
+
     def reply(self, query, context: Context = None) -> Reply:
         if context.type == ContextType.TEXT:
             return self._chat(query, context)
@@ -44,19 +49,13 @@ class LinkAIBot(Bot):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def _chat(self, query, context, retry_count=0) -> Reply:
+    def _chat(self, query, context) -> Reply:
         """
-        发起对话请求
+        发起对话请求，失败时按重试策略重试
         :param query: 请求提示词
         :param context: 对话上下文
-        :param retry_count: 当前递归重试次数
         :return: 回复
         """
-        if retry_count > 2:
-            # exit from retry 2 times
-            logger.warn("[LINKAI] failed after maximum number of retry times")
-            return Reply(ReplyType.TEXT, "请再问我一次吧")
-
         try:
             # load config
             if context.get("generate_breaked_by"):
@@ -121,60 +120,72 @@ class LinkAIBot(Bot):
             logger.info(f"[LINKAI] query={query}, app_code={app_code}, model={body.get('model')}, file_id={file_id}")
             headers = {"Authorization": "Bearer " + linkai_api_key}
 
-            # do http request
-            base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
-                                timeout=conf().get("request_timeout", 180))
-            if res.status_code == 200:
-                # execute success
-                response = res.json()
-                reply_content = response["choices"][0]["message"]["content"]
-                total_tokens = response["usage"]["total_tokens"]
-                res_code = response.get('code')
-                logger.info(f"[LINKAI] reply={reply_content}, total_tokens={total_tokens}, res_code={res_code}")
-                if res_code == 429:
-                    logger.warn(f"[LINKAI] 用户访问超出限流配置，sender_id={body.get('sender_id')}")
-                else:
-                    self.sessions.session_reply(reply_content, session_id, total_tokens, query=query)
-                agent_suffix = self._fetch_agent_suffix(response)
-                if agent_suffix:
-                    reply_content += agent_suffix
-                if not agent_suffix:
-                    knowledge_suffix = self._fetch_knowledge_search_suffix(response)
-                    if knowledge_suffix:
-                        reply_content += knowledge_suffix
-                # image process
-                if response["choices"][0].get("img_urls"):
-                    thread = threading.Thread(target=self._send_image, args=(context.get("channel"), context, response["choices"][0].get("img_urls")))
-                    thread.start()
-                    if response["choices"][0].get("text_content"):
-                        reply_content = response["choices"][0].get("text_content")
-                reply_content = self._process_url(reply_content)
-                return Reply(ReplyType.TEXT, reply_content)
+        except Exception as e:
+            logger.exception(e)
+            return Reply(ReplyType.TEXT, "请再问我一次吧")
 
-            else:
-                response = res.json()
-                error = response.get("error")
-                logger.error(f"[LINKAI] chat failed, status_code={res.status_code}, "
-                             f"msg={error.get('message')}, type={error.get('type')}")
+        # do http request
+        base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
+        for attempt in get_retry_policy(const.LINKAI).attempts(context.get("deadline")):
+            try:
+                res = http_client.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
+                                       timeout=attempt.timeout)
+            except Exception as e:
+                logger.exception(e)
+                attempt.failed(e)
+                continue
+            if res.status_code >= 500:
+                # server error, need retry
+                logger.error(f"[LINKAI] chat failed, status_code={res.status_code}")
+                attempt.failed(f"status_code={res.status_code}")
+                continue
+            attempt.succeeded()
+            try:
+                return self._handle_chat_response(res, query, context, session_id, body)
+            except Exception as e:
+                logger.exception(e)
+                break
+        logger.warn("[LINKAI] failed after maximum number of retry times")
+        return Reply(ReplyType.TEXT, "请再问我一次吧")
 
-                if res.status_code >= 500:
-                    # server error, need retry
-                    time.sleep(2)
-                    logger.warn(f"[LINKAI] do retry, times={retry_count}")
-                    return self._chat(query, context, retry_count + 1)
+    def _handle_chat_response(self, res, query, context, session_id, body) -> Reply:
+        if res.status_code == 200:
+            # execute success
+            response = res.json()
+            reply_content = response["choices"][0]["message"]["content"]
+            total_tokens = response["usage"]["total_tokens"]
+            res_code = response.get('code')
+            logger.info(f"[LINKAI] reply={reply_content}, total_tokens={total_tokens}, res_code={res_code}")
+            if res_code == 429:
+                logger.warn(f"[LINKAI] 用户访问超出限流配置，sender_id={body.get('sender_id')}")
+            else:
+                self.sessions.session_reply(reply_content, session_id, total_tokens, query=query)
+            agent_suffix = self._fetch_agent_suffix(response)
+            if agent_suffix:
+                reply_content += agent_suffix
+            if not agent_suffix:
+                knowledge_suffix = self._fetch_knowledge_search_suffix(response)
+                if knowledge_suffix:
+                    reply_content += knowledge_suffix
+            # image process
+            if response["choices"][0].get("img_urls"):
+                thread = threading.Thread(target=self._send_image, args=(context.get("channel"), context, response["choices"][0].get("img_urls")))
+                thread.start()
+                if response["choices"][0].get("text_content"):
+                    reply_content = response["choices"][0].get("text_content")
+            reply_content = self._process_url(reply_content)
+            return Reply(ReplyType.TEXT, reply_content)
 
-                error_reply = "提问太快啦，请休息一下再问我吧"
-                if res.status_code == 409:
-                    error_reply = "这个问题我还没有学会，请问我其它问题吧"
-                return Reply(ReplyType.TEXT, error_reply)
+        else:
+            response = res.json()
+            error = response.get("error")
+            logger.error(f"[LINKAI] chat failed, status_code={res.status_code}, "
+                         f"msg={error.get('message')}, type={error.get('type')}")
 
-        except Exception as e:
-            logger.exception(e)
-            # retry
-            time.sleep(2)
-            logger.warn(f"[LINKAI] do retry, times={retry_count}")
-            return self._chat(query, context, retry_count + 1)
+            error_reply = "提问太快啦，请休息一下再问我吧"
+            if res.status_code == 409:
+                error_reply = "这个问题我还没有学会，请问我其它问题吧"
+            return Reply(ReplyType.TEXT, error_reply)
 
     def _process_image_msg(self, app_code: str, session_id: str, query:str, img_cache: dict):
         try:
@@ -236,77 +247,70 @@ class LinkAIBot(Bot):
         except Exception as e:
             logger.exception(e)
 
-    def reply_text(self, session: ChatGPTSession, app_code="", retry_count=0) -> dict:
-        if retry_count >= 2:
-            # exit from retry 2 times
-            logger.warn("[LINKAI] failed after maximum number of retry times")
-            return {
-                "total_tokens": 0,
-                "completion_tokens": 0,
-                "content": "请再问我一次吧"
-            }
+    def reply_text(self, session: ChatGPTSession, app_code="", deadline=None) -> dict:
+        body = {
+            "app_code": app_code,
+            "messages": session.messages,
+            "model": conf().get("model") or "gpt-3.5-turbo",  # 对话模型的名称, 支持 gpt-3.5-turbo, gpt-3.5-turbo-16k, gpt-4, wenxin, xunfei
+            "temperature": conf().get("temperature"),
+            "top_p": conf().get("top_p", 1),
+            "frequency_penalty": conf().get("frequency_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
+            "presence_penalty": conf().get("presence_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
+        }
+        if self.args.get("max_tokens"):
+            body["max_tokens"] = self.args.get("max_tokens")
+        headers = {"Authorization": "Bearer " + conf().get("linkai_api_key")}
 
-        try:
-            body = {
-                "app_code": app_code,
-                "messages": session.messages,
-                "model": conf().get("model") or "gpt-3.5-turbo",  # 对话模型的名称, 支持 gpt-3.5-turbo, gpt-3.5-turbo-16k, gpt-4, wenxin, xunfei
-                "temperature": conf().get("temperature"),
-                "top_p": conf().get("top_p", 1),
-                "frequency_penalty": conf().get("frequency_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
-                "presence_penalty": conf().get("presence_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
-            }
-            if self.args.get("max_tokens"):
-                body["max_tokens"] = self.args.get("max_tokens")
-            headers = {"Authorization": "Bearer " + conf().get("linkai_api_key")}
-
-            # do http request
-            base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
-                                timeout=conf().get("request_timeout", 180))
-            if res.status_code == 200:
-                # execute success
-                response = res.json()
-                reply_content = response["choices"][0]["message"]["content"]
-                total_tokens = response["usage"]["total_tokens"]
-                logger.info(f"[LINKAI] reply={reply_content}, total_tokens={total_tokens}")
-                return {
-                    "total_tokens": total_tokens,
-                    "completion_tokens": response["usage"]["completion_tokens"],
-                    "content": reply_content,
-                }
+        # do http request
+        base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
+        for attempt in get_retry_policy(const.LINKAI).attempts(deadline):
+            try:
+                res = http_client.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
+                                       timeout=attempt.timeout)
+                if res.status_code == 200:
+                    # execute success
+                    attempt.succeeded()
+                    response = res.json()
+                    reply_content = response["choices"][0]["message"]["content"]
+                    total_tokens = response["usage"]["total_tokens"]
+                    logger.info(f"[LINKAI] reply={reply_content}, total_tokens={total_tokens}")
+                    return {
+                        "total_tokens": total_tokens,
+                        "completion_tokens": response["usage"]["completion_tokens"],
+                        "content": reply_content,
+                    }
 
-            else:
                 response = res.json()
                 error = response.get("error")
                 logger.error(f"[LINKAI] chat failed, status_code={res.status_code}, "
                              f"msg={error.get('message')}, type={error.get('type')}")
-
                 if res.status_code >= 500:
                     # server error, need retry
-                    time.sleep(2)
-                    logger.warn(f"[LINKAI] do retry, times={retry_count}")
-                    return self.reply_text(session, app_code, retry_count + 1)
-
+                    attempt.failed(f"status_code={res.status_code}")
+                    continue
+                attempt.succeeded()
                 return {
                     "total_tokens": 0,
                     "completion_tokens": 0,
                     "content": "提问太快啦，请休息一下再问我吧"
                 }
+            except Exception as e:
+                logger.exception(e)
+                attempt.failed(e)
 
-        except Exception as e:
-            logger.exception(e)
-            # retry
-            time.sleep(2)
-            logger.warn(f"[LINKAI] do retry, times={retry_count}")
-            return self.reply_text(session, app_code, retry_count + 1)
+        logger.warn("[LINKAI] failed after maximum number of retry times")
+        return {
+            "total_tokens": 0,
+            "completion_tokens": 0,
+            "content": "请再问我一次吧"
+        }
 
     def _fetch_app_info(self, app_code: str):
         headers = {"Authorization": "Bearer " + conf().get("linkai_api_key")}
         # do http request
         base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
         params = {"app_code": app_code}
-        res = requests.get(url=base_url + "/v1/app/info", params=params, headers=headers, timeout=(5, 10))
+        res = http_client.get(url=base_url + "/v1/app/info", params=params, headers=headers, timeout=(5, 10))
         if res.status_code == 200:
             return res.json()
         else:
@@ -327,7 +331,7 @@ class LinkAIBot(Bot):
                 "img_proxy": conf().get("image_proxy")
             }
             url = conf().get("linkai_api_base", "https://api.link-ai.tech") + "/v1/images/generations"
-            res = requests.post(url, headers=headers, json=data, timeout=(5, 90))
+            res = http_client.post(url, headers=headers, json=data, timeout=(5, 90))
             t2 = time.time()
             image_url = res.json()["data"][0]["url"]
             logger.info("[OPEN_AI] image_url={}".format(image_url))
@@ -430,7 +434,7 @@ def _download_file(url: str):
             os.makedirs(file_path)
         file_name = url.split("/")[-1]  # 获取文件名
         file_path = os.path.join(file_path, file_name)
-        response = requests.get(url)
+        response = http_client.get(url)
         with open(file_path, "wb") as f:
             f.write(response.content)
         return file_path
@@ -449,12 +453,14 @@ class LinkAISessionManager(SessionManager):
         if query:
             session.add_query(query)
         session.add_reply(reply)
+        UsageLedger().add_tokens(total_tokens)
         try:
             max_tokens = conf().get("conversation_max_tokens", 2500)
             tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
             logger.debug(f"[LinkAI] chat history, before tokens={total_tokens}, now tokens={tokens_cnt}")
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        self.registry.touch(session_id, session)
         return session
 
 
@@ -1,7 +1,5 @@
 # encoding:utf-8
 
-import time
-
 import openai
 import openai.error
 from bot.bot import Bot
@@ -10,9 +8,10 @@ from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
+from common.retry_policy import get_retry_after, get_retry_policy
 from config import conf, load_config
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
-import requests
+from common import http_client
 from common import const
 
 
@@ -43,6 +42,9 @@ class MinimaxBot(Bot):
         }
         self.sessions = SessionManager(MinimaxSession, model=const.MiniMax)
 
+    def warmup(self):
+        http_client.warmup(self.base_url)
+
     def reply(self, query, context: Context = None) -> Reply:
         # acquire reply content
         logger.info("[Minimax_AI] query={}".format(query))
@@ -72,7 +74,7 @@ class MinimaxBot(Bot):
             #     # reply in stream
             #     return self.reply_text_stream(query, new_query, session_id)
 
-            reply_content = self.reply_text(session, args=new_args)
+            reply_content = self.reply_text(session, args=new_args, deadline=context.get("deadline"))
             logger.debug(
                 "[Minimax_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
                     session.messages,
@@ -94,58 +96,52 @@ class MinimaxBot(Bot):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: MinimaxSession, args=None, retry_count=0) -> dict:
+    def reply_text(self, session: MinimaxSession, args=None, deadline=None) -> dict:
         """
         call openai's ChatCompletion to get the answer
         :param session: a conversation session
-        :param session_id: session id
-        :param retry_count: retry count
+        :param args: request args
+        :param deadline: 回复的截止时间，由channel传入，超过后不再重试
         :return: {}
         """
-        try:
-            headers = {"Content-Type": "application/json", "Authorization": "Bearer " + self.api_key}
-            self.request_body["messages"].extend(session.messages)
-            logger.info("[Minimax_AI] request_body={}".format(self.request_body))
-            # logger.info("[Minimax_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            res = requests.post(self.base_url, headers=headers, json=self.request_body)
+        headers = {"Content-Type": "application/json", "Authorization": "Bearer " + self.api_key}
+        # 只追加一次，重试时不重复追加会话消息
+        self.request_body["messages"].extend(session.messages)
+        logger.info("[Minimax_AI] request_body={}".format(self.request_body))
+        result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        for attempt in get_retry_policy(const.MiniMax).attempts(deadline):
+            try:
+                # logger.info("[Minimax_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
+                res = http_client.post(self.base_url, headers=headers, json=self.request_body, timeout=attempt.timeout)
 
-            # self.request_body["messages"].extend(response.json()["choices"][0]["messages"])
-            if res.status_code == 200:
-                response = res.json()
-                return {
-                    "total_tokens": response["usage"]["total_tokens"],
-                    "completion_tokens": response["usage"]["total_tokens"],
-                    "content": response["reply"],
-                }
-            else:
-                response = res.json()
-                error = response.get("error")
-                logger.error(f"[Minimax_AI] chat failed, status_code={res.status_code}, " f"msg={error.get('message')}, type={error.get('type')}")
-
-                result = {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
-                need_retry = False
-                if res.status_code >= 500:
-                    # server error, need retry
-                    logger.warn(f"[Minimax_AI] do retry, times={retry_count}")
-                    need_retry = retry_count < 2
-                elif res.status_code == 401:
-                    result["content"] = "授权失败，请检查API Key是否正确"
-                elif res.status_code == 429:
-                    result["content"] = "请求过于频繁，请稍后再试"
-                    need_retry = retry_count < 2
+                # self.request_body["messages"].extend(response.json()["choices"][0]["messages"])
+                if res.status_code == 200:
+                    attempt.succeeded()
+                    response = res.json()
+                    return {
+                        "total_tokens": response["usage"]["total_tokens"],
+                        "completion_tokens": response["usage"]["total_tokens"],
+                        "content": response["reply"],
+                    }
                 else:
-                    need_retry = False
+                    response = res.json()
+                    error = response.get("error") or {}
+                    logger.error(f"[Minimax_AI] chat failed, status_code={res.status_code}, " f"msg={error.get('message')}, type={error.get('type')}")
 
-                if need_retry:
-                    time.sleep(3)
-                    return self.reply_text(session, args, retry_count + 1)
-                else:
-                    return result
-        except Exception as e:
-            logger.exception(e)
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if need_retry:
-                return self.reply_text(session, args, retry_count + 1)
-            else:
-                return result
+                    result = {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
+                    if res.status_code >= 500:
+                        # server error, need retry
+                        attempt.failed(f"status_code={res.status_code}")
+                    elif res.status_code == 401:
+                        result["content"] = "授权失败，请检查API Key是否正确"
+                        attempt.failed(f"status_code={res.status_code}", retry=False)
+                    elif res.status_code == 429:
+                        result["content"] = "请求过于频繁，请稍后再试"
+                        attempt.failed(f"status_code={res.status_code}", retry_after=get_retry_after(res.headers))
+                    else:
+                        attempt.failed(f"status_code={res.status_code}", retry=False)
+            except Exception as e:
+                logger.exception(e)
+                attempt.failed(e)
+                result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        return result
@@ -26,6 +26,10 @@ class MinimaxSession(Session):
         assistant_item = {"sender_type": "BOT", "sender_name": "MM智能助理", "text": reply}
         self.messages.append(assistant_item)
 
+    def history(self):
+        roles = {"USER": "user", "BOT": "assistant"}
+        return [(roles[msg["sender_type"]], msg["text"]) for msg in self.messages if msg.get("sender_type") in roles]
+
     def discard_exceeding(self, max_tokens, cur_tokens=None):
         precise = True
         try:
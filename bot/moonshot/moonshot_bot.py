@@ -1,7 +1,5 @@
 # encoding:utf-8
 
-import time
-
 import openai
 import openai.error
 from bot.bot import Bot
@@ -9,9 +7,11 @@ from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
+from common.retry_policy import get_retry_after, get_retry_policy
+from common.token_bucket import get_chat_limiter
 from config import conf, load_config
 from .moonshot_session import MoonshotSession
-import requests
+from common import const, http_client
 
 
 # ZhipuAI对话模型API
@@ -27,6 +27,9 @@ class MoonshotBot(Bot):
         self.api_key = conf().get("moonshot_api_key")
         self.base_url = conf().get("moonshot_base_url", "https://api.moonshot.cn/v1/chat/completions")
 
+    def warmup(self):
+        http_client.warmup(self.base_url)
+
     def reply(self, query, context=None):
         # acquire reply content
         if context.type == ContextType.TEXT:
@@ -57,7 +60,7 @@ class MoonshotBot(Bot):
             #     # reply in stream
             #     return self.reply_text_stream(query, new_query, session_id)
 
-            reply_content = self.reply_text(session, args=new_args)
+            reply_content = self.reply_text(session, args=new_args, deadline=context.get("deadline"))
             logger.debug(
                 "[MOONSHOT_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
                     session.messages,
@@ -79,65 +82,73 @@ class MoonshotBot(Bot):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: MoonshotSession, args=None, retry_count=0) -> dict:
+    def reply_text(self, session: MoonshotSession, args=None, deadline=None) -> dict:
         """
         call openai's ChatCompletion to get the answer
         :param session: a conversation session
-        :param session_id: session id
-        :param retry_count: retry count
+        :param args: request args
+        :param deadline: 回复的截止时间，由channel传入，超过后不再重试
         :return: {}
         """
-        try:
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": "Bearer " + self.api_key
-            }
-            body = args
-            body["messages"] = session.messages
-            # logger.debug("[MOONSHOT_AI] response={}".format(response))
-            # logger.info("[MOONSHOT_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            res = requests.post(
-                self.base_url,
-                headers=headers,
-                json=body
-            )
-            if res.status_code == 200:
-                response = res.json()
-                return {
-                    "total_tokens": response["usage"]["total_tokens"],
-                    "completion_tokens": response["usage"]["completion_tokens"],
-                    "content": response["choices"][0]["message"]["content"]
-                }
-            else:
-                response = res.json()
-                error = response.get("error")
-                logger.error(f"[MOONSHOT_AI] chat failed, status_code={res.status_code}, "
-                             f"msg={error.get('message')}, type={error.get('type')}")
-
-                result = {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
-                need_retry = False
-                if res.status_code >= 500:
-                    # server error, need retry
-                    logger.warn(f"[MOONSHOT_AI] do retry, times={retry_count}")
-                    need_retry = retry_count < 2
-                elif res.status_code == 401:
-                    result["content"] = "授权失败，请检查API Key是否正确"
-                elif res.status_code == 429:
-                    result["content"] = "请求过于频繁，请稍后再试"
-                    need_retry = retry_count < 2
+        limiter = get_chat_limiter(const.MOONSHOT)
+        estimated_tokens = session.estimate_prompt_tokens()
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": "Bearer " + self.api_key
+        }
+        body = args
+        body["messages"] = session.messages
+        result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        for attempt in get_retry_policy(const.MOONSHOT).attempts(deadline):
+            try:
+                if limiter and not limiter.acquire(estimated_tokens, timeout=conf().get("rate_limit_wait", 20)):
+                    logger.warn("[MOONSHOT_AI] rate limit wait timeout, estimated_tokens={}".format(estimated_tokens))
+                    attempt.failed("rate limit wait timeout", retry=False)
+                    return {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
+                # logger.debug("[MOONSHOT_AI] response={}".format(response))
+                # logger.info("[MOONSHOT_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
+                res = http_client.post(
+                    self.base_url,
+                    headers=headers,
+                    json=body,
+                    timeout=attempt.timeout
+                )
+                if res.status_code == 200:
+                    attempt.succeeded()
+                    response = res.json()
+                    result = {
+                        "total_tokens": response["usage"]["total_tokens"],
+                        "completion_tokens": response["usage"]["completion_tokens"],
+                        "content": response["choices"][0]["message"]["content"]
+                    }
+                    # 解析完回复后再结算，解析失败时由except退回预扣的token，不会重复结算
+                    if limiter:
+                        limiter.settle(estimated_tokens, result["total_tokens"])
+                    return result
                 else:
-                    need_retry = False
+                    response = res.json()
+                    error = response.get("error") or {}
+                    logger.error(f"[MOONSHOT_AI] chat failed, status_code={res.status_code}, "
+                                 f"msg={error.get('message')}, type={error.get('type')}")
 
-                if need_retry:
-                    time.sleep(3)
-                    return self.reply_text(session, args, retry_count + 1)
-                else:
-                    return result
-        except Exception as e:
-            logger.exception(e)
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if need_retry:
-                return self.reply_text(session, args, retry_count + 1)
-            else:
-                return result
+                    result = {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
+                    if limiter:
+                        limiter.settle(estimated_tokens, 0)  # 请求未完成（包括被限流），退回预扣的token，重试时重新预扣
+                    if res.status_code >= 500:
+                        # server error, need retry
+                        attempt.failed(f"status_code={res.status_code}")
+                    elif res.status_code == 401:
+                        result["content"] = "授权失败，请检查API Key是否正确"
+                        attempt.failed(f"status_code={res.status_code}", retry=False)
+                    elif res.status_code == 429:
+                        result["content"] = "请求过于频繁，请稍后再试"
+                        attempt.failed(f"status_code={res.status_code}", retry_after=get_retry_after(res.headers))
+                    else:
+                        attempt.failed(f"status_code={res.status_code}", retry=False)
+            except Exception as e:
+                logger.exception(e)
+                if limiter:
+                    limiter.settle(estimated_tokens, 0)
+                attempt.failed(e)
+                result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        return result
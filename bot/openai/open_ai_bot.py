@@ -1,7 +1,5 @@
 # encoding:utf-8
 
-import time
-
 import openai
 import openai.error
 
@@ -11,7 +9,10 @@ from bot.openai.open_ai_session import OpenAISession
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import const
 from common.log import logger
+from common.retry_policy import get_retry_after, get_retry_policy
+from common.token_bucket import get_chat_limiter
 from config import conf
 
 user_session = dict()
@@ -56,7 +57,7 @@ class OpenAIBot(Bot, OpenAIImage):
                     reply = Reply(ReplyType.INFO, "所有人记忆已清除")
                 else:
                     session = self.sessions.session_query(query, session_id)
-                    result = self.reply_text(session)
+                    result = self.reply_text(session, deadline=context.get("deadline"))
                     total_tokens, completion_tokens, reply_content = (
                         result["total_tokens"],
                         result["completion_tokens"],
@@ -81,42 +82,48 @@ class OpenAIBot(Bot, OpenAIImage):
                     reply = Reply(ReplyType.ERROR, retstring)
                 return reply
 
-    def reply_text(self, session: OpenAISession, retry_count=0):
-        try:
-            response = openai.Completion.create(prompt=str(session), **self.args)
-            res_content = response.choices[0]["text"].strip().replace("<|endoftext|>", "")
-            total_tokens = response["usage"]["total_tokens"]
-            completion_tokens = response["usage"]["completion_tokens"]
-            logger.info("[OPEN_AI] reply={}".format(res_content))
-            return {
-                "total_tokens": total_tokens,
-                "completion_tokens": completion_tokens,
-                "content": res_content,
-            }
-        except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[OPEN_AI] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[OPEN_AI] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[OPEN_AI] APIConnectionError: {}".format(e))
-                need_retry = False
-                result["content"] = "我连接不到你的网络"
-            else:
-                logger.warn("[OPEN_AI] Exception: {}".format(e))
-                need_retry = False
-                self.sessions.clear_session(session.session_id)
-
-            if need_retry:
-                logger.warn("[OPEN_AI] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, retry_count + 1)
-            else:
-                return result
+    def reply_text(self, session: OpenAISession, deadline=None):
+        limiter = get_chat_limiter(const.OPEN_AI)
+        estimated_tokens = session.estimate_prompt_tokens()
+        result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        for attempt in get_retry_policy(const.OPEN_AI).attempts(deadline):
+            try:
+                if limiter and not limiter.acquire(estimated_tokens, timeout=conf().get("rate_limit_wait", 20)):
+                    logger.warn("[OPEN_AI] rate limit wait timeout, estimated_tokens={}".format(estimated_tokens))
+                    attempt.failed("rate limit wait timeout", retry=False)
+                    return {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
+                request_args = dict(self.args, request_timeout=attempt.timeout) if attempt.timeout else self.args
+                response = openai.Completion.create(prompt=str(session), **request_args)
+                attempt.succeeded()
+                res_content = response.choices[0]["text"].strip().replace("<|endoftext|>", "")
+                total_tokens = response["usage"]["total_tokens"]
+                completion_tokens = response["usage"]["completion_tokens"]
+                if limiter:
+                    limiter.settle(estimated_tokens, total_tokens)
+                logger.info("[OPEN_AI] reply={}".format(res_content))
+                return {
+                    "total_tokens": total_tokens,
+                    "completion_tokens": completion_tokens,
+                    "content": res_content,
+                }
+            except Exception as e:
+                result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+                if limiter:
+                    limiter.settle(estimated_tokens, 0)  # 请求未完成（包括被限流），退回预扣的token，重试时重新预扣
+                if isinstance(e, openai.error.RateLimitError):
+                    logger.warn("[OPEN_AI] RateLimitError: {}".format(e))
+                    result["content"] = "提问太快啦，请休息一下再问我吧"
+                    attempt.failed(e, retry_after=get_retry_after(getattr(e, "headers", None), 20))
+                elif isinstance(e, openai.error.Timeout):
+                    logger.warn("[OPEN_AI] Timeout: {}".format(e))
+                    result["content"] = "我没有收到你的消息"
+                    attempt.failed(e)
+                elif isinstance(e, openai.error.APIConnectionError):
+                    logger.warn("[OPEN_AI] APIConnectionError: {}".format(e))
+                    result["content"] = "我连接不到你的网络"
+                    attempt.failed(e, retry=False)
+                else:
+                    logger.warn("[OPEN_AI] Exception: {}".format(e))
+                    attempt.failed(e, retry=False)
+                    self.sessions.clear_session(session.session_id)
+        return result
@@ -1,10 +1,9 @@
-import time
-
 import openai
 import openai.error
 
 from common.log import logger
-from common.token_bucket import TokenBucket
+from common.retry_policy import get_retry_after, get_retry_policy
+from common.token_bucket import get_rate_limiter
 from config import conf
 
 
@@ -13,31 +12,38 @@ class OpenAIImage(object):
     def __init__(self):
         openai.api_key = conf().get("open_ai_api_key")
         if conf().get("rate_limit_dalle"):
-            self.tb4dalle = TokenBucket(conf().get("rate_limit_dalle", 50))
+            self.tb4dalle = get_rate_limiter("dalle", rpm=conf().get("rate_limit_dalle", 50))
 
-    def create_img(self, query, retry_count=0, api_key=None, api_base=None):
-        try:
-            if conf().get("rate_limit_dalle") and not self.tb4dalle.get_token():
-                return False, "请求太快了，请休息一下再问我吧"
-            logger.info("[OPEN_AI] image_query={}".format(query))
-            response = openai.Image.create(
-                api_key=api_key,
-                prompt=query,  # 图片描述
-                n=1,  # 每次生成图片的数量
-                model=conf().get("text_to_image") or "dall-e-2",
-                # size=conf().get("image_create_size", "256x256"),  # 图片大小,可选有 256x256, 512x512, 1024x1024
-            )
-            image_url = response["data"][0]["url"]
-            logger.info("[OPEN_AI] image_url={}".format(image_url))
-            return True, image_url
-        except openai.error.RateLimitError as e:
-            logger.warn(e)
-            if retry_count < 1:
-                time.sleep(5)
-                logger.warn("[OPEN_AI] ImgCreate RateLimit exceed, 第{}次重试".format(retry_count + 1))
-                return self.create_img(query, retry_count + 1)
-            else:
+    def create_img(self, query, retry_count=0, api_key=None, api_base=None, deadline=None):
+        """
+        :param retry_count: 兼容旧的调用方式，重试次数和间隔由dalle的重试策略控制
+        :param deadline: 截止时间，超过后不再重试
+        """
+        for attempt in get_retry_policy("dalle").attempts(deadline):
+            try:
+                if conf().get("rate_limit_dalle") and not self.tb4dalle.get_token():
+                    attempt.failed("rate limit", retry=False)
+                    return False, "请求太快了，请休息一下再问我吧"
+                logger.info("[OPEN_AI] image_query={}".format(query))
+                args = {"request_timeout": attempt.timeout} if attempt.timeout else {}
+                response = openai.Image.create(
+                    api_key=api_key,
+                    prompt=query,  # 图片描述
+                    n=1,  # 每次生成图片的数量
+                    model=conf().get("text_to_image") or "dall-e-2",
+                    # size=conf().get("image_create_size", "256x256"),  # 图片大小,可选有 256x256, 512x512, 1024x1024
+                    **args
+                )
+                attempt.succeeded()
+                image_url = response["data"][0]["url"]
+                logger.info("[OPEN_AI] image_url={}".format(image_url))
+                return True, image_url
+            except openai.error.RateLimitError as e:
+                logger.warn(e)
+                # 只有限流时重试
+                attempt.failed(e, retry_after=get_retry_after(getattr(e, "headers", None)))
+            except Exception as e:
+                logger.exception(e)
+                attempt.failed(e, retry=False)
                 return False, "画图出现问题，请休息一下再问我吧"
-        except Exception as e:
-            logger.exception(e)
-            return False, "画图出现问题，请休息一下再问我吧"
+        return False, "画图出现问题，请休息一下再问我吧"
@@ -1,24 +1,50 @@
+import os
+import shelve
+import threading
+import time
+from collections import OrderedDict
+
 from common.expired_dict import ExpiredDict
 from common.log import logger
-from config import conf
+from common.singleton import singleton
+from common.usage_ledger import UsageLedger
+from config import conf, get_appdata_dir
+
+
+_SYSTEM_ITEMS_MAX = 256
+_system_items = {}  # system prompt -> 共享的system消息
+_system_items_lock = threading.Lock()
+
+
+def system_item(system_prompt) -> dict:
+    """
+    返回system消息，相同人设的会话共享同一个消息对象和字符串，不在会话间重复保存
+    调用方不能修改返回的dict
+    """
+    item = _system_items.get(system_prompt)
+    if item is None:
+        item = {"role": "system", "content": system_prompt}
+        with _system_items_lock:
+            if len(_system_items) < _SYSTEM_ITEMS_MAX:
+                item = _system_items.setdefault(system_prompt, item)
+    return item
 
 
 class Session(object):
     def __init__(self, session_id, system_prompt=None):
         self.session_id = session_id
         self.messages = []
+        self.prompt_tokens = 0  # 最近一次提问时计算的prompt token数
         if system_prompt is None:
-            self.system_prompt = conf().get("character_desc", "")
-        else:
-            self.system_prompt = system_prompt
+            system_prompt = conf().get("character_desc", "")
+        self.system_prompt = system_item(system_prompt)["content"]
 
     # 重置会话
     def reset(self):
-        system_item = {"role": "system", "content": self.system_prompt}
-        self.messages = [system_item]
+        self.messages = [system_item(self.system_prompt)]
 
     def set_system_prompt(self, system_prompt):
-        self.system_prompt = system_prompt
+        self.system_prompt = system_item(system_prompt)["content"]
         self.reset()
 
     def add_query(self, query):
@@ -29,6 +55,26 @@ class Session(object):
         assistant_item = {"role": "assistant", "content": reply}
         self.messages.append(assistant_item)
 
+    def history(self):
+        """
+        导出不含system prompt的对话历史，用于在不同模型的会话之间迁移
+        :return: [(role, content), ...]，role为user或assistant
+        """
+        return [(msg["role"], msg["content"]) for msg in self.messages if msg.get("role") in ["user", "assistant"]]
+
+    def load_history(self, history):
+        for role, content in history:
+            if role == "user":
+                self.add_query(content)
+            else:
+                self.add_reply(content)
+
+    def estimate_prompt_tokens(self):
+        """
+        本次请求的prompt token数，用于限流时预扣，未能精确计算时按_estimate_tokens估算
+        """
+        return getattr(self, "prompt_tokens", 0) or _estimate_tokens(self)
+
     def discard_exceeding(self, max_tokens=None, cur_tokens=None):
         raise NotImplementedError
 
@@ -36,56 +82,218 @@ class Session(object):
         raise NotImplementedError
 
 
-class SessionManager(object):
-    def __init__(self, sessioncls, **session_args):
-        if conf().get("expires_in_seconds"):
-            sessions = ExpiredDict(conf().get("expires_in_seconds"))
+@singleton
+class SessionRegistry(object):
+    """
+    全局会话存储，按session_id索引，所有bot共享
+    每个session_id只保存一个会话对象，切换模型时由SessionManager转换为对应的会话类型，历史记录随之迁移
+    会话数或估算token总数超过上限时，按最近最少使用的顺序将会话写入磁盘，再次访问时自动加载
+    """
+
+    def __init__(self):
+        self.expires_in_seconds = conf().get("expires_in_seconds")
+        if self.expires_in_seconds:
+            sessions = ExpiredDict(self.expires_in_seconds)
         else:
             sessions = dict()
         self.sessions = sessions
+        self.lock = threading.RLock()
+        self.max_count = conf().get("session_max_count", 0)
+        self.max_tokens = conf().get("session_max_tokens", 0)
+        self.lru = OrderedDict()  # session_id -> 估算的token数，最近使用的在末尾
+        self.total_tokens = 0
+        self.spill = None  # 溢出到磁盘的会话，首次淘汰时打开
+        self.spill_count = 0
+        self.evictions = 0
+        self.reloads = 0
+
+    def get(self, session_id):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None and self.spill is not None and session_id in self.spill:
+                session = self._reload(session_id)
+            return session
+
+    def put(self, session_id, session):
+        with self.lock:
+            self.sessions[session_id] = session
+            self.touch(session_id, session)
+
+    def touch(self, session_id, session, tokens=None):
+        """
+        更新会话的使用顺序和token数，超过上限时淘汰最近最少使用的会话
+        :param tokens: 调用方已计算的会话token数，为空时重新计算
+        """
+        if session_id is None or (not self.max_count and not self.max_tokens):
+            return
+        with self.lock:
+            tokens = tokens or _estimate_tokens(session)
+            self.total_tokens += tokens - self.lru.pop(session_id, 0)
+            self.lru[session_id] = tokens
+            self._evict()
+
+    def remove(self, session_id):
+        with self.lock:
+            if session_id in self.sessions:
+                del self.sessions[session_id]
+            self.total_tokens -= self.lru.pop(session_id, 0)
+            if self.spill is not None and session_id in self.spill:
+                del self.spill[session_id]
+                self.spill_count -= 1
+
+    def clear(self):
+        with self.lock:
+            self.sessions.clear()
+            self.lru.clear()
+            self.total_tokens = 0
+            if self.spill is not None:
+                self.spill.clear()
+                self.spill_count = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "sessions": len(self.sessions.keys()),
+                "tokens": self.total_tokens,
+                "spilled": self.spill_count,
+                "evictions": self.evictions,
+                "reloads": self.reloads,
+                "max_count": self.max_count,
+                "max_tokens": self.max_tokens,
+            }
+
+    def _evict(self):
+        while len(self.lru) > 1 and ((self.max_count and len(self.lru) > self.max_count) or (self.max_tokens and self.total_tokens > self.max_tokens)):
+            session_id, tokens = self.lru.popitem(last=False)
+            self.total_tokens -= tokens
+            session = self.sessions.get(session_id)
+            if session is None:  # 已过期
+                continue
+            del self.sessions[session_id]
+            try:
+                if self.spill is None:
+                    self.spill = shelve.open(os.path.join(get_appdata_dir(), "session_spill"), flag="n")
+                if session_id not in self.spill:
+                    self.spill_count += 1
+                self.spill[session_id] = (time.time(), session)
+                self.evictions += 1
+                logger.debug("[SessionRegistry] spill session {} to disk, tokens={}".format(session_id, tokens))
+            except Exception as e:
+                logger.warning("[SessionRegistry] spill session {} failed: {}".format(session_id, e))
+
+    def _reload(self, session_id):
+        spilled_at, session = self.spill.pop(session_id)
+        self.spill_count -= 1
+        if self.expires_in_seconds and time.time() - spilled_at > self.expires_in_seconds:
+            return None
+        self.reloads += 1
+        logger.debug("[SessionRegistry] reload session {} from disk".format(session_id))
+        self.put(session_id, session)
+        return session
+
+
+def _estimate_tokens(session):
+    """
+    会话的token数，优先使用会话类型的calc_tokens计算，不支持时按字符估算：
+    中日韩字符约每字1个token，其他字符约每4个字符1个token
+    """
+    try:
+        return session.calc_tokens()
+    except Exception:
+        pass
+    tokens = 0
+    for msg in session.messages:
+        content = str(msg.get("content", msg.get("text", "")))
+        cjk = sum(1 for ch in content if "\u2e80" <= ch <= "\u9fff" or "\uac00" <= ch <= "\ud7af")
+        tokens += cjk + (len(content) - cjk + 3) // 4
+    return tokens
+
+
+class SessionManager(object):
+    """
+    各个bot使用的会话视图，会话本身保存在SessionRegistry中
+    """
+
+    def __init__(self, sessioncls, **session_args):
+        self.registry = SessionRegistry()
+        self.sessions = self.registry.sessions
         self.sessioncls = sessioncls
         self.session_args = session_args
 
     def build_session(self, session_id, system_prompt=None):
         """
         如果session_id不在sessions中，创建一个新的session并添加到sessions中
+        如果sessions中的session由其他bot创建，会转换为当前bot的会话类型并保留历史记录
         如果system_prompt不会空，会更新session的system_prompt并重置session
         """
         if session_id is None:
             return self.sessioncls(session_id, system_prompt, **self.session_args)
 
-        if session_id not in self.sessions:
-            self.sessions[session_id] = self.sessioncls(session_id, system_prompt, **self.session_args)
-        elif system_prompt is not None:  # 如果有新的system_prompt，更新并重置session
-            self.sessions[session_id].set_system_prompt(system_prompt)
-        session = self.sessions[session_id]
-        return session
+        with self.registry.lock:
+            session = self.registry.get(session_id)
+            if session is None:
+                session = self.sessioncls(session_id, system_prompt, **self.session_args)
+                self.registry.put(session_id, session)
+                return session
+            if not self._is_own(session):
+                session = self._adapt(session)
+                self.registry.put(session_id, session)
+            if system_prompt is not None:  # 如果有新的system_prompt，更新并重置session
+                session.set_system_prompt(system_prompt)
+            return session
+
+    def _is_own(self, session):
+        if type(session) is not self.sessioncls:
+            return False
+        for k, v in self.session_args.items():
+            if getattr(session, k, None) != v:
+                return False
+        return True
+
+    def _adapt(self, session):
+        """
+        将其他bot创建的会话转换为当前bot的会话类型
+        """
+        if type(session) is self.sessioncls:
+            # 同一会话类型仅模型等参数不同，直接更新参数即可
+            for k, v in self.session_args.items():
+                setattr(session, k, v)
+            return session
+        new_session = self.sessioncls(session.session_id, session.system_prompt, **self.session_args)
+        new_session.load_history(session.history())
+        logger.debug("[SessionManager] adapt session {} from {} to {}".format(session.session_id, type(session).__name__, self.sessioncls.__name__))
+        return new_session
 
     def session_query(self, query, session_id):
         session = self.build_session(session_id)
         session.add_query(query)
+        session.prompt_tokens = 0
         try:
             max_tokens = conf().get("conversation_max_tokens", 1000)
             total_tokens = session.discard_exceeding(max_tokens, None)
+            session.prompt_tokens = total_tokens
             logger.debug("prompt tokens used={}".format(total_tokens))
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+        self.registry.touch(session_id, session, session.prompt_tokens)
         return session
 
     def session_reply(self, reply, session_id, total_tokens=None):
         session = self.build_session(session_id)
         session.add_reply(reply)
+        UsageLedger().add_tokens(total_tokens)
+        tokens_cnt = None
         try:
             max_tokens = conf().get("conversation_max_tokens", 1000)
             tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
             logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        self.registry.touch(session_id, session, tokens_cnt)
         return session
 
     def clear_session(self, session_id):
-        if session_id in self.sessions:
-            del self.sessions[session_id]
+        self.registry.remove(session_id)
 
     def clear_all_session(self):
-        self.sessions.clear()
+        self.registry.clear()
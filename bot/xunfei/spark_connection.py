@@ -0,0 +1,181 @@
+# encoding:utf-8
+
+import base64
+import hashlib
+import hmac
+import json
+import ssl
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import mktime
+from urllib.parse import urlencode, urlparse
+from wsgiref.handlers import format_date_time
+
+import websocket
+
+from common.log import logger
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class SparkError(Exception):
+    def __init__(self, code, message):
+        super().__init__("spark error {}: {}".format(code, message))
+        self.code = code
+
+
+class SparkConnectionPool(object):
+    """
+    星火websocket连接池
+    鉴权url在有效期内复用，过期前重新签名；预先建立空闲连接，提问时直接发送，省去TLS和websocket握手的耗时
+    星火服务端在一次问答结束后会关闭连接，用过的连接不再放回，由后台线程补充新的空闲连接
+    :param size: 保持的空闲连接数，0表示每次提问时建立连接
+    :param idle_timeout: 空闲连接的最长保留时间，超过后丢弃
+    """
+
+    URL_TTL = 240  # 服务端要求签名时间与当前时间相差不超过300秒
+
+    def __init__(self, spark_url, api_key, api_secret, size=1, idle_timeout=30, recv_timeout=60):
+        self.spark_url = spark_url
+        self.host = urlparse(spark_url).netloc
+        self.path = urlparse(spark_url).path
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.recv_timeout = recv_timeout
+        self.idle = deque()  # (ws, 建立时间)
+        self.filling = 0
+        self.signed_url = None
+        self.signed_at = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="spark-ws")
+
+    def request(self, params, on_chunk=None):
+        """
+        发送一次提问并等待回复结束
+        :param params: 请求参数
+        :param on_chunk: 收到每段回复时的回调，用于流式输出
+        :return: (回复内容, usage)
+        """
+        payload = json.dumps(params)
+        ws, pooled = self.acquire()
+        try:
+            try:
+                ws.send(payload)
+                message = ws.recv()
+            except (websocket.WebSocketConnectionClosedException, OSError):
+                if not pooled:
+                    raise
+                # 空闲连接已被服务端关闭，换一个新连接重发
+                logger.debug("[XunFei] idle connection closed, reconnect")
+                ws.close()
+                ws = self._connect()
+                ws.send(payload)
+                message = ws.recv()
+            return self._receive(ws, message, on_chunk)
+        finally:
+            ws.close()
+            self.prewarm()
+
+    def acquire(self):
+        """
+        :return: (连接, 是否为预先建立的连接)
+        """
+        now = time.time()
+        with self.lock:
+            while self.idle:
+                ws, created_at = self.idle.popleft()
+                if ws.connected and now - created_at < self.idle_timeout:
+                    return ws, True
+                ws.close()
+        return self._connect(), False
+
+    def close(self):
+        with self.lock:
+            while self.idle:
+                self.idle.popleft()[0].close()
+
+    def _receive(self, ws, message, on_chunk):
+        content = ""
+        while True:
+            data = json.loads(message)
+            code = data["header"]["code"]
+            if code != 0:
+                raise SparkError(code, data["header"].get("message"))
+            choices = data["payload"]["choices"]
+            chunk = choices["text"][0]["content"]
+            if chunk:
+                content += chunk
+                if on_chunk:
+                    on_chunk(chunk)
+            if choices["status"] == 2:
+                return content, data["payload"].get("usage", {}).get("text", {})
+            message = ws.recv()
+
+    def _connect(self):
+        return websocket.create_connection(self._url(), timeout=self.recv_timeout, sslopt={"cert_reqs": ssl.CERT_NONE})
+
+    def prewarm(self):
+        """在后台补充空闲连接"""
+        with self.lock:
+            if len(self.idle) + self.filling >= self.size:
+                return
+            self.filling += 1
+        self.executor.submit(self._fill)
+
+    def _fill(self):
+        try:
+            ws = self._connect()
+            with self.lock:
+                self.idle.append((ws, time.time()))
+        except Exception as e:
+            logger.warn("[XunFei] prewarm connection failed: {}".format(e))
+        finally:
+            with self.lock:
+                self.filling -= 1
+
+    def _url(self):
+        with self.lock:
+            if self.signed_url is None or time.time() - self.signed_at > self.URL_TTL:
+                self.signed_url = self._sign_url()
+                self.signed_at = time.time()
+            return self.signed_url
+
+    def _sign_url(self):
+        # 生成RFC1123格式的时间戳
+        date = format_date_time(mktime(datetime.now().timetuple()))
+
+        # 拼接字符串
+        signature_origin = "host: " + self.host + "\n"
+        signature_origin += "date: " + date + "\n"
+        signature_origin += "GET " + self.path + " HTTP/1.1"
+
+        # 进行hmac-sha256进行加密
+        signature_sha = hmac.new(self.api_secret.encode("utf-8"), signature_origin.encode("utf-8"), digestmod=hashlib.sha256).digest()
+        signature_sha_base64 = base64.b64encode(signature_sha).decode(encoding="utf-8")
+
+        authorization_origin = f'api_key="{self.api_key}", algorithm="hmac-sha256", headers="host date request-line", ' f'signature="{signature_sha_base64}"'
+        authorization = base64.b64encode(authorization_origin.encode("utf-8")).decode(encoding="utf-8")
+
+        # 将请求的鉴权参数组合为字典，拼接生成url
+        v = {"authorization": authorization, "date": date, "host": self.host}
+        return self.spark_url + "?" + urlencode(v)
+
+
+def get_connection_pool(spark_url, api_key, api_secret, size=1, idle_timeout=30) -> SparkConnectionPool:
+    """
+    按接口地址和api key获取共享的连接池，重置bot后继续使用已建立的连接
+    """
+    key = (spark_url, api_key)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = SparkConnectionPool(spark_url, api_key, api_secret, size, idle_timeout)
+    return pool
@@ -1,7 +1,5 @@
 # encoding:utf-8
 
-import time
-
 import openai
 import openai.error
 from bot.bot import Bot
@@ -10,7 +8,10 @@ from bot.zhipuai.zhipu_ai_image import ZhipuAIImage
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import const
 from common.log import logger
+from common.retry_policy import get_retry_after, get_retry_policy
+from common.token_bucket import get_chat_limiter
 from config import conf, load_config
 from zhipuai import ZhipuAI
 
@@ -59,7 +60,7 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
             #     # reply in stream
             #     return self.reply_text_stream(query, new_query, session_id)
 
-            reply_content = self.reply_text(session, api_key, args=new_args)
+            reply_content = self.reply_text(session, api_key, args=new_args, deadline=context.get("deadline"))
             logger.debug(
                 "[ZHIPU_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
                     session.messages,
@@ -90,60 +91,64 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: ZhipuAISession, api_key=None, args=None, retry_count=0) -> dict:
+    def reply_text(self, session: ZhipuAISession, api_key=None, args=None, deadline=None) -> dict:
         """
         call openai's ChatCompletion to get the answer
         :param session: a conversation session
-        :param session_id: session id
-        :param retry_count: retry count
+        :param api_key: api key
+        :param deadline: 回复的截止时间，由channel传入，超过后不再重试
         :return: {}
         """
-        try:
-            # if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
-            #     raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
-            # if api_key == None, the default openai.api_key will be used
-            if args is None:
-                args = self.args
-            # response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
-            response = self.client.chat.completions.create(messages=session.messages, **args)
-            # logger.debug("[ZHIPU_AI] response={}".format(response))
-            # logger.info("[ZHIPU_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-
-            return {
-                "total_tokens": response.usage.total_tokens,
-                "completion_tokens": response.usage.completion_tokens,
-                "content": response.choices[0].message.content,
-            }
-        except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[ZHIPU_AI] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[ZHIPU_AI] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIError):
-                logger.warn("[ZHIPU_AI] Bad Gateway: {}".format(e))
-                result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[ZHIPU_AI] APIConnectionError: {}".format(e))
-                result["content"] = "我连接不到你的网络"
-                if need_retry:
-                    time.sleep(5)
-            else:
-                logger.exception("[ZHIPU_AI] Exception: {}".format(e), e)
-                need_retry = False
-                self.sessions.clear_session(session.session_id)
+        limiter = get_chat_limiter(const.ZHIPU_AI)
+        estimated_tokens = session.estimate_prompt_tokens()
+        # if api_key == None, the default openai.api_key will be used
+        if args is None:
+            args = self.args
+        result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        for attempt in get_retry_policy(const.ZHIPU_AI).attempts(deadline):
+            try:
+                if limiter and not limiter.acquire(estimated_tokens, timeout=conf().get("rate_limit_wait", 20)):
+                    logger.warn("[ZHIPU_AI] rate limit wait timeout, estimated_tokens={}".format(estimated_tokens))
+                    attempt.failed("rate limit wait timeout", retry=False)
+                    return {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
+                request_args = dict(args, timeout=attempt.timeout) if attempt.timeout else args
+                # response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
+                response = self.client.chat.completions.create(messages=session.messages, **request_args)
+                attempt.succeeded()
+                # logger.debug("[ZHIPU_AI] response={}".format(response))
+                # logger.info("[ZHIPU_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
 
-            if need_retry:
-                logger.warn("[ZHIPU_AI] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, api_key, args, retry_count + 1)
-            else:
+                result = {
+                    "total_tokens": response.usage.total_tokens,
+                    "completion_tokens": response.usage.completion_tokens,
+                    "content": response.choices[0].message.content,
+                }
+                # 解析完回复后再结算，解析失败时由except退回预扣的token，不会重复结算
+                if limiter:
+                    limiter.settle(estimated_tokens, result["total_tokens"])
                 return result
+            except Exception as e:
+                result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+                if limiter:
+                    limiter.settle(estimated_tokens, 0)  # 请求未完成（包括被限流），退回预扣的token，重试时重新预扣
+                if isinstance(e, openai.error.RateLimitError):
+                    logger.warn("[ZHIPU_AI] RateLimitError: {}".format(e))
+                    result["content"] = "提问太快啦，请休息一下再问我吧"
+                    attempt.failed(e, retry_after=get_retry_after(getattr(e, "headers", None), 20))
+                elif isinstance(e, openai.error.Timeout):
+                    logger.warn("[ZHIPU_AI] Timeout: {}".format(e))
+                    result["content"] = "我没有收到你的消息"
+                    attempt.failed(e)
+                elif isinstance(e, openai.error.APIError):
+                    logger.warn("[ZHIPU_AI] Bad Gateway: {}".format(e))
+                    result["content"] = "请再问我一次"
+                    attempt.failed(e)
+                elif isinstance(e, openai.error.APIConnectionError):
+                    logger.warn("[ZHIPU_AI] APIConnectionError: {}".format(e))
+                    result["content"] = "我连接不到你的网络"
+                    attempt.failed(e)
+                else:
+                    logger.exception("[ZHIPU_AI] Exception: {}".format(e), e)
+                    attempt.failed(e, retry=False)
+                    self.sessions.clear_session(session.session_id)
+        return result
@@ -1,13 +1,124 @@
-from bot.bot_factory import create_bot
-from bridge.context import Context
-from bridge.reply import Reply
+import copy
+import hashlib
+import json
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from bot import bot_factory
+from bot.session_manager import SessionRegistry
+from bridge.context import Context, ContextType
+from bridge.reply import Reply, ReplyType
 from common import const
+from common import memory
 from common.log import logger
+from common.reply_cache import ReplyCache
 from common.singleton import singleton
+from common.usage_ledger import UsageLedger
 from config import conf
 from translate.factory import create_translator
 from voice.factory import create_voice
 
+_router_pool = None
+_router_pool_lock = threading.Lock()
+
+
+def get_router_pool() -> ThreadPoolExecutor:
+    """
+    多模型故障转移和对冲请求使用的线程池
+    超时、被对冲的请求会一直占用线程直到接口返回，默认按处理消息的线程数、模型数的两倍确定大小，避免成为全局的并发上限
+    """
+    global _router_pool
+    if _router_pool is None:
+        with _router_pool_lock:
+            if _router_pool is None:
+                workers = conf().get("chat_router_workers")
+                if not workers:
+                    from channel.chat_channel import handler_pool
+
+                    workers = handler_pool._max_workers * (len(conf().get("chat_fallback_bots", [])) + 1) * 2
+                _router_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="router")
+    return _router_pool
+
+
+class ProviderStats(object):
+    """
+    单个模型服务的延迟和错误统计，连续失败后暂时降低其优先级
+    """
+
+    FAILURE_THRESHOLD = 3  # 连续失败多少次后进入冷却
+    COOLDOWN_SECONDS = 60
+
+    def __init__(self):
+        self.latencies = deque(maxlen=100)
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0
+        self.lock = threading.Lock()
+
+    def record(self, latency, ok):
+        with self.lock:
+            self.requests += 1
+            self.latencies.append(latency)
+            if ok:
+                self.consecutive_failures = 0
+            else:
+                self.errors += 1
+                self._fail()
+
+    def record_timeout(self):
+        with self.lock:
+            self.timeouts += 1
+            self._fail()
+
+    def _fail(self):
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.FAILURE_THRESHOLD:
+            self.cooldown_until = time.time() + self.COOLDOWN_SECONDS
+
+    def healthy(self):
+        return time.time() >= self.cooldown_until
+
+    def percentile(self, p):
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        return latencies[min(int(len(latencies) * p), len(latencies) - 1)]
+
+    def to_dict(self):
+        p50, p95 = self.percentile(0.5), self.percentile(0.95)
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "p50": round(p50, 3) if p50 is not None else None,
+            "p95": round(p95, 3) if p95 is not None else None,
+            "healthy": self.healthy(),
+        }
+
+
+provider_stats = {}  # provider -> ProviderStats，重置bot路由时保留
+provider_stats_lock = threading.Lock()
+
+
+def get_provider_stats(provider) -> ProviderStats:
+    stats = provider_stats.get(provider)
+    if stats is None:
+        with provider_stats_lock:
+            stats = provider_stats.setdefault(provider, ProviderStats())
+    return stats
+
+
+inflight = {}  # 请求key -> Future，结果为(回复类型, 回复内容, session_id)
+inflight_lock = threading.Lock()
+single_flight_stats = {"leaders": 0, "shared": 0}
+
 
 @singleton
 class Bridge(object):
@@ -71,7 +182,7 @@ class Bridge(object):
             elif typename == "voice_to_text":
                 self.bots[typename] = create_voice(self.btype[typename])
             elif typename == "chat":
-                self.bots[typename] = create_bot(self.btype[typename])
+                self.bots[typename] = bot_factory.get_bot(self.btype[typename])
             elif typename == "translate":
                 self.bots[typename] = create_translator(self.btype[typename])
         return self.bots[typename]
@@ -80,7 +191,244 @@ class Bridge(object):
         return self.btype[typename]
 
     def fetch_reply_content(self, query, context: Context) -> Reply:
-        return self.get_bot("chat").reply(query, context)
+        ledger = UsageLedger()
+        ok, tip = ledger.check_budget(context)
+        if not ok:
+            logger.info("[Bridge] usage budget exceeded, session_id={}, {}".format(context.get("session_id"), tip))
+            return Reply(ReplyType.INFO, tip)
+        # 命中缓存、共享进行中的回复也计入请求次数（token为0），预算和#usage统计保持准确
+        ledger.begin(context, context.get("gpt_model") or conf().get("model"))
+        try:
+            return self._fetch_reply(query, context)
+        finally:
+            ledger.end()
+
+    def _fetch_reply(self, query, context: Context) -> Reply:
+        cache_namespace = self._reply_cache_namespace(query, context)
+        if cache_namespace:
+            content = ReplyCache().get(cache_namespace, query)
+            if content is not None:
+                logger.info("[Bridge] reply cache hit, session_id={}".format(context.get("session_id")))
+                self._save_cached_turn(query, content, context)
+                return Reply(ReplyType.TEXT, content)
+        flight_key = self._single_flight_key(query, context)
+        flight = None
+        if flight_key:
+            with inflight_lock:
+                leader = inflight.get(flight_key)
+                if leader is None:
+                    flight = inflight[flight_key] = Future()
+                    single_flight_stats["leaders"] += 1
+            if leader is not None:
+                reply = self._join_flight(leader, query, context)
+                if reply is not None:
+                    return reply
+        reply = None
+        try:
+            if conf().get("chat_fallback_bots") and context.type == ContextType.TEXT and not query.startswith("#"):
+                reply = self._fetch_reply_with_failover(query, context)
+            else:
+                reply = self._call_provider(self.btype["chat"], self.get_bot("chat"), query, context)
+        finally:
+            if flight is not None:
+                with inflight_lock:
+                    inflight.pop(flight_key, None)
+                # 只共享回复的类型和内容，channel装饰回复时不会影响其他请求
+                flight.set_result((reply.type, reply.content, context["session_id"]) if reply else None)
+        if cache_namespace and reply and reply.type == ReplyType.TEXT and reply.content:
+            ReplyCache().put(cache_namespace, query, reply.content)
+        return reply
+
+    def _reply_cache_namespace(self, query, context: Context):
+        """
+        只缓存没有上下文的首轮文本提问，返回缓存的命名空间，不可缓存时返回None
+        """
+        if not conf().get("reply_cache_enabled") or context is None or context.type != ContextType.TEXT:
+            return None
+        if query.startswith("#") or context.get("openai_api_key") or context.get("app_code") or context.get("file_id"):
+            return None
+        session_id = context.get("session_id")
+        if memory.USER_IMAGE_CACHE.get(session_id):
+            return None
+        session = SessionRegistry().get(session_id)
+        if session is not None and session.history():
+            return None
+        system_prompt = session.system_prompt if session is not None else conf().get("character_desc", "")
+        model = context.get("gpt_model") or conf().get("model")
+        return ReplyCache.namespace("{}:{}".format(self.btype["chat"], model), system_prompt)
+
+    def _single_flight_key(self, query, context: Context):
+        """
+        相同模型、人设、对话历史和问题的请求key，不适合合并的请求返回None
+        """
+        if not conf().get("chat_single_flight", True) or context is None or context.type != ContextType.TEXT:
+            return None
+        if query.startswith("#") or context.get("openai_api_key") or context.get("file_id"):
+            return None
+        session_id = context.get("session_id")
+        if memory.USER_IMAGE_CACHE.get(session_id):
+            return None
+        session = SessionRegistry().get(session_id)
+        system_prompt = session.system_prompt if session is not None else conf().get("character_desc", "")
+        history = session.history() if session is not None else []
+        model = context.get("gpt_model") or conf().get("model")
+        payload = json.dumps([system_prompt, history, query, context.get("app_code")], ensure_ascii=False)
+        return self.btype["chat"], model, hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    def _join_flight(self, leader: Future, query, context: Context):
+        """
+        等待进行中的相同请求，返回共享的回复，该请求失败或等待超时时返回None，由调用方自行请求
+        等待时间不超过本次请求的截止时间，没有截止时间时不超过request_timeout
+        """
+        deadline = context.get("deadline")
+        timeout = deadline - time.time() if deadline else conf().get("request_timeout", 180)
+        try:
+            result = leader.result(timeout=max(timeout, 0))
+        except FutureTimeoutError:
+            logger.warn("[Bridge] in-flight request timeout after {:.1f}s, request independently, session_id={}".format(timeout, context["session_id"]))
+            return None
+        if result is None:
+            return None
+        reply_type, content, leader_session_id = result
+        if reply_type != ReplyType.TEXT:
+            return None
+        with inflight_lock:
+            single_flight_stats["shared"] += 1
+        logger.info("[Bridge] share in-flight reply, session_id={}".format(context["session_id"]))
+        if leader_session_id != context["session_id"]:
+            # 不同会话的相同提问，回复同样写入本会话；同一会话的重复请求只保留一轮对话
+            self._commit_turn(self.get_bot("chat"), query, content, context["session_id"])
+        return Reply(reply_type, content)
+
+    def _save_cached_turn(self, query, content, context: Context):
+        # 命中缓存时同样写入会话，保证后续提问的上下文完整
+        self._commit_turn(self.get_bot("chat"), query, content, context["session_id"])
+
+    @staticmethod
+    def _commit_turn(bot, query, content, session_id):
+        sessions = getattr(bot, "sessions", None)
+        if sessions is None:
+            return
+        sessions.session_query(query, session_id)
+        sessions.session_reply(content, session_id)
+
+    @staticmethod
+    def _call_provider(provider, bot, query, context: Context) -> Reply:
+        start = time.time()
+        reply = None
+        try:
+            reply = bot.reply(query, context)
+            return reply
+        finally:
+            get_provider_stats(provider).record(time.time() - start, reply is not None and reply.type != ReplyType.ERROR)
+
+    def _chat_providers(self):
+        """
+        按配置顺序返回(provider, bot_type, model)，处于冷却中的排到最后
+        chat_fallback_bots的每一项为bot_type或bot_type:model
+        """
+        providers = [(self.btype["chat"], self.btype["chat"], None)]
+        for item in conf().get("chat_fallback_bots", []):
+            bot_type, _, model = item.partition(":")
+            providers.append((item, bot_type, model or None))
+        healthy = [p for p in providers if get_provider_stats(p[0]).healthy()]
+        return healthy + [p for p in providers if p not in healthy]
+
+    def _fetch_reply_with_failover(self, query, context: Context) -> Reply:
+        """
+        依次请求配置的模型服务，出错或超过chat_failover_timeout时切换到下一个
+        开启chat_hedge_enabled后，当前请求超过其p95延迟仍未返回时，同时请求下一个服务，取先成功的结果
+        每次请求使用会话的副本，只有被采用的回复会写入会话
+        """
+        providers = self._chat_providers()
+        timeout = conf().get("chat_failover_timeout", 0)
+        hedge = conf().get("chat_hedge_enabled", False)
+        main_session = SessionRegistry().get(context["session_id"])
+        pending = {}  # future -> (provider, 开始时间)
+        next_index = 0
+        last_reply = None
+
+        def launch():
+            nonlocal next_index
+            provider = providers[next_index]
+            next_index += 1
+            future = get_router_pool().submit(self._provider_attempt, provider, query, context, main_session)
+            pending[future] = (provider, time.time())
+
+        launch()
+        while pending:
+            now = time.time()
+            waits = []
+            if timeout:
+                waits.append(min(started for _, started in pending.values()) + timeout - now)
+            can_hedge = hedge and next_index < len(providers) and len(pending) == 1
+            if can_hedge:
+                hedged, started = next(iter(pending.values()))
+                waits.append(started + self._hedge_delay(hedged[0]) - now)
+            done, _ = wait(list(pending), timeout=max(min(waits), 0) if waits else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                provider, _ = pending.pop(future)
+                reply, bot = future.result()
+                if reply is not None and reply.type != ReplyType.ERROR:
+                    if reply.type == ReplyType.TEXT:
+                        self._commit_turn(bot, query, reply.content, context["session_id"])
+                    if provider[0] != self.btype["chat"]:
+                        logger.info("[Bridge] reply from fallback provider {}".format(provider[0]))
+                    return reply
+                last_reply = reply
+            now = time.time()
+            if timeout:
+                for future, (provider, started) in list(pending.items()):
+                    if now - started >= timeout:
+                        logger.warn("[Bridge] provider {} timeout after {}s, failover".format(provider[0], timeout))
+                        get_provider_stats(provider[0]).record_timeout()
+                        pending.pop(future)
+            if next_index < len(providers):
+                if not pending:
+                    launch()
+                elif can_hedge and not done:
+                    logger.info("[Bridge] provider {} slower than p95, hedge with {}".format(hedged[0], providers[next_index][0]))
+                    launch()
+        return last_reply or Reply(ReplyType.ERROR, "我现在有点累了，等会再来吧")
+
+    @staticmethod
+    def _hedge_delay(provider):
+        stats = get_provider_stats(provider)
+        if len(stats.latencies) < 10:
+            return conf().get("chat_hedge_delay", 10)
+        return max(stats.percentile(0.95), 1)
+
+    def _provider_attempt(self, provider, query, context: Context, main_session):
+        provider_name, bot_type, model = provider
+        attempt_id = "{}#{}".format(context["session_id"], uuid.uuid4().hex[:8])
+        attempt_context = Context(context.type, context.content, dict(context.kwargs))
+        attempt_context["session_id"] = attempt_id
+        attempt_context.kwargs.pop("on_reply_chunk", None)  # 多个模型同时请求时不流式输出
+        if model:
+            attempt_context["gpt_model"] = model
+        registry = SessionRegistry()
+        if main_session is not None:
+            session = copy.deepcopy(main_session)
+            session.session_id = attempt_id
+            registry.put(attempt_id, session)
+        ledger = UsageLedger()
+        ledger.begin(context, model or conf().get("model"), count_request=False)
+        try:
+            bot = self.get_bot("chat") if bot_type == self.btype["chat"] else self.find_chat_bot(bot_type)
+            return self._call_provider(provider_name, bot, query, attempt_context), bot
+        except Exception as e:
+            logger.exception("[Bridge] provider {} failed: {}".format(provider_name, e))
+            return None, None
+        finally:
+            ledger.end()
+            registry.remove(attempt_id)
+
+    def get_provider_stats(self) -> dict:
+        return {provider: stats.to_dict() for provider, stats in provider_stats.items()}
+
+    def get_single_flight_stats(self) -> dict:
+        with inflight_lock:
+            return dict(single_flight_stats, inflight=len(inflight))
 
     def fetch_voice_to_text(self, voiceFile) -> Reply:
         return self.get_bot("voice_to_text").voiceToText(voiceFile)
@@ -93,11 +441,18 @@ class Bridge(object):
 
     def find_chat_bot(self, bot_type: str):
         if self.chat_bots.get(bot_type) is None:
-            self.chat_bots[bot_type] = create_bot(bot_type)
+            self.chat_bots[bot_type] = bot_factory.get_bot(bot_type)
         return self.chat_bots.get(bot_type)
 
+    def prewarm(self):
+        """
+        后台创建当前配置的对话bot并预先建立连接
+        """
+        if conf().get("bot_prewarm", True):
+            bot_factory.prewarm(self.btype["chat"])
+
     def reset_bot(self):
         """
-        重置bot路由
+        重置bot路由，依赖的配置没有变化的bot会被复用
         """
         self.__init__()
@@ -15,6 +15,7 @@ from bridge.context import Context
 from bridge.reply import Reply, ReplyType
 from common.log import logger
 from common.singleton import singleton
+from common.access_token_cache import get_access_token_cache
 from config import conf
 from common.expired_dict import ExpiredDict
 from bridge.context import ContextType
@@ -98,6 +99,11 @@ class FeiShuChanel(ChatChannel):
 
 
     def fetch_access_token(self) -> str:
+        # tenant_access_token有效期2小时，缓存后在过期前后台刷新
+        cache = get_access_token_cache("feishu:" + str(self.feishu_app_id), self._fetch_tenant_access_token)
+        return cache.get() or ""
+
+    def _fetch_tenant_access_token(self):
         url = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal/"
         headers = {
             "Content-Type": "application/json"
@@ -112,11 +118,11 @@ class FeiShuChanel(ChatChannel):
             res = response.json()
             if res.get("code") != 0:
                 logger.error(f"[FeiShu] get tenant_access_token error, code={res.get('code')}, msg={res.get('msg')}")
-                return ""
-            else:
-                return res.get("tenant_access_token")
+                raise Exception(res.get("msg"))
+            return res.get("tenant_access_token"), res.get("expire", 7200)
         else:
             logger.error(f"[FeiShu] fetch token error, res={response}")
+            raise Exception(f"status_code={response.status_code}")
 
 
     def _upload_image_url(self, img_url, access_token):
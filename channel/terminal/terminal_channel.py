@@ -1,3 +1,4 @@
+import functools
 import sys
 
 from bridge.context import *
@@ -30,6 +31,11 @@ class TerminalChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = [ReplyType.VOICE]
 
     def send(self, reply: Reply, context: Context):
+        if context.get("reply_streamed") and reply.type == ReplyType.TEXT:
+            # 回复内容已经流式输出
+            print("\n\nUser:", end="")
+            sys.stdout.flush()
+            return
         print("\nBot:")
         if reply.type == ReplyType.IMAGE:
             from PIL import Image
@@ -80,10 +86,18 @@ class TerminalChannel(ChatChannel):
             context = self._compose_context(ContextType.TEXT, prompt, msg=TerminalMessage(msg_id, prompt))
             context["isgroup"] = False
             if context:
+                context["on_reply_chunk"] = functools.partial(self._print_chunk, context)
                 self.produce(context)
             else:
                 raise Exception("context is None")
 
+    def _print_chunk(self, context: Context, chunk):
+        if not context.get("reply_streamed"):
+            context["reply_streamed"] = True
+            print("\nBot:")
+        print(chunk, end="")
+        sys.stdout.flush()
+
     def get_input(self):
         """
         Multi-line input function
@@ -0,0 +1,90 @@
+# encoding:utf-8
+
+"""
+微信联系人索引：昵称 -> UserName
+重新登录后好友、群聊的UserName会变化，插件按昵称查找新ID时不再遍历itchat的联系人列表
+索引通过itchat的联系人更新事件维护，退出登录时清空，下次查询时从itchat的联系人列表重建
+"""
+
+import threading
+
+from common.log import logger
+from common.singleton import singleton
+from lib import itchat
+from lib.itchat.storage import add_contact_listener
+
+
+@singleton
+class ContactIndex(object):
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.friends = {}  # 好友昵称 -> UserName
+        self.chatrooms = {}  # 群名称 -> UserName
+        self.names = {}  # UserName -> 昵称，联系人改名时删除旧昵称
+        self.version = 0  # 每次更新加一，依赖索引的缓存据此判断是否需要刷新
+        self.loaded = False
+        add_contact_listener(self.on_contacts_update)
+
+    def on_contacts_update(self, core, kind, contacts):
+        if core is not itchat.instance:
+            return
+        with self.lock:
+            if kind == "clear":
+                self._clear()
+            elif self.loaded:
+                # 未加载时，下次查询会从完整的联系人列表重建，这里不需要处理
+                self._update(contacts, kind == "chatrooms")
+            self.version += 1
+
+    def is_loaded(self):
+        with self.lock:
+            self._ensure_loaded()
+            return self.loaded
+
+    def get_friend(self, nickname):
+        """按昵称查找好友的UserName，找不到时返回None"""
+        with self.lock:
+            self._ensure_loaded()
+            return self.friends.get(nickname)
+
+    def get_chatroom(self, title):
+        """按群名称查找群聊的UserName，找不到时返回None"""
+        with self.lock:
+            self._ensure_loaded()
+            return self.chatrooms.get(title)
+
+    def _ensure_loaded(self):
+        if self.loaded:
+            return
+        # 不获取storageClass.updateLock：更新事件是在持有该锁时触发的，这里再获取会和self.lock形成死锁
+        storage = itchat.instance.storageClass
+        friends = list(storage.memberList)
+        chatrooms = list(storage.chatroomList)
+        self._update(friends, False)
+        self._update(chatrooms, True)
+        # 未登录时联系人列表为空，下次查询再重建
+        self.loaded = len(friends) + len(chatrooms) > 0
+        logger.debug("[ContactIndex] rebuilt, friends={}, chatrooms={}".format(len(self.friends), len(self.chatrooms)))
+
+    def _update(self, contacts, is_chatroom):
+        index = self.chatrooms if is_chatroom else self.friends
+        for contact in contacts:
+            user_name = contact.get("UserName")
+            nickname = contact.get("NickName")
+            if not user_name or not nickname:
+                continue
+            # 公众号不作为好友
+            if not is_chatroom and contact.get("VerifyFlag", 0) & 8 != 0:
+                continue
+            old_name = self.names.get(user_name)
+            if old_name is not None and old_name != nickname and index.get(old_name) == user_name:
+                del index[old_name]
+            self.names[user_name] = nickname
+            # 昵称重复时以最后更新的为准
+            index[nickname] = user_name
+
+    def _clear(self):
+        self.friends = {}
+        self.chatrooms = {}
+        self.names = {}
+        self.loaded = False
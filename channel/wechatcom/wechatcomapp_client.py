@@ -3,19 +3,33 @@ import time
 
 from wechatpy.enterprise import WeChatClient
 
+from common.access_token_cache import AccessTokenCache
+
 
 class WechatComAppClient(WeChatClient):
     def __init__(self, corp_id, secret, access_token=None, session=None, timeout=None, auto_retry=True):
         super(WechatComAppClient, self).__init__(corp_id, secret, access_token, session, timeout, auto_retry)
-        self.fetch_access_token_lock = threading.Lock()
-
-    def fetch_access_token(self):  # 重载父类方法，加锁避免多线程重复获取access_token
-        with self.fetch_access_token_lock:
-            access_token = self.session.get(self.access_token_key)
-            if access_token:
-                if not self.expires_at:
-                    return access_token
-                timestamp = time.time()
-                if self.expires_at - timestamp > 60:
-                    return access_token
-            return super().fetch_access_token()
+        self.token_cache = AccessTokenCache("wechatcom", self._request_token)
+        self.request_local = threading.local()  # 当前线程正在处理的请求使用的token
+
+    @property
+    def access_token(self):  # 重载父类属性，从缓存读取access_token，过期前由后台线程刷新
+        return self.token_cache.get()
+
+    def fetch_access_token(self):  # 重载父类方法，token失效时强制刷新，并发调用只会请求一次
+        # 父类在token失效(40001/42001)后调用，以失败请求使用的token作为失效token，已被其他线程刷新时直接返回新token
+        stale_token = getattr(self.request_local, "token", None) or self.token_cache.token
+        token = self.token_cache.refresh(stale_token=stale_token)
+        # 与父类的返回值格式一致
+        return {"access_token": token, "expires_in": max(int(self.token_cache.expires_at - time.time()), 0)}
+
+    def _handle_result(self, res, method=None, url=None, result_processor=None, **kwargs):  # 重载父类方法，记录本次请求使用的token
+        self.request_local.token = (kwargs.get("params") or {}).get("access_token")
+        try:
+            return super()._handle_result(res, method, url, result_processor, **kwargs)
+        finally:
+            self.request_local.token = None
+
+    def _request_token(self):  # 不能命名为_fetch_access_token，会覆盖父类实际请求token的方法
+        result = super().fetch_access_token()
+        return result["access_token"], result.get("expires_in", 7200)
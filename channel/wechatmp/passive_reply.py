@@ -62,6 +62,9 @@ class Query:
                     logger.debug("[wechatmp] context: {} {} {}".format(context, wechatmp_msg, supported))
 
                     if supported and context:
+                        if conf().get("wechatmp_reply_deadline"):
+                            # 回复需要在微信服务器的等待时间内完成，截止时间随context传给bot
+                            context["deadline"] = request_time + conf().get("wechatmp_reply_deadline")
                         channel.running.add(from_user)
                         channel.produce(context)
                     else:
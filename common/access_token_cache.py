@@ -0,0 +1,84 @@
+# encoding:utf-8
+
+import threading
+import time
+
+from common.log import logger
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class AccessTokenCache(object):
+    """
+    缓存接口的access_token，在过期前由后台线程刷新
+    同一时间只有一个线程在获取token，并发请求等待同一次获取的结果
+    :param name: 名称，用于日志
+    :param fetcher: 获取token的函数，返回(token, 有效期秒数)，失败时抛出异常
+    :param refresh_ahead: 提前多少秒刷新
+    """
+
+    def __init__(self, name, fetcher, refresh_ahead=300):
+        self.name = name
+        self.fetcher = fetcher
+        self.refresh_ahead = refresh_ahead
+        self.token = None
+        self.expires_at = 0
+        self.fetched_at = 0
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def get(self):
+        token, expires_at = self.token, self.expires_at
+        if token and time.time() < expires_at:
+            return token
+        return self.refresh(stale_token=token)
+
+    def refresh(self, stale_token=None):
+        """
+        重新获取token，stale_token为调用方认为已失效的token，若已被其他线程刷新则直接返回新token
+        """
+        with self.lock:
+            if self.token and self.token != stale_token and time.time() < self.expires_at:
+                return self.token
+            if stale_token is None and self.token and time.time() - self.fetched_at < 5:
+                # 刚刚刷新过，避免token失效时的并发请求重复刷新
+                return self.token
+            try:
+                token, expires_in = self.fetcher()
+            except Exception as e:
+                logger.error("[AccessTokenCache] fetch {} token failed: {}".format(self.name, e))
+                return self.token
+            self.token = token
+            self.fetched_at = time.time()
+            self.expires_at = self.fetched_at + max(int(expires_in) - 60, 0)
+            self._schedule(max(int(expires_in) - self.refresh_ahead, 60))
+            logger.debug("[AccessTokenCache] {} token refreshed, expires_in={}".format(self.name, expires_in))
+            return token
+
+    def invalidate(self):
+        with self.lock:
+            self.expires_at = 0
+
+    def _schedule(self, delay):
+        if self.timer:
+            self.timer.cancel()
+        self.timer = threading.Timer(delay, self._background_refresh)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _background_refresh(self):
+        self.refresh(stale_token=self.token)
+
+
+def get_access_token_cache(key, fetcher, refresh_ahead=300) -> AccessTokenCache:
+    """
+    按key获取共享的token缓存，同一个应用的多个实例使用同一份token
+    """
+    cache = _caches.get(key)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(key)
+            if cache is None:
+                cache = _caches[key] = AccessTokenCache(key.split(":")[0], fetcher, refresh_ahead)
+    return cache
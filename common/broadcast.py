@@ -0,0 +1,315 @@
+# encoding:utf-8
+
+"""
+标签群发引擎，TagManager、ConfigGUIWeb共用，用法:
+    engine = get_broadcast_engine()
+    broadcast_id = engine.submit("客户", "新品上架", ["昵称1", "昵称2"], source="tag_manager")
+    engine.get_progress(broadcast_id)  # 发送进度和预计剩余时间
+
+- 发件箱保存在sqlite，每个接收人单独记录发送状态，重启后继续发送未完成的群发
+- 一个发送线程按令牌桶匀速发送，同时受每分钟、每天的发送上限限制，未登录时暂停
+- 接收人按昵称保存，发送时再查找UserName，重新登录后ID变化也能继续发送
+"""
+
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from common.log import logger
+from common.token_bucket import TokenBucket
+from config import conf, get_appdata_dir
+
+ACTIVE = ("queued", "running")
+
+
+def _itchat_send(user_name, message):
+    from lib import itchat
+
+    result = itchat.send(message, toUserName=user_name)
+    if result["BaseResponse"]["Ret"] != 0:
+        raise Exception("send failed: {}".format(result["BaseResponse"]))
+
+
+def _itchat_resolve(nickname):
+    from channel.wechat.contact_index import ContactIndex
+
+    return ContactIndex().get_friend(nickname)
+
+
+def _itchat_online():
+    from lib import itchat
+
+    return bool(itchat.instance.alive and itchat.instance.storageClass.userName)
+
+
+class BroadcastEngine(object):
+    def __init__(self, db_path, per_minute=20, daily_limit=500, max_attempts=3, send=None, resolve=None, is_online=None):
+        """
+        :param per_minute: 每分钟最多发送的消息数
+        :param daily_limit: 每天最多发送的消息数，0表示不限制
+        :param max_attempts: 单个接收人最多尝试发送的次数
+        """
+        self.per_minute = per_minute
+        self.daily_limit = daily_limit
+        self.max_attempts = max_attempts
+        self.send = send or _itchat_send
+        self.resolve = resolve or _itchat_resolve
+        self.is_online = is_online or _itchat_online
+        # 容量为1，按每分钟的上限匀速发送，不突发
+        self.bucket = TokenBucket(per_minute, capacity=1)
+        self.lock = threading.RLock()
+        self.cond = threading.Condition()
+        self.callbacks = {}  # broadcast_id -> 完成回调，不持久化
+        self.cancelled = set()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS broadcasts (id TEXT PRIMARY KEY, tag TEXT, message TEXT, source TEXT, "
+                "status TEXT, created_at REAL, finished_at REAL)"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS deliveries (broadcast_id TEXT, seq INTEGER, nickname TEXT, user_name TEXT, "
+                "status TEXT, attempts INTEGER DEFAULT 0, error TEXT, sent_at REAL, PRIMARY KEY (broadcast_id, seq))"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts (status, created_at)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS idx_deliveries_sent_at ON deliveries (sent_at)")
+        self.today = None
+        self.sent_today = 0
+        self._reset_daily_count()
+        self.thread = threading.Thread(target=self._run, name="broadcast", daemon=True)
+        self.thread.start()
+
+    def submit(self, tag, message, nicknames, source="", on_done=None):
+        """
+        提交群发，立即返回群发ID
+        :param nicknames: 接收人昵称列表，重复的昵称只发送一次
+        :param on_done: 发送完成后的回调，参数为get_progress的结果
+        """
+        nicknames = list(dict.fromkeys(name for name in nicknames if name))
+        if not nicknames:
+            raise ValueError("没有接收人")
+        broadcast_id = "bc_" + uuid.uuid4().hex[:12]
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO broadcasts (id, tag, message, source, status, created_at) VALUES (?, ?, ?, ?, 'queued', ?)",
+                (broadcast_id, tag, message, source, time.time()),
+            )
+            self.db.executemany(
+                "INSERT INTO deliveries (broadcast_id, seq, nickname, status) VALUES (?, ?, ?, 'pending')",
+                [(broadcast_id, seq, name) for seq, name in enumerate(nicknames)],
+            )
+        if on_done is not None:
+            self.callbacks[broadcast_id] = on_done
+        with self.cond:
+            self.cond.notify_all()
+        logger.info("[Broadcast] {} queued, tag={}, recipients={}, source={}".format(broadcast_id, tag, len(nicknames), source))
+        return broadcast_id
+
+    def cancel(self, broadcast_id):
+        with self.lock, self.db:
+            row = self.db.execute("SELECT status FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+            if row is None or row[0] not in ACTIVE:
+                return False
+            self.db.execute("UPDATE broadcasts SET status = 'cancelled', finished_at = ? WHERE id = ?", (time.time(), broadcast_id))
+        if row[0] == "queued":
+            # 还未开始发送，发送线程不会再处理，在这里完成（调用完成回调）
+            self._finish(broadcast_id)
+            return True
+        self.cancelled.add(broadcast_id)
+        with self.cond:
+            self.cond.notify_all()
+        return True
+
+    def get_progress(self, broadcast_id):
+        """发送进度，群发不存在时返回None"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT id, tag, source, status, created_at, finished_at FROM broadcasts WHERE id = ?", (broadcast_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            counts = dict(
+                self.db.execute("SELECT status, COUNT(*) FROM deliveries WHERE broadcast_id = ? GROUP BY status", (broadcast_id,)).fetchall()
+            )
+            # 排在前面的群发还未发送的数量
+            ahead = 0
+            if row[3] in ACTIVE:
+                ahead = self.db.execute(
+                    "SELECT COUNT(*) FROM deliveries d JOIN broadcasts b ON d.broadcast_id = b.id "
+                    "WHERE b.status IN (?, ?) AND b.created_at < ? AND d.status = 'pending'",
+                    ACTIVE + (row[4],),
+                ).fetchone()[0]
+        pending = counts.get("pending", 0)
+        return {
+            "id": row[0],
+            "tag": row[1],
+            "source": row[2],
+            "status": row[3],
+            "total": sum(counts.values()),
+            "sent": counts.get("sent", 0),
+            "failed": counts.get("failed", 0),
+            "skipped": counts.get("skipped", 0),
+            "pending": pending,
+            "created_at": _format_time(row[4]),
+            "finished_at": _format_time(row[5]),
+            "eta_seconds": round(self._eta(ahead + pending)) if row[3] in ACTIVE else 0,
+        }
+
+    def get_deliveries(self, broadcast_id):
+        """每个接收人的发送状态"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT nickname, user_name, status, attempts, error, sent_at FROM deliveries WHERE broadcast_id = ? ORDER BY seq",
+                (broadcast_id,),
+            ).fetchall()
+        return [
+            {"nickname": r[0], "user_name": r[1], "status": r[2], "attempts": r[3], "error": r[4], "sent_at": _format_time(r[5])}
+            for r in rows
+        ]
+
+    def list_broadcasts(self, limit=20):
+        with self.lock:
+            ids = [r[0] for r in self.db.execute("SELECT id FROM broadcasts ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()]
+        return [self.get_progress(broadcast_id) for broadcast_id in ids]
+
+    def _eta(self, pending):
+        """按每分钟、每天的上限估算发送pending条消息需要的秒数"""
+        interval = 60 / self.per_minute
+        self._reset_daily_count()
+        if not self.daily_limit or pending <= self.daily_limit - self.sent_today:
+            return pending * interval
+        # 今天的额度用完后，等到第二天继续发送
+        rest = pending - max(self.daily_limit - self.sent_today, 0)
+        days, last = divmod(rest, self.daily_limit)
+        return _seconds_to_midnight() + days * 86400 + last * interval
+
+    def _reset_daily_count(self):
+        today = datetime.now().date()
+        if today == self.today:
+            return
+        midnight = datetime.combine(today, datetime.min.time()).timestamp()
+        with self.lock:
+            self.sent_today = self.db.execute(
+                "SELECT COUNT(*) FROM deliveries WHERE status = 'sent' AND sent_at >= ?", (midnight,)
+            ).fetchone()[0]
+        self.today = today
+
+    def _sleep(self, seconds):
+        """等待，提交、取消群发时提前唤醒"""
+        with self.cond:
+            self.cond.wait(seconds)
+
+    def _run(self):
+        while True:
+            try:
+                with self.lock:
+                    row = self.db.execute(
+                        "SELECT id FROM broadcasts WHERE status IN (?, ?) ORDER BY created_at LIMIT 1", ACTIVE
+                    ).fetchone()
+                if row is None:
+                    self._sleep(60)
+                    continue
+                self._run_broadcast(row[0])
+            except Exception as e:
+                logger.exception("[Broadcast] sender error: {}".format(e))
+                time.sleep(5)
+
+    def _run_broadcast(self, broadcast_id):
+        with self.lock, self.db:
+            self.db.execute("UPDATE broadcasts SET status = 'running' WHERE id = ? AND status = 'queued'", (broadcast_id,))
+            status, message = self.db.execute("SELECT status, message FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+        if status != "running":
+            # 开始发送前已被取消，由cancel完成
+            return
+        while broadcast_id not in self.cancelled:
+            with self.lock:
+                delivery = self.db.execute(
+                    "SELECT seq, nickname, attempts FROM deliveries WHERE broadcast_id = ? AND status = 'pending' "
+                    "ORDER BY attempts, seq LIMIT 1",
+                    (broadcast_id,),
+                ).fetchone()
+            if delivery is None:
+                break
+            if not self.is_online():
+                # 未登录，暂停发送
+                self._sleep(5)
+                continue
+            self._reset_daily_count()
+            if self.daily_limit and self.sent_today >= self.daily_limit:
+                logger.info("[Broadcast] daily limit {} reached, resume tomorrow".format(self.daily_limit))
+                self._sleep(min(_seconds_to_midnight() + 1, 600))
+                continue
+            wait = self.bucket.try_acquire()
+            if wait > 0:
+                self._sleep(wait)
+                continue
+            self._deliver(broadcast_id, message, *delivery)
+        self._finish(broadcast_id)
+
+    def _deliver(self, broadcast_id, message, seq, nickname, attempts):
+        user_name = self.resolve(nickname)
+        if not user_name:
+            status, error = "skipped", "contact not found"
+        else:
+            try:
+                self.send(user_name, message)
+                status, error = "sent", None
+                self.sent_today += 1
+            except Exception as e:
+                attempts += 1
+                status, error = ("failed" if attempts >= self.max_attempts else "pending"), str(e)
+                logger.warning("[Broadcast] {} send to {} failed ({}/{}): {}".format(broadcast_id, nickname, attempts, self.max_attempts, e))
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE deliveries SET user_name = ?, status = ?, attempts = ?, error = ?, sent_at = ? WHERE broadcast_id = ? AND seq = ?",
+                (user_name, status, attempts, error, time.time() if status == "sent" else None, broadcast_id, seq),
+            )
+
+    def _finish(self, broadcast_id):
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE broadcasts SET status = 'done', finished_at = ? WHERE id = ? AND status = 'running'", (time.time(), broadcast_id)
+            )
+        self.cancelled.discard(broadcast_id)
+        progress = self.get_progress(broadcast_id)
+        logger.info("[Broadcast] {} {}: sent={}, failed={}, skipped={}".format(
+            broadcast_id, progress["status"], progress["sent"], progress["failed"], progress["skipped"]))
+        callback = self.callbacks.pop(broadcast_id, None)
+        if callback is not None:
+            try:
+                callback(progress)
+            except Exception as e:
+                logger.exception("[Broadcast] {} callback error: {}".format(broadcast_id, e))
+
+
+def _format_time(ts):
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S") if ts else None
+
+
+def _seconds_to_midnight():
+    now = datetime.now()
+    return (datetime.combine(now.date() + timedelta(days=1), datetime.min.time()) - now).total_seconds()
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_broadcast_engine() -> BroadcastEngine:
+    """
+    获取共用的群发引擎，首次调用时启动发送线程，继续发送重启前未完成的群发
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = BroadcastEngine(
+                    os.path.join(get_appdata_dir(), "broadcast.db"),
+                    per_minute=max(conf().get("broadcast_per_minute", 20) or 0, 1),  # 配置为0时按每分钟1条发送，避免除零
+                    daily_limit=conf().get("broadcast_daily_limit", 500),
+                    max_attempts=conf().get("broadcast_max_attempts", 3),
+                )
+    return _engine
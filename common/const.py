@@ -15,6 +15,7 @@ GEMINI = "gemini"  # gemini-1.0-pro
 ZHIPU_AI = "glm-4"
 MOONSHOT = "moonshot"
 MiniMax = "minimax"
+COZE = "coze"  # 字节扣子
 
 
 # model
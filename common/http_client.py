@@ -0,0 +1,143 @@
+# encoding:utf-8
+
+"""
+共享的HTTP客户端，按host复用连接池和keep-alive连接，用法与requests一致:
+    from common import http_client
+    res = http_client.post(url, json=body, headers=headers)
+"""
+
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config import conf
+
+DEFAULT_TIMEOUT = (5, 180)  # (连接超时, 读取超时)
+
+_sessions = OrderedDict()  # (scheme, host) -> session，最近使用的在末尾
+_lock = threading.Lock()
+
+
+class _PoolAdapter(HTTPAdapter):
+    """未指定timeout的请求使用默认超时，避免连接一直挂起"""
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = DEFAULT_TIMEOUT
+        return super().send(request, timeout=timeout, **kwargs)
+
+
+def _new_session() -> requests.Session:
+    # 只重试建立连接阶段的错误，已发出的请求不重试，避免重复调用模型接口
+    retry = Retry(
+        total=conf().get("http_retries", 2),
+        connect=conf().get("http_retries", 2),
+        read=0,
+        status=0,
+        backoff_factor=0.3,
+        allowed_methods=None,
+    )
+    adapter = _PoolAdapter(pool_connections=1, pool_maxsize=conf().get("http_pool_maxsize", 10), max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session(url) -> requests.Session:
+    """
+    获取url对应host的session，同一host的请求共享连接池
+    host数超过http_max_hosts时，关闭最久未使用的host的连接池
+    """
+    parsed = urlparse(url)
+    key = (parsed.scheme, parsed.netloc)
+    evicted = None
+    with _lock:
+        session = _sessions.get(key)
+        if session is not None:
+            _sessions.move_to_end(key)
+            return session
+        session = _sessions[key] = _new_session()
+        if len(_sessions) > max(conf().get("http_max_hosts", 32), 1):
+            _, evicted = _sessions.popitem(last=False)
+    if evicted is not None:
+        # 正在进行的请求不受影响，连接归还时被关闭
+        evicted.close()
+    return session
+
+
+def request(method, url, **kwargs) -> requests.Response:
+    return get_session(url).request(method, url, **kwargs)
+
+
+def get(url, params=None, **kwargs) -> requests.Response:
+    return request("GET", url, params=params, **kwargs)
+
+
+def post(url, data=None, json=None, **kwargs) -> requests.Response:
+    return request("POST", url, data=data, json=json, **kwargs)
+
+
+def warmup(url):
+    """
+    预先建立到url所在host的连接，放入连接池供后续请求复用，失败时忽略
+    """
+    try:
+        request("HEAD", url, timeout=(3, 3), allow_redirects=False).close()
+    except Exception:
+        pass
+
+
+def close_all():
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+if __name__ == "__main__":
+    # 与本地桩服务对比每次请求新建连接和复用连接的耗时
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            body = b'{"choices": [{"message": {"content": "ok"}}]}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    stub_url = "http://127.0.0.1:{}/v1/chat/completions".format(server.server_address[1])
+    n = 500
+    payload = {"messages": [{"role": "user", "content": "hello"}]}
+
+    start = time.perf_counter()
+    for _ in range(n):
+        requests.post(stub_url, json=payload, timeout=DEFAULT_TIMEOUT)
+    cold = (time.perf_counter() - start) / n
+
+    post(stub_url, json=payload)  # 建立连接
+    start = time.perf_counter()
+    for _ in range(n):
+        post(stub_url, json=payload)
+    pooled = (time.perf_counter() - start) / n
+
+    print(f"requests.post: {cold * 1000:.3f} ms/call")
+    print(f"http_client.post: {pooled * 1000:.3f} ms/call")
+    print(f"saved: {(cold - pooled) * 1000:.3f} ms/call (不含TLS握手，https接口节省更多)")
+    server.shutdown()
@@ -0,0 +1,153 @@
+# encoding:utf-8
+
+import hashlib
+import random
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from common.log import logger
+from common.singleton import singleton
+from config import conf
+
+_MINHASH_PERM = 32  # minhash签名长度
+_MINHASH_BANDS = 8  # LSH分桶数，每个桶 _MINHASH_PERM / _MINHASH_BANDS 行
+_MINHASH_SEEDS = random.Random(20240601).sample(range(1, 1 << 31), _MINHASH_PERM)
+
+
+def normalize(text: str) -> str:
+    """
+    归一化问题文本：去掉空白和标点，转为小写，全角转半角
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    return "".join(ch for ch in text if not ch.isspace() and not unicodedata.category(ch).startswith("P"))
+
+
+def _shingles(text: str, n=2):
+    if len(text) <= n:
+        return {text}
+    return {text[i : i + n] for i in range(len(text) - n + 1)}
+
+
+def _minhash(text: str):
+    hashes = [int.from_bytes(hashlib.md5(s.encode("utf-8")).digest()[:8], "little") for s in _shingles(text)]
+    return tuple(min((h ^ seed) & 0xFFFFFFFFFFFFFFFF for h in hashes) for seed in _MINHASH_SEEDS)
+
+
+def _similarity(sig1, sig2) -> float:
+    return sum(1 for a, b in zip(sig1, sig2) if a == b) / len(sig1)
+
+
+class _Entry(object):
+    __slots__ = ("reply", "expire_at", "signature")
+
+    def __init__(self, reply, expire_at, signature):
+        self.reply = reply
+        self.expire_at = expire_at
+        self.signature = signature
+
+
+@singleton
+class ReplyCache(object):
+    """
+    问答缓存，只用于没有上下文的首轮提问，按模型和人设区分命名空间
+    先按归一化文本精确匹配，开启reply_cache_similarity后再用minhash查找相似问题
+    """
+
+    def __init__(self):
+        self.ttl = conf().get("reply_cache_ttl", 3600)
+        self.max_size = conf().get("reply_cache_max_size", 1000)
+        self.threshold = conf().get("reply_cache_similarity", 0)
+        self.entries = OrderedDict()  # (namespace, 文本hash) -> _Entry
+        self.bands = {}  # (namespace, band, 桶内签名) -> set(key)
+        self.metrics = {}  # namespace -> {"hit": 0, "similar_hit": 0, "miss": 0}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def namespace(model, system_prompt=""):
+        return "{}:{}".format(model, hashlib.md5((system_prompt or "").encode("utf-8")).hexdigest()[:8])
+
+    def get(self, namespace, query):
+        text = normalize(query)
+        if not text:
+            return None
+        key = (namespace, hashlib.sha1(text.encode("utf-8")).hexdigest())
+        with self.lock:
+            metrics = self.metrics.setdefault(namespace, {"hit": 0, "similar_hit": 0, "miss": 0})
+            entry = self._get_entry(key)
+            if entry is not None:
+                metrics["hit"] += 1
+                return entry.reply
+            if self.threshold:
+                entry = self._find_similar(namespace, _minhash(text))
+                if entry is not None:
+                    metrics["similar_hit"] += 1
+                    return entry.reply
+            metrics["miss"] += 1
+        return None
+
+    def put(self, namespace, query, reply):
+        text = normalize(query)
+        if not text:
+            return
+        key = (namespace, hashlib.sha1(text.encode("utf-8")).hexdigest())
+        signature = _minhash(text) if self.threshold else None
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = _Entry(reply, time.time() + self.ttl, signature)
+            if signature:
+                for band in self._band_keys(namespace, signature):
+                    self.bands.setdefault(band, set()).add(key)
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"size": len(self.entries), "namespaces": {ns: dict(m) for ns, m in self.metrics.items()}}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bands.clear()
+
+    def _get_entry(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry.expire_at < time.time():
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def _find_similar(self, namespace, signature):
+        candidates = set()
+        for band in self._band_keys(namespace, signature):
+            candidates |= self.bands.get(band, set())
+        best, best_score = None, self.threshold
+        for key in candidates:
+            entry = self._get_entry(key)
+            if entry is None:
+                continue
+            score = _similarity(signature, entry.signature)
+            if score >= best_score:
+                best, best_score = entry, score
+        if best is not None:
+            logger.debug("[ReplyCache] similar hit, score={}".format(best_score))
+        return best
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None and entry.signature:
+            for band in self._band_keys(key[0], entry.signature):
+                keys = self.bands.get(band)
+                if keys:
+                    keys.discard(key)
+                    if not keys:
+                        del self.bands[band]
+
+    @staticmethod
+    def _band_keys(namespace, signature):
+        rows = _MINHASH_PERM // _MINHASH_BANDS
+        return [(namespace, i, signature[i * rows : (i + 1) * rows]) for i in range(_MINHASH_BANDS)]
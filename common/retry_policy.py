@@ -0,0 +1,199 @@
+# encoding:utf-8
+
+"""
+模型接口的重试和超时策略，用法:
+    policy = get_retry_policy("linkai")
+    for attempt in policy.attempts(deadline=context.get("deadline")):
+        try:
+            res = http_client.post(url, json=body, timeout=attempt.timeout)
+        except Exception as e:
+            attempt.failed(e)
+            continue
+        attempt.succeeded()
+        return res
+    # 重试次数用完或超过截止时间
+"""
+
+import random
+import threading
+import time
+from collections import deque
+
+from common.log import logger
+from config import conf
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+class Attempt(object):
+    """
+    一次请求尝试，调用方在请求结束后调用succeeded或failed，记录耗时和结果
+    """
+
+    def __init__(self, policy, number, timeout):
+        self.policy = policy
+        self.number = number  # 第几次尝试，从1开始
+        self.timeout = timeout  # 本次请求的超时时间，单位秒
+        self.started = time.time()
+        self.ok = None  # None表示还没有结果
+        self.timed_out = False  # 是否因超时失败
+        self.retry = True
+        self.retry_after = None
+
+    def succeeded(self):
+        if self.ok is None:
+            self.ok = True
+            self.policy.record(self, time.time() - self.started, ok=True)
+
+    def failed(self, error=None, retry=True, retry_after=None):
+        """
+        :param error: 失败原因，用于日志
+        :param retry: 是否需要重试
+        :param retry_after: 服务端要求的等待秒数，为None时按指数退避计算
+        """
+        if self.ok is None:
+            latency = time.time() - self.started
+            self.ok = False
+            # 用满了超时时间才失败的，按超时处理
+            self.timed_out = bool(self.timeout) and latency >= self.timeout * 0.95
+            self.retry = retry
+            self.retry_after = retry_after
+            self.policy.record(self, latency, ok=False, error=error)
+
+
+class RetryPolicy(object):
+    """
+    单个模型服务的重试策略：指数退避加随机抖动，超时时间根据该服务近期请求的p99延迟调整，
+    不会超过调用方传入的截止时间；超时后下一次尝试的超时时间加倍，最后一次尝试使用配置的request_timeout
+    """
+
+    MIN_SAMPLES = 20  # 样本数达到后才根据p99调整超时
+
+    def __init__(self, name, max_attempts=3, base_delay=1, max_delay=20, timeout=180, min_timeout=20, p99_multiplier=2):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_timeout = timeout
+        self.min_timeout = min_timeout
+        self.p99_multiplier = p99_multiplier
+        self.latencies = deque(maxlen=200)  # 成功请求的耗时，超时的请求按超时时间记录
+        self.metrics = {"attempts": 0, "failures": 0, "retries": 0, "gave_up": 0}
+        self.lock = threading.Lock()
+
+    def attempts(self, deadline=None):
+        """
+        依次产生请求尝试，上一次尝试失败且需要重试时，等待退避时间后产生下一次
+        :param deadline: 截止时间(time.time())，超过后不再重试
+        """
+        floor = None
+        for number in range(1, self.max_attempts + 1):
+            timeout = self.timeout(deadline, final=number == self.max_attempts, floor=floor)
+            if timeout is not None and timeout <= 0:
+                self._give_up("deadline exceeded")
+                return
+            attempt = Attempt(self, number, timeout)
+            yield attempt
+            if attempt.ok is None:
+                # 调用方没有标记结果时按失败处理
+                attempt.failed("no result")
+            if attempt.ok or not attempt.retry:
+                return
+            if attempt.timed_out:
+                # 本次超时，下一次的超时时间加倍
+                floor = attempt.timeout * 2
+            if number == self.max_attempts:
+                self._give_up("max attempts reached")
+                return
+            delay = self.backoff(number, attempt.retry_after)
+            if deadline is not None and time.time() + delay >= deadline:
+                self._give_up("deadline exceeded")
+                return
+            with self.lock:
+                self.metrics["retries"] += 1
+            logger.warn("[RetryPolicy] {} attempt {} failed, retry in {:.1f}s".format(self.name, number, delay))
+            if delay > 0:
+                time.sleep(delay)
+
+    def timeout(self, deadline=None, final=False, floor=None):
+        """
+        本次请求的超时时间：近期p99延迟的若干倍，限制在[min_timeout, max_timeout]内，且不超过截止时间
+        :param final: 是否最后一次尝试，最后一次使用max_timeout
+        :param floor: 超时时间的下限，上一次尝试超时后传入
+        """
+        timeout = self.max_timeout
+        p99 = self.percentile(0.99)
+        if p99 is not None and timeout and not final:
+            timeout = min(max(p99 * self.p99_multiplier, self.min_timeout, floor or 0), timeout)
+        if deadline is not None:
+            remaining = deadline - time.time()
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        return timeout
+
+    def backoff(self, number, retry_after=None):
+        if retry_after is not None:
+            return retry_after
+        # full jitter，避免多个请求同时重试
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** number))
+
+    def percentile(self, p):
+        with self.lock:
+            if len(self.latencies) < self.MIN_SAMPLES:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * p), len(latencies) - 1)]
+
+    def record(self, attempt, latency, ok, error=None):
+        with self.lock:
+            self.metrics["attempts"] += 1
+            if ok:
+                self.latencies.append(latency)
+            else:
+                self.metrics["failures"] += 1
+                if attempt.timed_out:
+                    # 超时的请求也计入延迟，避免超时时间只降不升
+                    self.latencies.append(attempt.timeout)
+        if not ok:
+            logger.debug("[RetryPolicy] {} attempt {} failed after {:.2f}s: {}".format(self.name, attempt.number, latency, error))
+
+    def stats(self) -> dict:
+        p99 = self.percentile(0.99)
+        timeout = self.timeout()
+        with self.lock:
+            return dict(self.metrics, p99=round(p99, 3) if p99 is not None else None, timeout=round(timeout, 1) if timeout else None)
+
+    def _give_up(self, reason):
+        with self.lock:
+            self.metrics["gave_up"] += 1
+        logger.warn("[RetryPolicy] {} give up: {}".format(self.name, reason))
+
+
+def get_retry_policy(name) -> RetryPolicy:
+    """
+    按模型服务名获取共享的重试策略，参数可在retry_policies中按服务名配置
+    """
+    policy = _policies.get(name)
+    if policy is None:
+        with _policies_lock:
+            policy = _policies.get(name)
+            if policy is None:
+                options = {"timeout": conf().get("request_timeout") or 180}
+                options.update((conf().get("retry_policies") or {}).get(name, {}))
+                policy = _policies[name] = RetryPolicy(name, **options)
+    return policy
+
+
+def get_retry_after(headers, default=None):
+    """
+    从响应头Retry-After中读取服务端要求等待的秒数，没有或无法解析时返回default
+    """
+    try:
+        value = headers.get("retry-after") if headers else None
+        return default if value is None else float(value)
+    except Exception:
+        return default
+
+
+def get_retry_stats() -> dict:
+    return {name: policy.stats() for name, policy in list(_policies.items())}
@@ -0,0 +1,318 @@
+# encoding:utf-8
+
+"""
+插件共用的定时调度器，一个调度线程按最近的执行时间睡眠，到期的任务提交到线程池执行，用法:
+    scheduler = get_scheduler()
+    scheduler.add_job("tag_manager.task_1", func, make_trigger("workday", "08:30"), args=(task,))
+    scheduler.remove_job("tag_manager.task_1")
+
+- 触发器: once / daily / weekly / workday / cron / interval，见make_trigger
+- 持久化: 任务的下次执行时间保存在sqlite，重启后插件以相同的ID和触发器重新添加任务时，沿用保存的执行时间，
+  停机期间错过的执行在misfire_grace_time内补执行一次，超过则跳过
+- 同一任务上一次还未执行完时，到期的执行合并为一次，在上一次结束后执行
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from common.log import logger
+from common.timer_heap import TimerHeap
+from config import conf, get_appdata_dir
+
+WEEKDAYS = {"Monday": 0, "Tuesday": 1, "Wednesday": 2, "Thursday": 3, "Friday": 4, "Saturday": 5, "Sunday": 6}
+
+
+def _localize(timezone, dt):
+    """naive时间转换为指定时区的时间，timezone为None时使用本地时间"""
+    if timezone is None:
+        return dt
+    if hasattr(timezone, "localize"):
+        # pytz时区
+        return timezone.localize(dt)
+    return dt.replace(tzinfo=timezone)
+
+
+class OnceTrigger(object):
+    """在指定时间执行一次"""
+
+    def __init__(self, run_at):
+        self.run_at = run_at.timestamp() if isinstance(run_at, datetime) else float(run_at)
+        self.spec = "once {:.0f}".format(self.run_at)
+
+    def get_next(self, after):
+        return self.run_at if self.run_at > after else None
+
+
+class IntervalTrigger(object):
+    """每隔固定秒数执行"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.spec = "interval {}".format(seconds)
+
+    def get_next(self, after):
+        return after + self.seconds
+
+
+class TimeOfDayTrigger(object):
+    """每天的固定时间执行，weekdays限定星期几（0为周一），为None时每天执行"""
+
+    def __init__(self, time_str, weekdays=None, timezone=None):
+        parts = [int(part) for part in time_str.split(":")]
+        if len(parts) not in (2, 3):
+            raise ValueError("时间格式错误，应为 HH:MM")
+        self.hour, self.minute = parts[0], parts[1]
+        self.second = parts[2] if len(parts) == 3 else 0
+        self.weekdays = weekdays
+        self.timezone = timezone
+        self.spec = "time {} {} {}".format(time_str, sorted(weekdays) if weekdays else "*", timezone or "")
+
+    def get_next(self, after):
+        day = datetime.fromtimestamp(after, self.timezone).date()
+        for i in range(8):
+            candidate = day + timedelta(days=i)
+            if self.weekdays and candidate.weekday() not in self.weekdays:
+                continue
+            run_at = _localize(self.timezone, datetime(candidate.year, candidate.month, candidate.day,
+                                                       self.hour, self.minute, self.second)).timestamp()
+            if run_at > after:
+                return run_at
+        return None
+
+
+class CronTrigger(object):
+    """cron表达式（分 时 日 月 周）"""
+
+    def __init__(self, expression, timezone=None):
+        from croniter import croniter
+
+        if not croniter.is_valid(expression):
+            raise ValueError("无效的cron表达式: {}".format(expression))
+        self.expression = expression
+        self.timezone = timezone
+        self.spec = "cron {} {}".format(expression, timezone or "")
+
+    def get_next(self, after):
+        from croniter import croniter
+
+        start = datetime.fromtimestamp(after, self.timezone)
+        return croniter(self.expression, start).get_next(datetime).timestamp()
+
+
+def make_trigger(schedule_type, time_str=None, timezone=None, run_at=None):
+    """
+    :param schedule_type: once(run_at为执行时间) / daily(HH:MM) / weekly(Monday HH:MM) / workday(HH:MM) /
+                          cron(表达式) / interval(秒数)
+    :param timezone: 时区(tzinfo)，为None时使用本地时间
+    """
+    if schedule_type == "once":
+        return OnceTrigger(run_at)
+    if schedule_type == "daily":
+        return TimeOfDayTrigger(time_str, timezone=timezone)
+    if schedule_type == "weekly":
+        weekday, time_str = time_str.split()
+        if weekday not in WEEKDAYS:
+            raise ValueError("无效的星期值")
+        return TimeOfDayTrigger(time_str, {WEEKDAYS[weekday]}, timezone)
+    if schedule_type == "workday":
+        return TimeOfDayTrigger(time_str, {0, 1, 2, 3, 4}, timezone)
+    if schedule_type == "cron":
+        return CronTrigger(time_str, timezone)
+    if schedule_type == "interval":
+        return IntervalTrigger(float(time_str))
+    raise ValueError("不支持的调度类型: {}".format(schedule_type))
+
+
+class Job(object):
+    __slots__ = ("id", "func", "args", "trigger", "next_run", "misfire_grace_time", "persistent", "running", "pending", "last_run")
+
+    def __init__(self, job_id, func, trigger, args, misfire_grace_time, persistent):
+        self.id = job_id
+        self.func = func
+        self.args = args
+        self.trigger = trigger
+        self.next_run = None
+        self.misfire_grace_time = misfire_grace_time  # 到期后超过该秒数仍未执行则跳过，None表示不跳过
+        self.persistent = persistent
+        self.running = False
+        self.pending = None  # 执行期间又到期的执行时间，结束后补执行一次
+        self.last_run = None
+
+    def is_misfire(self, run_time, now):
+        return self.misfire_grace_time is not None and now - run_time > self.misfire_grace_time
+
+
+class JobStore(object):
+    """保存任务的触发器和下次执行时间"""
+
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, trigger TEXT, next_run REAL)")
+
+    def get(self, job_id):
+        with self.lock:
+            return self.db.execute("SELECT trigger, next_run FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+    def save(self, job_id, trigger, next_run):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO jobs (id, trigger, next_run) VALUES (?, ?, ?)", (job_id, trigger, next_run))
+
+    def delete(self, job_id):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+
+class Scheduler(object):
+    def __init__(self, db_path=None, max_workers=4, misfire_grace_time=60):
+        self.timers = TimerHeap()
+        self.jobs = {}
+        self.lock = threading.RLock()
+        self.misfire_grace_time = misfire_grace_time
+        self.store = JobStore(db_path) if db_path else None
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="scheduler")
+        self.metrics = {"executed": 0, "failed": 0, "missed": 0, "coalesced": 0}
+        self.thread = threading.Thread(target=self._run, name="scheduler", daemon=True)
+        self.thread.start()
+
+    def add_job(self, job_id, func, trigger, args=(), misfire_grace_time=-1, persistent=True):
+        """
+        添加任务，相同ID的任务会被替换
+        :param misfire_grace_time: -1使用默认值，None表示错过执行时间也不跳过
+        :param persistent: 是否保存下次执行时间，重启后以相同的触发器添加时沿用
+        :return: Job，触发器没有下次执行时间（如once的时间已过）时返回None
+        """
+        if misfire_grace_time == -1:
+            misfire_grace_time = self.misfire_grace_time
+        job = Job(job_id, func, trigger, args, misfire_grace_time, persistent)
+        next_run = None
+        if persistent and self.store:
+            saved = self.store.get(job_id)
+            if saved and saved[0] == trigger.spec:
+                next_run = saved[1]
+        if next_run is None:
+            next_run = trigger.get_next(time.time())
+        with self.lock:
+            self.jobs[job_id] = job
+            self._set_next_run(job, next_run)
+        if next_run is None:
+            logger.warn("[Scheduler] job {} has no next run time, trigger: {}".format(job_id, trigger.spec))
+            return None
+        logger.debug("[Scheduler] job {} added, next run at {}".format(job_id, datetime.fromtimestamp(next_run)))
+        return job
+
+    def remove_job(self, job_id):
+        with self.lock:
+            job = self.jobs.pop(job_id, None)
+            self.timers.cancel(job_id)
+        if self.store:
+            self.store.delete(job_id)
+        return job is not None
+
+    def reschedule_job(self, job_id, run_at):
+        """修改任务的下次执行时间，之后仍按触发器计算"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return False
+            self._set_next_run(job, run_at)
+        return True
+
+    def get_job(self, job_id):
+        return self.jobs.get(job_id)
+
+    def get_jobs(self, prefix=""):
+        return [job for job_id, job in list(self.jobs.items()) if job_id.startswith(prefix)]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.metrics, jobs=len(self.jobs), running=sum(1 for job in self.jobs.values() if job.running))
+
+    def _set_next_run(self, job, next_run):
+        """调用前需持有self.lock"""
+        job.next_run = next_run
+        if next_run is None:
+            if self.jobs.get(job.id) is job:
+                del self.jobs[job.id]
+            self.timers.cancel(job.id)
+            if job.persistent and self.store:
+                self.store.delete(job.id)
+            return
+        self.timers.schedule(job.id, next_run)
+        if job.persistent and self.store:
+            self.store.save(job.id, job.trigger.spec, next_run)
+
+    def _run(self):
+        while True:
+            try:
+                for job_id, run_time in self.timers.pop_due():
+                    self._fire(job_id, run_time)
+            except Exception as e:
+                logger.exception("[Scheduler] dispatch error: {}".format(e))
+            self.timers.wait(60)
+
+    def _fire(self, job_id, run_time):
+        now = time.time()
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            # 先计算下次执行时间，任务执行中可以再修改
+            self._set_next_run(job, job.trigger.get_next(max(now, run_time)))
+            if job.is_misfire(run_time, now):
+                self.metrics["missed"] += 1
+                logger.warn("[Scheduler] job {} missed run at {}, skipped".format(job_id, datetime.fromtimestamp(run_time)))
+                return
+            if job.running:
+                self.metrics["coalesced"] += 1
+                job.pending = run_time
+                return
+            job.running = True
+        self.executor.submit(self._execute, job, run_time)
+
+    def _execute(self, job, run_time):
+        while True:
+            job.last_run = run_time
+            try:
+                job.func(*job.args)
+                ok = True
+            except Exception as e:
+                ok = False
+                logger.exception("[Scheduler] job {} failed: {}".format(job.id, e))
+            with self.lock:
+                self.metrics["executed" if ok else "failed"] += 1
+                run_time, job.pending = job.pending, None
+                if run_time is not None and self.jobs.get(job.id) is not job:
+                    # 执行期间任务被删除、替换
+                    run_time = None
+                if run_time is not None and job.is_misfire(run_time, time.time()):
+                    self.metrics["missed"] += 1
+                    run_time = None
+                if run_time is None:
+                    job.running = False
+                    return
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> Scheduler:
+    """
+    获取共用的调度器，首次调用时启动调度线程
+    """
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = Scheduler(
+                    os.path.join(get_appdata_dir(), "scheduler.db"),
+                    max_workers=conf().get("scheduler_max_workers", 4),
+                    misfire_grace_time=conf().get("scheduler_misfire_grace_time", 60),
+                )
+    return _scheduler
@@ -0,0 +1,124 @@
+# encoding:utf-8
+
+import heapq
+import itertools
+import threading
+import time
+
+
+class TimerHeap(object):
+    """
+    按下次执行时间排序的最小堆，替代每秒遍历全部任务
+    检测线程只需要查看堆顶，睡眠到最近的执行时间；添加、取消任务时唤醒检测线程
+    任务重新调度、取消后，堆中的旧记录不会立即删除，出堆时判断是否为当前有效记录
+    定时任务插件的任务堆、common.scheduler的调度线程共用
+    """
+
+    def __init__(self):
+        self.heap = []  # (执行时间戳, 序号, taskId)
+        self.entries = {}  # taskId -> 当前有效的堆记录
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+
+    def schedule(self, taskId, run_time):
+        """
+        设置任务的下次执行时间，run_time为None时取消任务
+        """
+        with self.cond:
+            if run_time is None:
+                self.entries.pop(taskId, None)
+            else:
+                entry = (run_time, next(self.counter), taskId)
+                self.entries[taskId] = entry
+                heapq.heappush(self.heap, entry)
+            # 失效记录过多时重建堆
+            if len(self.heap) > 2 * len(self.entries) + 64:
+                self.heap = [entry for entry in self.heap if self.entries.get(entry[2]) is entry]
+                heapq.heapify(self.heap)
+            self.cond.notify()
+
+    def cancel(self, taskId):
+        self.schedule(taskId, None)
+
+    def clear(self):
+        with self.cond:
+            self.heap = []
+            self.entries = {}
+            self.cond.notify()
+
+    def _discard_stale(self):
+        while self.heap and self.entries.get(self.heap[0][2]) is not self.heap[0]:
+            heapq.heappop(self.heap)
+
+    def get(self, taskId):
+        """任务的下次执行时间，未调度时返回None"""
+        entry = self.entries.get(taskId)
+        return entry[0] if entry else None
+
+    def next_time(self):
+        """最近的执行时间，没有任务时返回None"""
+        with self.cond:
+            self._discard_stale()
+            return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now=None):
+        """
+        取出已到执行时间的任务
+        :return: [(taskId, 执行时间戳)]，按执行时间排序
+        """
+        now = time.time() if now is None else now
+        due = []
+        with self.cond:
+            while True:
+                self._discard_stale()
+                if not self.heap or self.heap[0][0] > now:
+                    break
+                run_time, _, taskId = heapq.heappop(self.heap)
+                del self.entries[taskId]
+                due.append((taskId, run_time))
+        return due
+
+    def wait(self, timeout):
+        """
+        睡眠到最近的执行时间，最长timeout秒，期间添加、取消任务会提前唤醒
+        """
+        with self.cond:
+            self._discard_stale()
+            if self.heap:
+                timeout = min(timeout, self.heap[0][0] - time.time())
+            if timeout > 0:
+                self.cond.wait(timeout)
+
+    def __contains__(self, taskId):
+        return taskId in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+if __name__ == "__main__":
+    import random
+
+    # 1万个任务，分布在未来一天内
+    n = 10000
+    scheduler = TimerHeap()
+    now = time.time()
+    start = time.perf_counter()
+    for i in range(n):
+        scheduler.schedule(f"task{i}", now + random.uniform(0, 86400))
+    print(f"调度{n}个任务: {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    # 无到期任务时，每次检测只查看堆顶
+    start = time.perf_counter()
+    for _ in range(10000):
+        scheduler.pop_due(now)
+    print(f"无到期任务的检测: {(time.perf_counter() - start) / 10000 * 1e6:.2f}us/次")
+
+    # 取消一半任务后，取出一小时内到期的任务并重新调度到第二天
+    for i in range(0, n, 2):
+        scheduler.cancel(f"task{i}")
+    start = time.perf_counter()
+    due = scheduler.pop_due(now + 3600)
+    for taskId, run_time in due:
+        scheduler.schedule(taskId, run_time + 86400)
+    print(f"取出并重新调度{len(due)}个到期任务: {(time.perf_counter() - start) * 1000:.2f}ms, 剩余任务数: {len(scheduler)}")
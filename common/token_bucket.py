@@ -1,39 +1,182 @@
+import asyncio
 import threading
 import time
 
+from common import const
+from config import conf
+
 
 class TokenBucket:
-    def __init__(self, tpm, timeout=None):
-        self.capacity = int(tpm)  # 令牌桶容量
-        self.tokens = 0  # 初始令牌数为0
+    """
+    令牌桶，获取令牌时根据距上次补充的时间计算新增的令牌，不需要后台线程
+    单次获取的数量超过桶容量时，桶满即可获取，超出部分从后续补充的令牌中扣除
+    """
+
+    def __init__(self, tpm, timeout=None, capacity=None):
+        self.capacity = int(tpm) if capacity is None else int(capacity)  # 令牌桶容量，默认为每分钟的令牌数，设置较小的容量可避免突发
+        self.tokens = float(self.capacity)  # 初始为满桶
         self.rate = int(tpm) / 60  # 令牌每秒生成速率
         self.timeout = timeout  # 等待令牌超时时间
-        self.cond = threading.Condition()  # 条件变量
-        self.is_running = True
-        # 开启令牌生成线程
-        threading.Thread(target=self._generate_tokens).start()
-
-    def _generate_tokens(self):
-        """生成令牌"""
-        while self.is_running:
-            with self.cond:
-                if self.tokens < self.capacity:
-                    self.tokens += 1
-                self.cond.notify()  # 通知获取令牌的线程
-            time.sleep(1 / self.rate)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
 
-    def get_token(self):
-        """获取令牌"""
-        with self.cond:
-            while self.tokens <= 0:
-                flag = self.cond.wait(self.timeout)
-                if not flag:  # 超时
-                    return False
-            self.tokens -= 1
-        return True
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def _wait_time(self, n):
+        """还需要等待多少秒才能获取n个令牌，调用前需先_refill"""
+        need = min(n, self.capacity)
+        if self.tokens >= need:
+            return 0
+        return (need - self.tokens) / self.rate
+
+    def _take(self, n):
+        self.tokens -= n
+
+    def try_acquire(self, n=1):
+        """
+        尝试获取n个令牌，不等待
+        :return: 获取成功返回0，否则返回需要等待的秒数
+        """
+        with self.lock:
+            self._refill(time.monotonic())
+            wait = self._wait_time(n)
+            if wait == 0:
+                self._take(n)
+            return wait
+
+    def get_token(self, n=1, timeout=-1):
+        """获取令牌，timeout为-1时使用创建时指定的超时时间，None表示一直等待"""
+        return _acquire(self.try_acquire, n, self.timeout if timeout == -1 else timeout)
+
+    async def get_token_async(self, n=1, timeout=-1):
+        return await _acquire_async(self.try_acquire, n, self.timeout if timeout == -1 else timeout)
+
+    def refund(self, n):
+        """退回多扣的令牌，n为负数时补扣"""
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + n)
 
     def close(self):
-        self.is_running = False
+        # 不再有令牌生成线程，保留该方法以兼容旧的调用
+        pass
+
+
+class RateLimiter:
+    """
+    同时限制每分钟请求数(RPM)和每分钟token数(TPM)，两个维度都满足时才放行
+    """
+
+    def __init__(self, rpm=0, tpm=0, timeout=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.timeout = timeout
+        self.request_bucket = TokenBucket(rpm) if rpm else None
+        self.token_bucket = TokenBucket(tpm) if tpm else None
+        self.lock = threading.Lock()
+
+    def try_acquire(self, tokens=0):
+        """
+        :param tokens: 本次请求预估的token数
+        :return: 获取成功返回0，否则返回需要等待的秒数
+        """
+        with self.lock:
+            now = time.monotonic()
+            wait = 0
+            if self.request_bucket:
+                self.request_bucket._refill(now)
+                wait = max(wait, self.request_bucket._wait_time(1))
+            if self.token_bucket and tokens:
+                self.token_bucket._refill(now)
+                wait = max(wait, self.token_bucket._wait_time(tokens))
+            if wait == 0:
+                if self.request_bucket:
+                    self.request_bucket._take(1)
+                if self.token_bucket and tokens:
+                    self.token_bucket._take(tokens)
+            return wait
+
+    def acquire(self, tokens=0, timeout=-1):
+        """获取一次请求的额度，timeout为-1时使用创建时指定的超时时间，None表示一直等待"""
+        return _acquire(self.try_acquire, tokens, self.timeout if timeout == -1 else timeout)
+
+    async def acquire_async(self, tokens=0, timeout=-1):
+        return await _acquire_async(self.try_acquire, tokens, self.timeout if timeout == -1 else timeout)
+
+    def settle(self, estimated, actual):
+        """
+        请求完成后按实际用量修正预扣的token数
+        :param estimated: 获取额度时预扣的token数
+        :param actual: 接口返回的实际token数(含回复)，请求失败时为0
+        """
+        if self.token_bucket and actual is not None and actual != estimated:
+            self.token_bucket.refund(estimated - actual)
+
+    def get_token(self):
+        # 兼容TokenBucket的调用方式
+        return self.acquire()
+
+
+def _acquire(try_acquire, n, timeout):
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        wait = try_acquire(n)
+        if wait == 0:
+            return True
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            wait = min(wait, remaining)
+        time.sleep(wait)
+
+
+async def _acquire_async(try_acquire, n, timeout):
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        wait = try_acquire(n)
+        if wait == 0:
+            return True
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            wait = min(wait, remaining)
+        await asyncio.sleep(wait)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(key, rpm=0, tpm=0, timeout=None) -> RateLimiter:
+    """
+    按key获取共享的限流器，用于按用户、按api key等维度限流，配置变化时重新创建
+    """
+    limiter = _limiters.get(key)
+    if limiter is None or limiter.rpm != rpm or limiter.tpm != tpm:
+        with _limiters_lock:
+            limiter = _limiters.get(key)
+            if limiter is None or limiter.rpm != rpm or limiter.tpm != tpm:
+                limiter = _limiters[key] = RateLimiter(rpm, tpm, timeout)
+    return limiter
+
+
+def get_chat_limiter(bot_type):
+    """
+    获取对话接口的限流器，未配置限流时返回None
+    chatGPT使用rate_limit_chatgpt和rate_limit_chatgpt_tpm，其他模型在rate_limits中按bot类型配置
+    """
+    if bot_type == const.CHATGPT:
+        rpm, tpm = conf().get("rate_limit_chatgpt", 0), conf().get("rate_limit_chatgpt_tpm", 0)
+    else:
+        limit = (conf().get("rate_limits") or {}).get(bot_type) or {}
+        rpm, tpm = limit.get("rpm", 0), limit.get("tpm", 0)
+    if not rpm and not tpm:
+        return None
+    return get_rate_limiter("chat:" + bot_type, rpm=rpm, tpm=tpm)
 
 
 if __name__ == "__main__":
@@ -43,3 +186,21 @@ if __name__ == "__main__":
         if token_bucket.get_token():
             print(f"第{i+1}次请求成功")
     token_bucket.close()
+
+    # 获取令牌的吞吐量
+    n = 200000
+    limiter = RateLimiter(rpm=10 ** 12, tpm=10 ** 12)
+    start = time.perf_counter()
+    for _ in range(n):
+        limiter.acquire(100)
+    elapsed = time.perf_counter() - start
+    print(f"单线程: {n / elapsed:.0f} acquire/s")
+
+    threads = [threading.Thread(target=lambda: [limiter.acquire(100) for _ in range(n // 8)]) for _ in range(8)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    print(f"8线程: {n / elapsed:.0f} acquire/s")
@@ -0,0 +1,175 @@
+# encoding:utf-8
+
+import atexit
+import os
+import sqlite3
+import threading
+import time
+from datetime import date, timedelta
+
+from common.log import logger
+from common.singleton import singleton
+from config import conf, get_appdata_dir
+
+
+@singleton
+class UsageLedger(object):
+    """
+    按会话/用户/群/模型统计每日的token用量和请求次数
+    每个线程只写自己的计数器，记录时无需加锁；后台线程定期汇总写入sqlite，重启后会加载当天的用量
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._buffers = []  # 所有线程的计数器 {(day, dim, key): [tokens, requests]}
+        self._buffers_lock = threading.Lock()  # 保护计数器列表，记录时不使用
+        self._base = {}  # 启动时从数据库加载的用量
+        self._db_path = os.path.join(get_appdata_dir(), "usage.db")
+        self._init_db()
+        self._flush_interval = conf().get("usage_flush_interval", 60)
+        _thread = threading.Thread(target=self._flush_loop)
+        _thread.setDaemon(True)
+        _thread.start()
+        atexit.register(self.flush)
+
+    def _init_db(self):
+        today = date.today().isoformat()
+        with sqlite3.connect(self._db_path) as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS usage (day TEXT NOT NULL, dim TEXT NOT NULL, key TEXT NOT NULL, "
+                "tokens INTEGER NOT NULL DEFAULT 0, requests INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (day, dim, key))"
+            )
+            for dim, key, tokens, requests in db.execute("SELECT dim, key, tokens, requests FROM usage WHERE day = ?", (today,)):
+                self._base[(today, dim, key)] = [tokens, requests]
+
+    def _buffer(self) -> dict:
+        buf = getattr(self._local, "buf", None)
+        if buf is None:
+            buf = self._local.buf = {}
+            self._local.day = date.today().isoformat()
+            with self._buffers_lock:
+                self._buffers.append(buf)
+        return buf
+
+    def _incr(self, targets, tokens, requests):
+        buf = self._buffer()
+        day = date.today().isoformat()
+        if day != self._local.day:
+            # 跨天后清理前天及更早的计数，昨天的保留到下一次写库
+            self._local.day = day
+            yesterday = (date.today() - timedelta(days=1)).isoformat()
+            for k in [k for k in buf if k[0] < yesterday]:
+                del buf[k]
+        for dim, key in targets:
+            counter = buf.get((day, dim, key))
+            if counter is None:
+                counter = buf[(day, dim, key)] = [0, 0]
+            counter[0] += tokens
+            counter[1] += requests
+
+    @staticmethod
+    def _targets(context, model=None):
+        targets = []
+        if context is None:
+            return targets
+        if context.get("session_id"):
+            targets.append(("session", context["session_id"]))
+        msg = context.get("msg")
+        if msg is not None:
+            if context.get("isgroup", False):
+                targets.append(("user", msg.actual_user_id))
+                targets.append(("group", msg.other_user_id))
+            else:
+                targets.append(("user", msg.from_user_id))
+        if model:
+            targets.append(("model", model))
+        return targets
+
+    def begin(self, context, model=None, count_request=True):
+        """
+        开始一次对话请求，之后当前线程上报的token都计入该请求的会话/用户/群/模型
+        :param count_request: 是否计入请求次数，在其他线程中处理同一请求时传False
+        """
+        targets = self._targets(context, model)
+        self._local.targets = targets
+        if count_request:
+            self._incr(targets, 0, 1)
+
+    def end(self):
+        self._local.targets = None
+
+    def add_tokens(self, total_tokens):
+        """
+        上报当前线程正在处理的请求消耗的token数
+        """
+        targets = getattr(self._local, "targets", None)
+        if not targets or not total_tokens:
+            return
+        self._incr(targets, int(total_tokens), 0)
+
+    def _aggregate(self) -> dict:
+        total = {k: list(v) for k, v in self._base.items()}
+        with self._buffers_lock:
+            buffers = list(self._buffers)
+        for buf in buffers:
+            for k, (tokens, requests) in dict(buf).items():
+                counter = total.get(k)
+                if counter is None:
+                    counter = total[k] = [0, 0]
+                counter[0] += tokens
+                counter[1] += requests
+        return total
+
+    def get_usage(self, dim, key, day=None):
+        """
+        :return: (tokens, requests)
+        """
+        k = (day or date.today().isoformat(), dim, key)
+        tokens, requests = self._base.get(k, (0, 0))
+        with self._buffers_lock:
+            buffers = list(self._buffers)
+        for buf in buffers:
+            counter = buf.get(k)
+            if counter:
+                tokens += counter[0]
+                requests += counter[1]
+        return tokens, requests
+
+    def get_context_usage(self, context) -> dict:
+        """
+        :return: {dim: (tokens, requests)}，dim为session、user、group
+        """
+        return {dim: self.get_usage(dim, key) for dim, key in self._targets(context)}
+
+    def check_budget(self, context):
+        """
+        检查用户和群当天的用量是否超出预算，预算为0或不配置时不限制
+        :return: (是否允许请求, 提示信息)
+        """
+        for dim, key in self._targets(context):
+            if dim not in ["user", "group"]:
+                continue
+            tokens, requests = self.get_usage(dim, key)
+            token_budget = conf().get("daily_token_budget_" + dim, 0)
+            request_budget = conf().get("daily_request_budget_" + dim, 0)
+            if token_budget and tokens >= token_budget:
+                return False, "今日token额度已用完({}/{})".format(tokens, token_budget)
+            if request_budget and requests >= request_budget:
+                return False, "今日提问次数已用完({}/{})".format(requests, request_budget)
+        return True, None
+
+    def flush(self):
+        try:
+            rows = [(day, dim, key, tokens, requests) for (day, dim, key), (tokens, requests) in self._aggregate().items()]
+            if not rows:
+                return
+            with sqlite3.connect(self._db_path) as db:
+                db.executemany("INSERT OR REPLACE INTO usage (day, dim, key, tokens, requests) VALUES (?, ?, ?, ?, ?)", rows)
+            logger.debug("[UsageLedger] flushed {} rows".format(len(rows)))
+        except Exception as e:
+            logger.warning("[UsageLedger] flush failed: {}".format(e))
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self._flush_interval)
+            self.flush()
@@ -5,6 +5,8 @@ import logging
 import os
 import pickle
 import copy
+import threading
+from contextlib import contextmanager
 
 from common.log import logger
 
@@ -13,6 +15,8 @@ from common.log import logger
 available_setting = {
     # openai api配置
     "open_ai_api_key": "",  # openai api key
+    # 多个openai api key，按负载分配请求，每项为key字符串或{"key": "sk-xxx", "rpm": 3500, "tpm": 90000}
+    "open_ai_api_keys": [],
     # openai apibase，当use_azure_chatgpt为true时，需要设置对应的api base
     "open_ai_api_base": "https://api.openai.com/v1",
     "proxy": "",  # openai使用的代理
@@ -52,19 +56,57 @@ available_setting = {
     "group_chat_exit_group": False,
     # chatgpt会话参数
     "expires_in_seconds": 3600,  # 无操作会话的过期时间
+    "session_max_count": 0,  # 内存中最多保留的会话数，超出后最久未使用的会话写入磁盘，0表示不限制
+    "session_max_tokens": 0,  # 内存中会话token总数上限，按各模型的token计算方式统计，0表示不限制
     # 人格描述
     "character_desc": "你是ChatGPT, 一个由OpenAI训练的大型语言模型, 你旨在回答并解决人们的任何问题，并且可以使用多种语言与人交流。",
     "conversation_max_tokens": 1000,  # 支持上下文记忆的最多字符数
+    # 首轮提问的回复缓存，适合群聊中的常见问题
+    "reply_cache_enabled": False,  # 是否开启回复缓存
+    "reply_cache_ttl": 3600,  # 缓存有效期，单位秒
+    "reply_cache_max_size": 1000,  # 最多缓存的问题数
+    "reply_cache_similarity": 0,  # 相似问题的命中阈值(0~1)，0表示只精确匹配
     # chatgpt限流配置
     "rate_limit_chatgpt": 20,  # chatgpt的调用频率限制
+    "rate_limit_chatgpt_tpm": 0,  # chatgpt每分钟token数限制，按预估的prompt token预扣，回复后按实际用量修正，0表示不限制
+    "rate_limits": {},  # 其他模型的限流配置，按bot类型设置，如 {"claudeAPI": {"rpm": 50, "tpm": 40000}}
+    "rate_limit_wait": 20,  # 超出限流时最多排队等待的秒数，超时后提示用户稍后再问
     "rate_limit_dalle": 50,  # openai dalle的调用频率限制
+    # 用量统计与每日预算，预算为0表示不限制
+    "usage_flush_interval": 60,  # 用量写入数据库的间隔，单位秒
+    "daily_token_budget_user": 0,  # 每个用户每天的token预算
+    "daily_token_budget_group": 0,  # 每个群每天的token预算
+    "daily_request_budget_user": 0,  # 每个用户每天的提问次数
+    "daily_request_budget_group": 0,  # 每个群每天的提问次数
     # chatgpt api参数 参考https://platform.openai.com/docs/api-reference/chat/create
     "temperature": 0.9,
     "top_p": 1,
     "frequency_penalty": 0,
     "presence_penalty": 0,
     "request_timeout": 180,  # chatgpt请求超时时间，openai接口默认设置为600，对于难问题一般需要较长时间
+    # 模型接口的重试策略，按bot类型配置，如 {"chatGPT": {"max_attempts": 3, "base_delay": 1, "max_delay": 20, "min_timeout": 20}}，画图接口为dalle
+    # 超时时间为近期成功请求p99延迟的p99_multiplier倍，不低于min_timeout，不超过request_timeout
+    "retry_policies": {},
     "timeout": 120,  # chatgpt重试超时时间，在这个时间内，将会自动重试
+    # 共享HTTP连接池配置
+    "http_pool_maxsize": 10,  # 每个host最多保持的连接数
+    "http_max_hosts": 32,  # 最多保持连接池的host数，超出后关闭最久未使用的host的连接
+    "http_retries": 2,  # 建立连接失败时的重试次数
+    # 多模型故障转移，列表项为bot_type或bot_type:model，如 ["dashscope", "chatGPT:gpt-4o-mini"]
+    "chat_fallback_bots": [],
+    "chat_failover_timeout": 0,  # 单个模型请求超过该时间未返回则切换到下一个，0表示只在出错时切换
+    "chat_hedge_enabled": False,  # 请求超过其p95延迟仍未返回时，同时请求下一个模型，取先返回的结果
+    "chat_hedge_delay": 10,  # 延迟样本不足时使用的对冲等待时间，单位秒
+    "chat_router_workers": 0,  # 多模型请求的线程数，0表示按处理消息的线程数和模型数计算
+    "bot_prewarm": True,  # 启动时在后台创建对话bot并预先建立到接口的连接
+    "chat_single_flight": True,  # 同一模型、相同上下文和问题的并发请求只调用一次接口，共享回复
+    # 插件共用的定时调度器
+    "scheduler_max_workers": 4,  # 执行定时任务的线程数
+    "scheduler_misfire_grace_time": 60,  # 任务错过执行时间超过该秒数（如停机、线程池繁忙）则跳过本次执行
+    # 标签群发
+    "broadcast_per_minute": 20,  # 每分钟最多发送的消息数，按该速率匀速发送，最小为1
+    "broadcast_daily_limit": 500,  # 每天最多发送的消息数，超过后第二天继续发送，0表示不限制
+    "broadcast_max_attempts": 3,  # 单个接收人发送失败时最多尝试的次数
     # Baidu 文心一言参数
     "baidu_wenxin_model": "eb-instant",  # 默认使用ERNIE-Bot-turbo模型
     "baidu_wenxin_api_key": "",  # Baidu api key
@@ -75,6 +117,8 @@ available_setting = {
     "xunfei_api_secret": "",  # 讯飞 API secret
     "xunfei_domain": "",  # 讯飞模型对应的domain参数，Spark4.0 Ultra为 4.0Ultra，其他模型详见: https://www.xfyun.cn/doc/spark/Web.html
     "xunfei_spark_url": "",  # 讯飞模型对应的请求地址，Spark4.0 Ultra为 wss://spark-api.xf-yun.com/v4.0/chat，其他模型参考详见: https://www.xfyun.cn/doc/spark/Web.html
+    "xunfei_ws_pool_size": 1,  # 预先建立的websocket连接数，0表示每次提问时建立连接
+    "xunfei_ws_idle_timeout": 30,  # 预先建立的连接超过该时间未使用则丢弃，单位秒
     # claude 配置
     "claude_api_cookie": "",
     "claude_uuid": "",
@@ -132,6 +176,7 @@ available_setting = {
     "wechatmp_app_id": "",  # 微信公众平台的appID
     "wechatmp_app_secret": "",  # 微信公众平台的appsecret
     "wechatmp_aes_key": "",  # 微信公众平台的EncodingAESKey，加密模式需要
+    "wechatmp_reply_deadline": 0,  # 被动回复模式下模型回复的截止时间(秒)，超时后不再重试并返回错误提示，微信服务器等待15秒，0表示不限制
     # wechatcom的通用配置
     "wechatcom_corp_id": "",  # 企业微信公司的corpID
     # wechatcomapp的配置
@@ -193,6 +238,9 @@ class Config(dict):
     def __getitem__(self, key):
         if key not in available_setting:
             raise Exception("key {} not in available_setting".format(key))
+        keys = getattr(_config_reads, "keys", None)
+        if keys is not None:
+            keys.add(key)
         return super().__getitem__(key)
 
     def __setitem__(self, key, value):
@@ -312,6 +360,24 @@ def conf():
     return config
 
 
+_config_reads = threading.local()
+
+
+@contextmanager
+def record_config_reads():
+    """
+    记录代码块中当前线程读取过的配置项，用于判断对象创建时依赖的配置是否发生变化
+    """
+    outer = getattr(_config_reads, "keys", None)
+    keys = _config_reads.keys = set()
+    try:
+        yield keys
+    finally:
+        _config_reads.keys = outer
+        if outer is not None:
+            outer.update(keys)
+
+
 def get_appdata_dir():
     data_path = os.path.join(get_root(), conf().get("appdata_dir", ""))
     if not os.path.exists(data_path):
@@ -7,7 +7,7 @@ import logging
 
 from .. import config, utils
 from ..returnvalues import ReturnValue
-from ..storage import contact_change
+from ..storage import contact_change, notify_contact_listeners
 from ..utils import update_info_dict
 
 logger = logging.getLogger('itchat')
@@ -169,6 +169,7 @@ def update_local_chatrooms(core, l):
         newSelf = utils.search_dict_list(oldChatroom['MemberList'],
                                          'UserName', core.storageClass.userName)
         oldChatroom['Self'] = newSelf or copy.deepcopy(core.loginInfo['User'])
+    notify_contact_listeners(core, 'chatrooms', l)
     return {
         'Type': 'System',
         'Text': [chatroom['UserName'] for chatroom in l],
@@ -200,6 +201,7 @@ def update_local_friends(core, l):
                 core.mpList.append(oldInfoDict)
         else:
             update_info_dict(oldInfoDict, friend)
+    notify_contact_listeners(core, 'friends', l)
 
 
 @contact_change
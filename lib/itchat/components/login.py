@@ -19,6 +19,7 @@ from pyqrcode import QRCode
 from .. import config, utils
 from ..returnvalues import ReturnValue
 from ..storage.templates import wrap_user_dict
+from ..storage import notify_contact_listeners
 from .contact import update_local_chatrooms, update_local_friends
 from .messages import produce_msg
 
@@ -413,6 +414,7 @@ def logout(self):
     del self.chatroomList[:]
     del self.memberList[:]
     del self.mpList[:]
+    notify_contact_listeners(self, 'clear', [])
     return ReturnValue({'BaseResponse': {
         'ErrMsg': 'logout successfully.',
         'Ret': 0, }})
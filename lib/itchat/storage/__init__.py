@@ -1,4 +1,4 @@
-import os, time, copy
+import os, time, copy, logging
 from threading import Lock
 
 from .messagequeue import Queue
@@ -6,12 +6,28 @@ from .templates import (
     ContactList, AbstractUserDict, User,
     MassivePlatform, Chatroom, ChatroomMember)
 
+logger = logging.getLogger('itchat')
+
 def contact_change(fn):
     def _contact_change(core, *args, **kwargs):
         with core.storageClass.updateLock:
             return fn(core, *args, **kwargs)
     return _contact_change
 
+contact_listeners = []
+
+def add_contact_listener(fn):
+    ''' fn(core, kind, contacts) is called after local contacts change
+        kind is 'friends', 'chatrooms' or 'clear' (logout) '''
+    contact_listeners.append(fn)
+
+def notify_contact_listeners(core, kind, contacts):
+    for fn in contact_listeners:
+        try:
+            fn(core, kind, contacts)
+        except Exception:
+            logger.exception('contact listener failed')
+
 class Storage(object):
     def __init__(self, core):
         self.userName          = None
@@ -12,7 +12,6 @@ from plugins import *
 from config import conf
 import json
 import os
-import schedule
 from datetime import datetime
 import shutil
 from pathlib import Path
@@ -20,12 +19,17 @@ from flask import Flask, render_template, jsonify, request, send_file, current_a
 import threading
 import webbrowser
 from common.log import logger
+from common.broadcast import get_broadcast_engine
+from common.scheduler import get_scheduler, make_trigger
+from plugins.config_gui_web.tag_index import TagIndex
 import platform
-import random
 import time
 import traceback
 import tempfile
 import copy
+import hashlib
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 import itchat
 
 def safe_int(value, default):
@@ -53,6 +57,103 @@ def get_expires_in_seconds():
         logger.error(f"[ConfigGUIWeb] Failed to get expires_in_seconds: {e}")
         return 3600  # 返回默认值
 
+_json_cache = {}  # 文件路径 -> ((修改时间, 大小), 解析结果)
+_json_cache_lock = threading.Lock()
+
+def read_json_cached(path):
+    """读取JSON文件，按文件的修改时间、大小缓存解析结果，返回副本，调用方可以修改"""
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    with _json_cache_lock:
+        cached = _json_cache.get(path)
+    if cached is None or cached[0] != signature:
+        with open(path, 'r', encoding='utf-8') as f:
+            cached = (signature, json.load(f))
+        with _json_cache_lock:
+            _json_cache[path] = cached
+    return copy.deepcopy(cached[1])
+
+def write_json(path, data):
+    """写入JSON文件：内容不变时不写入，先写临时文件再替换，避免读到写了一半的文件，返回是否写入"""
+    text = json.dumps(data, ensure_ascii=False, indent=4)
+    mode = 0o644
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            if f.read() == text:
+                return False
+        mode = os.stat(path).st_mode & 0o777
+    # 每次写入使用不同的临时文件，后台任务和请求线程同时写入时互不影响
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=os.path.dirname(path) or ".", suffix=".tmp", delete=False) as f:
+        f.write(text)
+    try:
+        # 临时文件的权限为600，替换前恢复原文件的权限
+        os.chmod(f.name, mode)
+        os.replace(f.name, path)
+    except Exception:
+        os.remove(f.name)
+        raise
+    return True
+
+def etag_json(payload):
+    """返回JSON响应并设置ETag，请求头If-None-Match与内容一致时返回304"""
+    body = json.dumps(payload, ensure_ascii=False)
+    response = current_app.response_class(body, mimetype="application/json")
+    response.set_etag(hashlib.md5(body.encode("utf-8")).hexdigest())
+    return response.make_conditional(request)
+
+# 后台任务（导入配置等），通过 /api/jobs/<job_id> 查询状态，完成1小时后过期
+JOB_EXPIRES_IN_SECONDS = 3600
+_jobs = {}  # job_id -> 任务状态
+_job_expires = {}  # job_id -> 过期时间，任务完成时设置
+_jobs_lock = threading.Lock()
+_job_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="config_gui_web")
+
+def submit_job(job_type, func, *args):
+    """提交后台任务，立即返回任务状态"""
+    job = {
+        "id": f"{job_type}_{uuid.uuid4().hex[:12]}",
+        "type": job_type,
+        "status": "queued",
+        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "finished_at": None,
+        "result": None,
+        "error": None
+    }
+    with _jobs_lock:
+        # 清理已过期的任务
+        now = time.time()
+        for job_id in [job_id for job_id, expires_at in _job_expires.items() if expires_at <= now]:
+            del _job_expires[job_id]
+            _jobs.pop(job_id, None)
+        _jobs[job["id"]] = job
+    _job_executor.submit(_run_job, job, func, args)
+    return job
+
+def get_job_status(job_id):
+    """后台任务状态，不存在或已过期时返回None"""
+    with _jobs_lock:
+        expires_at = _job_expires.get(job_id)
+        if expires_at is not None and expires_at <= time.time():
+            return None
+        return _jobs.get(job_id)
+
+def _run_job(job, func, args):
+    job["status"] = "running"
+    try:
+        job["result"] = func(*args)
+        job["status"] = "done"
+    except Exception as e:
+        job["status"] = "failed"
+        job["error"] = str(e)
+        logger.error(f"[ConfigGUIWeb] Job {job['id']} failed: {e}\n{traceback.format_exc()}")
+    finally:
+        job["finished_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with _jobs_lock:
+            _job_expires[job["id"]] = time.time() + JOB_EXPIRES_IN_SECONDS
+
+# 网页添加的任务使用英文调度类型，对应TagManager的调度类型
+WEB_SCHEDULE_TYPES = {"daily": "每天", "workday": "工作日", "weekly": "每周"}
+
 # 创建Flask应用
 app = Flask(__name__)
 
@@ -83,31 +184,17 @@ class ConfigGUIWebPlugin(Plugin):
                 "plugin_trigger_prefix": "#",
                 "task_retry_count": 3,
                 "task_retry_interval": 300,
-                "task_timeout": 600,
-                # 添加消息发送限制配置
-                "message_interval": [3, 8],  # 发送消息的随机间隔范围（秒）
-                "batch_size": 5,  # 每批发送的最大消息数
-                "batch_interval": [30, 60],  # 批次之间的随机间隔范围（秒）
-                "daily_limit": 100,  # 每日发送消息的上限
-                "active_hours": [9, 22]  # 活跃时间范围（避免深夜发送）
+                "task_timeout": 600
+                # 消息发送频率由主配置的 broadcast_per_minute、broadcast_daily_limit 控制
             }
         
-        # 初始化消息计数器
-        self.message_counter = {
-            "daily_count": 0,
-            "last_reset": datetime.now().date(),
-            "last_send_time": None,
-            "current_batch": 0
-        }
-        
         # 注册事件处理器
         self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
         
         # 初始化状态
         self.server_thread = None
-        self.schedule_thread = None
+        self.scheduler_started = False
         self.scheduled_tasks = []
-        self._task_locks = {}
         
         logger.info("[ConfigGUIWeb] Plugin initialized")
 
@@ -127,8 +214,7 @@ class ConfigGUIWebPlugin(Plugin):
                 if 'updateAutoReplyTable' not in config:
                     config['updateAutoReplyTable'] = True
                     # 保存更新后的配置
-                    with open(self.config_path, 'w', encoding='utf-8') as f:
-                        json.dump(config, f, indent=4, ensure_ascii=False)
+                    write_json(self.config_path, config)
                 return config
         except Exception as e:
             logger.error(f"[ConfigGUIWeb] Failed to load config: {e}")
@@ -178,7 +264,7 @@ class ConfigGUIWebPlugin(Plugin):
                     self.start_web_server()
                     
                     # 确保调度器已初始化
-                    if self.schedule_thread is None:
+                    if not self.scheduler_started:
                         logger.info("[ConfigGUIWeb] Initializing scheduler")
                         self.init_scheduler()
                     
@@ -203,23 +289,18 @@ class ConfigGUIWebPlugin(Plugin):
     def init_scheduler(self):
         """初始化调度器"""
         try:
-            if self.schedule_thread is None:
+            if not self.scheduler_started:
                 logger.info("[ConfigGUIWeb] Initializing scheduler...")
                 
-                # 清除所有现有任务
-                schedule.clear()
+                # 任务由共用调度器执行，按任务ID替换，不清除其他插件的任务
                 self.scheduled_tasks = []
                 
                 # 加载现有任务
                 self.load_scheduled_tasks()
                 
-                # 启动调度线程
-                if self.schedule_thread and self.schedule_thread.is_alive():
-                    logger.info("[ConfigGUIWeb] Scheduler thread already running")
-                    return True
-                    
-                self.schedule_thread = threading.Thread(target=self.run_schedule, daemon=True)
-                self.schedule_thread.start()
+                # 定期检查登录状态
+                get_scheduler().add_job("config_gui_web.login_check", self.check_login, make_trigger("interval", 300), persistent=False)
+                self.scheduler_started = True
                 logger.info("[ConfigGUIWeb] Scheduler started successfully")
                 return True
                 
@@ -265,13 +346,6 @@ class ConfigGUIWebPlugin(Plugin):
                     logger.error(f"[ConfigGUIWeb] Invalid task data: {task}")
                     continue
                     
-                # 验证时间格式
-                try:
-                    time.strptime(task["time"], "%H:%M")
-                except ValueError:
-                    logger.error(f"[ConfigGUIWeb] Invalid time format in task: {task}")
-                    continue
-                    
                 # 创建完整的任务对象
                 task_obj = {
                     "id": task["id"],
@@ -293,31 +367,16 @@ class ConfigGUIWebPlugin(Plugin):
                 # 添加到内存中的任务列表
                 self.scheduled_tasks.append(task_obj)
                     
-                # 调度任务
-                self.schedule_task(
-                    task_obj["id"],
-                    task_obj["tag"],
-                    task_obj["time"],
-                    task_obj["message"]
-                )
+                # 调度任务，TagManager已按相同的触发器调度时保留原任务
+                self._schedule_job(task_obj)
             logger.info(f"[ConfigGUIWeb] Successfully loaded {len(tasks)} scheduled tasks")
         except Exception as e:
             logger.error(f"[ConfigGUIWeb] Failed to load scheduled tasks: {e}")
 
-    def schedule_task(self, task_id, tag, time_str, message):
+    def schedule_task(self, task_id, tag, time_str, message, schedule_type="daily"):
         """调度定时任务"""
         try:
-            logger.info(f"[ConfigGUIWeb] Scheduling task {task_id} for tag {tag} at {time_str}")
-            
-            # 验证时间格式
-            try:
-                time.strptime(time_str, "%H:%M")
-            except ValueError:
-                logger.error(f"[ConfigGUIWeb] Invalid time format for task {task_id}: {time_str}")
-                return False
-            
-            # 清除同ID的旧任务
-            schedule.clear(task_id)
+            logger.info(f"[ConfigGUIWeb] Scheduling task {task_id} for tag {tag} at {schedule_type} {time_str}")
             
             # 从任务列表中移除旧任务
             self.scheduled_tasks = [t for t in self.scheduled_tasks if t.get("id") != task_id]
@@ -326,6 +385,7 @@ class ConfigGUIWebPlugin(Plugin):
             task = {
                 "id": task_id,
                 "tag": tag,
+                "schedule_type": schedule_type,
                 "time": time_str,
                 "message": message,
                 "status": {
@@ -344,70 +404,8 @@ class ConfigGUIWebPlugin(Plugin):
             
             # 添加到调度器
             try:
-                def job(task):
-                    """任务执行函数"""
-                    task_id = task["id"]
-                    tag = task["tag"]
-                    message = task["message"]
-
-                    if not self._task_locks.get(task_id):
-                        self._task_locks[task_id] = threading.Lock()
-                    
-                    if not self._task_locks[task_id].acquire(blocking=False):
-                        logger.warning(f"[ConfigGUIWeb] Task {task_id} is already running")
-                        return
-
-                    try:
-                        task["status"]["is_running"] = True
-                        task["status"]["last_execution"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        task["status"]["total_attempts"] += 1
-                        # 获所有微信好友
-                        # 首先检查登录状态
-                        if not itchat.instance.alive:
-                            try:
-                                itchat.auto_login(
-                                    hotReload=True
-                                )
-                                logger.info("[ConfigGUIWeb] Successfully re-logged into WeChat")
-                            except Exception as e:
-                                logger.error(f"[ConfigGUIWeb] Failed to re-login to WeChat: {str(e)}")
-                                return jsonify({"error": "WeChat login required. Please scan QR code to login."}), 401
-
-                # 获取指定标签的好友列表           
-                        # 获取好友列表并发送消息
-                        friends = itchat.get_friends(update=True)
-                        target_friends = self.get_friends_by_tag(tag, friends)
-                        
-                        if not target_friends:
-                            raise Exception(f"No friends found with tag: {tag}")
-                        
-                        for friend in target_friends:
-                            if not self.can_send_message():
-                                time.sleep(60)
-                                if not self.can_send_message():
-                                    raise Exception("Message sending limit reached")
-                                    
-                            result = itchat.send(message, toUserName=friend['UserName'])
-                            if result['BaseResponse']['Ret'] == 0:
-                                task["status"]["success_count"] += 1
-                                self.update_message_counter(success=True)
-                            else:
-                                raise Exception(f"Failed to send message: {result}")
-                                
-                            time.sleep(random.uniform(2, 5))
-                        
-                        task["status"]["last_success"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        task["status"]["last_error"] = None
-                        
-                    except Exception as e:
-                        task["status"]["error_count"] += 1
-                        task["status"]["last_error"] = str(e)
-                        logger.error(f"[ConfigGUIWeb] Task {task_id} failed: {e}")
-                    finally:
-                        task["status"]["is_running"] = False
-                        self._task_locks[task_id].release()
-                
-                schedule.every().day.at(time_str).do(job, task).tag(task_id)
+                if not self._schedule_job(task, replace=True):
+                    raise Exception("no next run time")
                 logger.info(f"[ConfigGUIWeb] Task {task_id} scheduled successfully")
                 return True
                 
@@ -431,16 +429,45 @@ class ConfigGUIWebPlugin(Plugin):
             logger.error(f"[ConfigGUIWeb] Failed to schedule task {task_id}: {e}\n{traceback.format_exc()}")
             return False
             
+    def _make_task_trigger(self, task):
+        """按任务的调度类型、TagManager的时区创建触发器，返回(调度类型, 触发器)，与TagManager调度同一任务时一致"""
+        schedule_type = task.get("schedule_type") or "daily"
+        schedule_type = WEB_SCHEDULE_TYPES.get(schedule_type, schedule_type)
+        tag_manager = PluginManager().instances.get("TAGMANAGER")
+        if tag_manager is not None:
+            return tag_manager.make_task_trigger(schedule_type, task["time"])
+        # 未启用TagManager时只支持每天执行
+        if schedule_type != "每天":
+            raise ValueError(f"TagManager未启用，不支持的调度类型: {schedule_type}")
+        return "daily", make_trigger("daily", task["time"])
+
+    def _schedule_job(self, task, replace=False):
+        """
+        添加任务到调度器，与TagManager使用相同的任务ID，同一任务只调度一次
+        :param replace: 为False时，已按相同的触发器调度的任务（如TagManager添加的）保持不变
+        :return: 是否已调度
+        """
+        job_id = f"tag_manager.{task['id']}"
+        try:
+            schedule_type, trigger = self._make_task_trigger(task)
+        except Exception as e:
+            logger.error(f"[ConfigGUIWeb] Invalid schedule for task {task['id']}: {e}")
+            return False
+        task["once"] = schedule_type == "once"
+        job = get_scheduler().get_job(job_id)
+        if not replace and job is not None and job.trigger.spec == trigger.spec:
+            return True
+        # 不先删除旧任务：触发器不变时沿用保存的下次执行时间，重启后错过的执行可以补执行
+        if get_scheduler().add_job(job_id, self.run_task, trigger, args=(task,)) is None:
+            logger.warning(f"[ConfigGUIWeb] Task {task['id']} has no next run time, not scheduled")
+            return False
+        return True
+
     def _save_tasks_config(self):
-        """保存任务配置到文件"""
+        """保存任务配置到tag_manager的配置文件，只替换任务列表，内容不变时不写入"""
         try:
             plugin_config_path = os.path.join("plugins", "tag_manager", "config.json")
-            if not os.path.exists(plugin_config_path):
-                logger.error(f"[ConfigGUIWeb] Tag manager config not found: {plugin_config_path}")
-                return False
-                
-            with open(plugin_config_path, 'r', encoding='utf-8') as f:
-                config = json.load(f)
+            config = read_json_cached(plugin_config_path) if os.path.exists(plugin_config_path) else {}
             
             # 更新任务列表，保留所有字段
             tasks_to_save = []
@@ -464,186 +491,69 @@ class ConfigGUIWebPlugin(Plugin):
                 tasks_to_save.append(task_copy)
             
             config["scheduled_tasks"] = tasks_to_save
-            
-            with open(plugin_config_path, 'w', encoding='utf-8') as f:
-                json.dump(config, f, indent=4, ensure_ascii=False)
-            
+            if write_json(plugin_config_path, config):
+                logger.info("[ConfigGUIWeb] Tasks configuration saved successfully")
             return True
             
         except Exception as e:
             logger.error(f"[ConfigGUIWeb] Failed to save tasks configuration: {e}")
             return False
 
-    def run_schedule(self):
-        """运行调度器"""
-        logger.info("[ConfigGUIWeb] Starting scheduler")
-        last_login_check = time.time()
-        
-        while True:
-            try:
-                # 每5分钟检查一次登录状态
-                current_time = time.time()
-                if current_time - last_login_check > 300:  # 5分钟
-                    try:
-                        if not hasattr(itchat, 'instance'):
-                            logger.warning("[ConfigGUIWeb] WeChat not initialized, skipping login check")
-                            continue
-                            
-                        if not itchat.instance or not itchat.instance.alive:
-                            logger.warning("[ConfigGUIWeb] WeChat session expired or not alive, attempting to re-login")
-                            try:
-                                itchat.auto_login(hotReload=True)
-                                logger.info("[ConfigGUIWeb] Successfully re-logged into WeChat")
-                            except Exception as e:
-                                logger.error(f"[ConfigGUIWeb] Failed to re-login to WeChat: {e}")
-                    except Exception as e:
-                        logger.error(f"[ConfigGUIWeb] Error during login check: {e}")
-                    last_login_check = current_time
-
-                # 运行待执行的任务
-                schedule.run_pending()
-                
-                # 避免CPU过度使用
-                time.sleep(1)
-                
-            except Exception as e:
-                logger.error(f"[ConfigGUIWeb] Scheduler error: {e}")
-                time.sleep(5)  # 出错后等待一段时间再继续
-
-    def get_friends_by_tag(self, tag, friends):
-        """根据标签获取好友列表"""
+    def check_login(self):
+        """检查登录状态，由调度器每5分钟执行一次"""
         try:
-            logger.info(f"[ConfigGUIWeb] Getting friends with tag: {tag}")
-            
-            # 读取标签配置
-            plugin_config_path = os.path.join("plugins", "tag_manager", "config.json")
-            if not os.path.exists(plugin_config_path):
-                logger.error(f"[ConfigGUIWeb] Tag config file not found: {plugin_config_path}")
-                return []
-                
-            with open(plugin_config_path, 'r', encoding='utf-8') as f:
-                tag_config = json.load(f)
-                
-            # 获取标签下的好友昵称列表
-            tags_friends = tag_config.get("tags_friends", {})
-            if tag not in tags_friends:
-                logger.warning(f"[ConfigGUIWeb] Tag '{tag}' not found in config")
-                return []
-                
-            tag_friend_names = tags_friends[tag]
-            if not tag_friend_names:
-                logger.warning(f"[ConfigGUIWeb] No friends found in tag '{tag}'")
-                return []
+            if not hasattr(itchat, 'instance'):
+                logger.warning("[ConfigGUIWeb] WeChat not initialized, skipping login check")
+                return
                 
-            # 将昵称映射到好友对象
-            friend_map = {f['NickName']: f for f in friends if f.get('NickName')}
-            target_friends = []
-            
-            for friend_name in tag_friend_names:
-                if friend_name in friend_map:
-                    target_friends.append(friend_map[friend_name])
-                    logger.debug(f"[ConfigGUIWeb] Found friend: {friend_name}")
-                else:
-                    logger.warning(f"[ConfigGUIWeb] Friend not found in WeChat: {friend_name}")
-                    
-            logger.info(f"[ConfigGUIWeb] Found {len(target_friends)}/{len(tag_friend_names)} friends with tag '{tag}'")
-            return target_friends
-            
+            if not itchat.instance or not itchat.instance.alive:
+                logger.warning("[ConfigGUIWeb] WeChat session expired or not alive, attempting to re-login")
+                try:
+                    itchat.auto_login(hotReload=True)
+                    logger.info("[ConfigGUIWeb] Successfully re-logged into WeChat")
+                except Exception as e:
+                    logger.error(f"[ConfigGUIWeb] Failed to re-login to WeChat: {e}")
         except Exception as e:
-            logger.error(f"[ConfigGUIWeb] Failed to get friends by tag: {e}\n{traceback.format_exc()}")
-            return []
-
-    def can_send_message(self):
-        """检查是否可以发送消息"""
-        now = datetime.now()
-        today = now.date()
-        
-        # 重置每日计数器
-        if today != self.message_counter["last_reset"]:
-            self.message_counter["daily_count"] = 0
-            self.message_counter["last_reset"] = today
-            self.message_counter["current_batch"] = 0
-        
-        # 暂时移除活跃时间限制，让消息可以在任何时间发送
-        # active_start, active_end = self.config["active_hours"]
-        # if not (active_start <= now.hour < active_end):
-        #     logger.warning(f"[ConfigGUIWeb] Outside active hours ({active_start}:00-{active_end}:00)")
-        #     return False
-        
-        # 放宽每日限制
-        if self.message_counter["daily_count"] >= 1000:  # 增加到1000条
-            logger.warning("[ConfigGUIWeb] Daily message limit reached")
-            return False
-        
-        # 放宽批次限制
-        if self.message_counter["current_batch"] >= 10:  # 改回10条
-            logger.info("[ConfigGUIWeb] Batch size limit reached, waiting for next batch")
-            return False
-        
-        # 减少消息间隔
-        if self.message_counter["last_send_time"]:
-            min_interval = 1  # 减少到1秒
-            elapsed = (now - self.message_counter["last_send_time"]).total_seconds()
-            if elapsed < min_interval:
-                logger.debug(f"[ConfigGUIWeb] Message interval too short ({elapsed:.1f}s < {min_interval}s)")
-                return False
-        
-        return True
+            logger.error(f"[ConfigGUIWeb] Error during login check: {e}")
+
+    def run_task(self, task):
+        """任务执行函数：提交到群发引擎，发送完成后更新任务状态"""
+        task_id = task["id"]
+        if task["status"]["is_running"]:
+            # 上一次群发还未发送完
+            logger.warning(f"[ConfigGUIWeb] Task {task_id} is already running")
+            return
 
-    def update_message_counter(self, success=True):
-        """更新消息计数器"""
-        now = datetime.now()
-        
-        if success:
-            self.message_counter["daily_count"] += 1
-            self.message_counter["current_batch"] += 1
-            self.message_counter["last_send_time"] = now
-            
-            # 检查是否需要开始新的批次
-            if self.message_counter["current_batch"] >= self.config["batch_size"]:
-                min_interval, max_interval = 60, 120  # 增加批次间隔到60-120秒
-                wait_time = random.uniform(min_interval, max_interval)
-                logger.info(f"[ConfigGUIWeb] Starting new batch after {wait_time:.1f}s")
-                threading.Timer(wait_time, lambda: setattr(self.message_counter, "current_batch", 0)).start()
-
-    def send_message_with_retry(self, message, friend, max_retries=3):
-        """发送消息给好友，带重试机制"""
-        friend_name = friend.get('NickName', 'Unknown')
-        retry_count = 0
-        
-        while retry_count < max_retries:
-            try:
-                # 检查是否可以发送消息
-                if not self.can_send_message():
-                    time.sleep(5)  # 等待一段时间后重试
-                    continue
-                
-                logger.info(f"[ConfigGUIWeb] Sending message to {friend_name} (attempt {retry_count + 1})")
-                
-                # 添加随机延迟
-                time.sleep(random.uniform(2, 4))
-                
-                # 尝试发送消息
-                result = itchat.send(message, toUserName=friend['UserName'])
-                
-                if result['BaseResponse']['Ret'] == 0:
-                    logger.info(f"[ConfigGUIWeb] Message sent successfully to {friend_name}")
-                    self.update_message_counter(success=True)
-                    return True
-                else:
-                    raise Exception(f"Send failed with response: {result}")
-                
-            except Exception as e:
-                retry_count += 1
-                if retry_count < max_retries:
-                    wait_time = random.uniform(5, 10)
-                    logger.warning(f"[ConfigGUIWeb] Retry {retry_count}/{max_retries} for {friend_name} in {wait_time:.1f}s: {e}")
-                    time.sleep(wait_time)
-                else:
-                    logger.error(f"[ConfigGUIWeb] Failed to send message to {friend_name} after {max_retries} attempts: {e}")
-                    return False
-        
-        return False
+        task["status"]["is_running"] = True
+        task["status"]["last_execution"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        task["status"]["total_attempts"] += 1
+        try:
+            friend_names = TagIndex().get_names(task["tag"])
+            if not friend_names:
+                raise Exception(f"No friends found with tag: {task['tag']}")
+            broadcast_id = get_broadcast_engine().submit(task["tag"], task["message"], friend_names, source=f"config_gui_web.{task_id}",
+                                                         on_done=lambda progress: self._on_task_broadcast_done(task, progress))
+            logger.info(f"[ConfigGUIWeb] Task {task_id} submitted as broadcast {broadcast_id}")
+            if task.get("once"):
+                # 只执行一次的任务（今天、明天、具体日期等），执行后从任务列表中移除
+                self.scheduled_tasks = [t for t in self.scheduled_tasks if t.get("id") != task_id]
+                self._save_tasks_config()
+        except Exception as e:
+            task["status"]["is_running"] = False
+            task["status"]["error_count"] += 1
+            task["status"]["last_error"] = str(e)
+            logger.error(f"[ConfigGUIWeb] Task {task_id} failed: {e}")
+
+    def _on_task_broadcast_done(self, task, progress):
+        """群发完成后更新任务状态"""
+        task["status"]["is_running"] = False
+        task["status"]["success_count"] += progress["sent"]
+        if progress["status"] == "done" and progress["failed"] == 0 and progress["skipped"] == 0:
+            task["status"]["last_success"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            task["status"]["last_error"] = None
+        else:
+            task["status"]["error_count"] += 1
+            task["status"]["last_error"] = f"{progress['status']}: failed {progress['failed']}, not found {progress['skipped']}"
 
     def get_tasks_status(self):
         """获取所有任务的状态"""
@@ -656,10 +566,9 @@ class ConfigGUIWebPlugin(Plugin):
                     
                     # 计算下次执行时间
                     next_run = None
-                    for job in schedule.get_jobs():
-                        if hasattr(job, 'tag') and job.tag == task['id']:
-                            next_run = job.next_run
-                            break
+                    job = get_scheduler().get_job(f"tag_manager.{task['id']}")
+                    if job is not None and job.next_run is not None:
+                        next_run = datetime.fromtimestamp(job.next_run)
                     
                     # 添加额外状态信息
                     task_copy['next_run'] = next_run.strftime("%Y-%m-%d %H:%M:%S") if next_run else None
@@ -753,9 +662,6 @@ class ConfigGUIWebPlugin(Plugin):
     def update_schedule_job(self, task_id, time_str):
         """更新调度器中的任务"""
         try:
-            # 先清除旧的任务
-            schedule.clear(task_id)
-            
             # 找到对应的任务
             task = None
             for t in self.scheduled_tasks:
@@ -764,71 +670,9 @@ class ConfigGUIWebPlugin(Plugin):
                     break
                     
             if task:
-                def job(task):
-                    """任务执行函数"""
-                    task_id = task["id"]
-                    tag = task["tag"]
-                    message = task["message"]
-
-                    if not self._task_locks.get(task_id):
-                        self._task_locks[task_id] = threading.Lock()
-                    
-                    if not self._task_locks[task_id].acquire(blocking=False):
-                        logger.warning(f"[ConfigGUIWeb] Task {task_id} is already running")
-                        return
-
-                    try:
-                        task["status"]["is_running"] = True
-                        task["status"]["last_execution"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        task["status"]["total_attempts"] += 1
-                        # 获所有微信好友
-                        # 首先检查登录状态
-                        if not itchat.instance.alive:
-                            try:
-                                itchat.auto_login(
-                                    hotReload=True
-                                )
-                                logger.info("[ConfigGUIWeb] Successfully re-logged into WeChat")
-                            except Exception as e:
-                                logger.error(f"[ConfigGUIWeb] Failed to re-login to WeChat: {str(e)}")
-                                return jsonify({"error": "WeChat login required. Please scan QR code to login."}), 401
-
-                # 获取指定标签的好友列表           
-                        # 获取好友列表并发送消息
-                        friends = itchat.get_friends(update=True)
-                        target_friends = self.get_friends_by_tag(tag, friends)
-                        
-                        if not target_friends:
-                            raise Exception(f"No friends found with tag: {tag}")
-                        
-                        for friend in target_friends:
-                            if not self.can_send_message():
-                                time.sleep(60)
-                                if not self.can_send_message():
-                                    raise Exception("Message sending limit reached")
-                                    
-                            result = itchat.send(message, toUserName=friend['UserName'])
-                            if result['BaseResponse']['Ret'] == 0:
-                                task["status"]["success_count"] += 1
-                                self.update_message_counter(success=True)
-                            else:
-                                raise Exception(f"Failed to send message: {result}")
-                                
-                            time.sleep(random.uniform(2, 5))
-                        
-                        task["status"]["last_success"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        task["status"]["last_error"] = None
-                        
-                    except Exception as e:
-                        task["status"]["error_count"] += 1
-                        task["status"]["last_error"] = str(e)
-                        logger.error(f"[ConfigGUIWeb] Task {task_id} failed: {e}")
-                    finally:
-                        task["status"]["is_running"] = False
-                        self._task_locks[task_id].release()
-                
-                # 重新调度任务
-                schedule.every().day.at(time_str).do(job, task).tag(task_id)
+                # 重新调度任务，替换原任务，触发器不变时沿用保存的下次执行时间
+                if not self._schedule_job(task, replace=True):
+                    return False
                 logger.info(f"[ConfigGUIWeb] Task {task_id} rescheduled successfully")
                 return True
                 
@@ -840,31 +684,6 @@ class ConfigGUIWebPlugin(Plugin):
             logger.error(f"[ConfigGUIWeb] Failed to update task {task_id}: {e}")
             return False
 
-    def _save_tasks_config(self):
-        """保存任务配置到文件"""
-        try:
-            # 读取现有配置
-            plugin_config_path = os.path.join("plugins", "tag_manager", "config.json")
-            if os.path.exists(plugin_config_path):
-                with open(plugin_config_path, 'r', encoding='utf-8') as f:
-                    config = json.load(f)
-            else:
-                config = {}
-
-            # 更新任务列表
-            config["scheduled_tasks"] = self.scheduled_tasks
-
-            # 保存配置
-            with open(plugin_config_path, 'w', encoding='utf-8') as f:
-                json.dump(config, f, ensure_ascii=False, indent=4)
-            
-            logger.info("[ConfigGUIWeb] Tasks configuration saved successfully")
-            return True
-            
-        except Exception as e:
-            logger.error(f"[ConfigGUIWeb] Failed to save tasks configuration: {e}")
-            return False
-
 # Flask路由和API端点
 @app.route('/')
 def index():
@@ -924,11 +743,9 @@ def get_config():
         config = default_config.copy()  # 从默认配置开始
         
         if os.path.exists(config_path):
-            with open(config_path, 'r', encoding='utf-8') as f:
-                file_config = json.load(f)
-                config.update(file_config)  # 用文件中的配置更新默认配置
+            config.update(read_json_cached(config_path))  # 用文件中的配置更新默认配置
                 
-        return jsonify(config)
+        return etag_json(config)
     except Exception as e:
         logger.error(f"[ConfigGUIWeb] Failed to get config: {e}")
         return jsonify({"error": str(e)}), 500
@@ -959,8 +776,7 @@ def update_config():
         
         # 保存配置
         try:
-            with open(config_path, 'w', encoding='utf-8') as f:
-                json.dump(existing_config, f, ensure_ascii=False, indent=4)
+            write_json(config_path, existing_config)
         except IOError as e:
             logger.error(f"[ConfigGUIWeb] Failed to write config file: {e}")
             return jsonify({"error": "Failed to save configuration"}), 500
@@ -993,23 +809,19 @@ def get_tag_config():
         # 使用绝对路径
         plugin_config_path = os.path.join(os.getcwd(), "plugins", "tag_manager", "config.json")
         if os.path.exists(plugin_config_path):
-            with open(plugin_config_path, 'r', encoding='utf-8') as f:
-                tag_config = json.load(f)
-                # 确保必要字段存在
-                for key, value in default_tag_config.items():
-                    if key not in tag_config:
-                        tag_config[key] = value
-                # 保存更新后的配置
-                with open(plugin_config_path, 'w', encoding='utf-8') as f:
-                    json.dump(tag_config, f, ensure_ascii=False, indent=4)
+            tag_config = read_json_cached(plugin_config_path)
+            # 确保必要字段存在，缺少字段时才保存
+            missing = {key: value for key, value in default_tag_config.items() if key not in tag_config}
+            if missing:
+                tag_config.update(missing)
+                write_json(plugin_config_path, tag_config)
         else:
             tag_config = default_tag_config
             # 创建目录和文件
             os.makedirs(os.path.dirname(plugin_config_path), exist_ok=True)
-            with open(plugin_config_path, 'w', encoding='utf-8') as f:
-                json.dump(tag_config, f, ensure_ascii=False, indent=4)
+            write_json(plugin_config_path, tag_config)
                 
-        return jsonify(tag_config)
+        return etag_json(tag_config)
     except Exception as e:
         logger.error(f"[ConfigGUIWeb] Failed to get tag config: {e}")
         return jsonify({"error": str(e)}), 500
@@ -1024,8 +836,8 @@ def save_tag_config():
         # 保存配置
         try:
             config_path = os.path.join("plugins", "tag_manager", "config.json")
-            with open(config_path, 'w', encoding='utf-8') as f:
-                json.dump(config_data, f, ensure_ascii=False, indent=4)
+            write_json(config_path, config_data)
+            TagIndex().invalidate()
                 
             return jsonify({"message": "Configuration saved successfully"})
             
@@ -1074,21 +886,20 @@ def get_tasks():
             return jsonify({"error": "Plugin not initialized"}), 500
             
         tasks = []
+        saved_schedule_types = None
         for task in plugin.scheduled_tasks:
             # 从任务对象中获取调度类型，如果不存在则从配置文件中获取
             schedule_type = task.get("schedule_type")
             if not schedule_type:
-                # 从配置文件中读取任务信息
-                try:
-                    with open(os.path.join("plugins", "tag_manager", "config.json"), 'r', encoding='utf-8') as f:
-                        config = json.load(f)
-                        for saved_task in config.get("scheduled_tasks", []):
-                            if saved_task.get("id") == task["id"]:
-                                schedule_type = saved_task.get("schedule_type", "daily")
-                                break
-                except Exception as e:
-                    logger.error(f"[ConfigGUIWeb] Failed to read schedule_type from config: {e}")
-                    schedule_type = "daily"  # 默认值
+                # 从配置文件中读取任务信息，只读取一次
+                if saved_schedule_types is None:
+                    try:
+                        config = read_json_cached(os.path.join("plugins", "tag_manager", "config.json"))
+                        saved_schedule_types = {t.get("id"): t.get("schedule_type", "daily") for t in config.get("scheduled_tasks", [])}
+                    except Exception as e:
+                        logger.error(f"[ConfigGUIWeb] Failed to read schedule_type from config: {e}")
+                        saved_schedule_types = {}
+                schedule_type = saved_schedule_types.get(task["id"], "daily")
             
             task_info = {
                 "id": task["id"],
@@ -1100,7 +911,7 @@ def get_tasks():
             }
             tasks.append(task_info)
             
-        return jsonify(tasks)
+        return etag_json(tasks)
     except Exception as e:
         logger.error(f"[ConfigGUIWeb] Failed to get tasks: {e}")
         return jsonify({"error": str(e)}), 500
@@ -1145,7 +956,7 @@ def add_task():
         task_id = f"task_{int(time.time())}"
         
         # 调度任务
-        if plugin_instance.schedule_task(task_id, tag, time_str, message):
+        if plugin_instance.schedule_task(task_id, tag, time_str, message, schedule_type):
             # 保存任务配置
             try:
                 plugin_config_path = os.path.join("plugins", "tag_manager", "config.json")
@@ -1171,8 +982,7 @@ def add_task():
                     })
                 
                 # 保存更新后的配置
-                with open(plugin_config_path, 'w', encoding='utf-8') as f:
-                    json.dump(config, f, ensure_ascii=False, indent=4)
+                write_json(plugin_config_path, config)
                 
                 return jsonify({"message": "任务添加成功", "task_id": task_id}), 201
             except Exception as e:
@@ -1239,8 +1049,7 @@ def update_task_api(task_id):
                     break
             
             # 保存更新后的配置
-            with open(plugin_config_path, 'w', encoding='utf-8') as f:
-                json.dump(config, f, ensure_ascii=False, indent=4)
+            write_json(plugin_config_path, config)
                 
             # 更新调度器中的任务
             plugin_instance.update_schedule_job(task_id, time_str)
@@ -1264,7 +1073,7 @@ def delete_task(task_id):
             return jsonify({"error": "插件实例未初始化"}), 500
             
         # 从调度器中移除任务
-        schedule.clear(task_id)
+        get_scheduler().remove_job(f"tag_manager.{task_id}")
         
         # 从内存中的任务列表移除任务
         plugin_instance.scheduled_tasks = [t for t in plugin_instance.scheduled_tasks if t.get("id") != task_id]
@@ -1280,8 +1089,7 @@ def delete_task(task_id):
                 config["scheduled_tasks"] = [t for t in config["scheduled_tasks"] if t.get("id") != task_id]
                 
                 # 保存更新后的配置
-                with open(plugin_config_path, 'w', encoding='utf-8') as f:
-                    json.dump(config, f, ensure_ascii=False, indent=4)
+                write_json(plugin_config_path, config)
             
             return jsonify({"message": "任务删除成功"}), 200
             
@@ -1295,7 +1103,7 @@ def delete_task(task_id):
 
 @app.route('/api/broadcast', methods=['POST'])
 def send_broadcast():
-    """发送群发消息"""
+    """提交群发消息，由群发引擎在后台按发送上限匀速发送，返回群发ID和预计完成时间"""
     try:
         data = request.get_json()
         tag = data.get('tag')
@@ -1304,78 +1112,49 @@ def send_broadcast():
         if not tag or not message:
             return jsonify({"error": "Missing tag or message"}), 400
             
-        # 获取标签下的好友
-        plugin_config_path = os.path.join("plugins", "tag_manager", "config.json")
-        with open(plugin_config_path, 'r', encoding='utf-8') as f:
-            tag_config = json.load(f)
-            tags_friends = tag_config.get("tags_friends", {})
-        
-        if tag not in tags_friends:
+        # 获取标签下的好友（缓存的标签索引，配置文件变化时重新加载）
+        tag_index = TagIndex()
+        friends = tag_index.get_names(tag)
+        if friends is None:
             return jsonify({"error": f"Tag '{tag}' does not exist"}), 404
             
-        friends = tags_friends[tag]
         if not friends:
             return jsonify({"error": f"No friends found in tag '{tag}'"}), 404
         
-        # 获所有微信好友
-        # 首先检查登录状态
-        if not itchat.instance.alive:
-            try:
-                itchat.auto_login(
-                    hotReload=True
-                )
-                logger.info("[ConfigGUIWeb] Successfully re-logged into WeChat")
-            except Exception as e:
-                logger.error(f"[ConfigGUIWeb] Failed to re-login to WeChat: {str(e)}")
-                return jsonify({"error": "WeChat login required. Please scan QR code to login."}), 401
-
-        try:
-            wx_friends = itchat.get_friends(update=True)
-            if not wx_friends:
-                return jsonify({"error": "Failed to get WeChat friends list"}), 500
-        except Exception as e:
-            logger.error(f"[ConfigGUIWeb] Error getting friends list: {str(e)}")
-            return jsonify({"error": f"Error getting friends list: {str(e)}"}), 500
-        friend_map = {}
-        # for friend in wx_friends:
-        #     if friend.get('NickName'):
-        #         print(f"mjh_test friend['NickName'] {friend['NickName']};  friend {friend}")
-        #         friend_map[friend['NickName']] = friend
-        friend_map = {f['NickName']: f for f in wx_friends if f.get('NickName')}
-        
-        success_count = 0
-        fail_count = 0
-        failed_friends = []
-        
-        for friend_name in friends:
-            try:
-                if friend_name in friend_map:
-                    friend = friend_map[friend_name]
-                    user_id = friend['UserName']
-                    time.sleep(random.uniform(1, 2))
-                    itchat.send(msg=message, toUserName=user_id)
-                    success_count += 1
-                    logger.info(f"[ConfigGUIWeb] Sent message to {friend_name}-{user_id}")
-                else:
-                    fail_count += 1
-                    failed_friends.append(friend_name)
-                    logger.warning(f"[ConfigGUIWeb] Friend not found: {friend_name}")
-            except Exception as e:
-                fail_count += 1
-                failed_friends.append(friend_name)
-                logger.error(f"[ConfigGUIWeb] Failed to send message to {friend_name}: {e}")
-        
+        # 未登录时引擎暂停发送，登录后继续
+        engine = get_broadcast_engine()
+        broadcast_id = engine.submit(tag, message, friends, source="config_gui_web")
+        # 当前联系人中找不到的好友，发送时会再查找一次
+        _, not_found = tag_index.get_user_names(tag)
         return jsonify({
-            "message": "Broadcast completed",
-            "success_count": success_count,
-            "fail_count": fail_count,
-            "failed_friends": failed_friends
-        })
+            "message": "Broadcast queued",
+            "job_id": broadcast_id,
+            "status_url": f"/api/jobs/{broadcast_id}",
+            "broadcast_id": broadcast_id,
+            "progress": engine.get_progress(broadcast_id),
+            "not_found": not_found
+        }), 202
         
     except Exception as e:
         logger.error(f"[ConfigGUIWeb] Broadcast failed: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/broadcast/<broadcast_id>', methods=['GET'])
+def get_broadcast(broadcast_id):
+    """群发进度和每个接收人的发送状态"""
+    engine = get_broadcast_engine()
+    progress = engine.get_progress(broadcast_id)
+    if progress is None:
+        return jsonify({"error": f"Broadcast '{broadcast_id}' not found"}), 404
+    return jsonify({"progress": progress, "deliveries": engine.get_deliveries(broadcast_id)})
+
+@app.route('/api/broadcast/<broadcast_id>', methods=['DELETE'])
+def cancel_broadcast(broadcast_id):
+    """取消未发送完的群发"""
+    if not get_broadcast_engine().cancel(broadcast_id):
+        return jsonify({"error": f"Broadcast '{broadcast_id}' is not running"}), 404
+    return jsonify({"message": "Broadcast cancelled"})
+
 @app.route('/api/export-config', methods=['GET'])
 def export_config():
     """导出配置"""
@@ -1429,37 +1208,59 @@ def import_config():
         if not main_config or not tag_config:
             return jsonify({"error": "Missing required config sections"}), 400
         
-        # 备份现有配置
+        # 备份、写入配置在后台执行，立即返回任务ID
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        
-        if os.path.exists("config.json"):
-            config_dir = "configs"
-            if not os.path.exists(config_dir):
-                os.makedirs(config_dir)
-            shutil.copy2("config.json", os.path.join(config_dir, f"config_backup_{timestamp}.json"))
-            
-        plugin_config_path = os.path.join("plugins", "tag_manager", "config.json")
-        if os.path.exists(plugin_config_path):
-            backup_path = os.path.join("plugins", "tag_manager", f"config_backup_{timestamp}.json")
-            shutil.copy2(plugin_config_path, backup_path)
-        
-        # 保存新配置
-        with open("config.json", 'w', encoding='utf-8') as f:
-            json.dump(main_config, f, ensure_ascii=False, indent=4)
-            
-        os.makedirs(os.path.dirname(plugin_config_path), exist_ok=True)
-        with open(plugin_config_path, 'w', encoding='utf-8') as f:
-            json.dump(tag_config, f, ensure_ascii=False, indent=4)
-            
+        job = submit_job("import", _import_config, main_config, tag_config, timestamp)
         return jsonify({
-            "message": "Configuration imported successfully",
+            "message": "Configuration import queued",
+            "job_id": job["id"],
+            "status_url": f"/api/jobs/{job['id']}",
             "backup_timestamp": timestamp
-        })
+        }), 202
         
     except Exception as e:
         logger.error(f"[ConfigGUIWeb] Import config failed: {e}")
         return jsonify({"error": str(e)}), 500
 
+def _import_config(main_config, tag_config, timestamp):
+    """备份现有配置后写入导入的配置"""
+    if os.path.exists("config.json"):
+        config_dir = "configs"
+        if not os.path.exists(config_dir):
+            os.makedirs(config_dir)
+        shutil.copy2("config.json", os.path.join(config_dir, f"config_backup_{timestamp}.json"))
+        
+    plugin_config_path = os.path.join("plugins", "tag_manager", "config.json")
+    if os.path.exists(plugin_config_path):
+        backup_path = os.path.join("plugins", "tag_manager", f"config_backup_{timestamp}.json")
+        shutil.copy2(plugin_config_path, backup_path)
+    
+    # 保存新配置
+    write_json("config.json", main_config)
+    os.makedirs(os.path.dirname(plugin_config_path), exist_ok=True)
+    write_json(plugin_config_path, tag_config)
+    TagIndex().invalidate()
+    logger.info(f"[ConfigGUIWeb] Configuration imported, backup timestamp: {timestamp}")
+    return {"backup_timestamp": timestamp}
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """后台任务状态，群发任务返回发送进度"""
+    job = get_job_status(job_id)
+    if job is not None:
+        return jsonify(job)
+    progress = get_broadcast_engine().get_progress(job_id)
+    if progress is None:
+        return jsonify({"error": f"Job '{job_id}' not found"}), 404
+    return jsonify({
+        "id": job_id,
+        "type": "broadcast",
+        "status": progress["status"],
+        "created_at": progress["created_at"],
+        "finished_at": progress["finished_at"],
+        "progress": progress
+    })
+
 @app.route('/api/reset-config', methods=['POST'])
 def reset_config():
     """获取默认配置值，但不保存"""
@@ -1552,8 +1353,7 @@ def save_config():
         existing_config.update(main_config)
         
         # 保存配置
-        with open(config_path, 'w', encoding='utf-8') as f:
-            json.dump(existing_config, f, ensure_ascii=False, indent=4)
+        write_json(config_path, existing_config)
             
         return jsonify({"message": "Configuration saved successfully"})
     except Exception as e:
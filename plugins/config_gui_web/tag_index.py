@@ -0,0 +1,82 @@
+# encoding:utf-8
+
+import json
+import os
+import threading
+
+from channel.wechat.contact_index import ContactIndex
+from common.log import logger
+from common.singleton import singleton
+
+TAG_CONFIG_PATH = os.path.join("plugins", "tag_manager", "config.json")
+
+
+@singleton
+class TagIndex(object):
+    """
+    标签索引：标签 -> 好友昵称、UserName
+    标签配置读取后缓存在内存，配置文件的修改时间、大小变化（包括其他插件写入）或调用invalidate后重新加载；
+    UserName通过联系人索引解析，联系人更新后（ContactIndex.version变化）再次查询时重新解析
+    """
+
+    def __init__(self, config_path=TAG_CONFIG_PATH):
+        self.config_path = config_path
+        self.lock = threading.Lock()
+        self.signature = None  # 配置文件的(修改时间, 大小)
+        self.tags = {}  # 标签 -> 好友昵称列表
+        self.resolved = {}  # 标签 -> (联系人索引版本, {UserName: 昵称}, 未找到的昵称列表)
+
+    def invalidate(self):
+        """写入标签配置后调用，下次查询时重新加载"""
+        with self.lock:
+            self.signature = None
+
+    def get_names(self, tag):
+        """标签下的好友昵称列表，标签不存在时返回None"""
+        with self.lock:
+            self._load()
+            names = self.tags.get(tag)
+            return list(names) if names is not None else None
+
+    def get_user_names(self, tag):
+        """
+        标签下好友的UserName
+        :return: ({UserName: 昵称}, 未找到的昵称列表)，标签不存在时返回({}, [])
+        """
+        contact_index = ContactIndex()
+        with self.lock:
+            self._load()
+            version = contact_index.version
+            cached = self.resolved.get(tag)
+            if cached is not None and cached[0] == version:
+                return dict(cached[1]), list(cached[2])
+            user_names, missing = {}, []
+            for name in self.tags.get(tag) or []:
+                user_name = contact_index.get_friend(name)
+                if user_name:
+                    user_names[user_name] = name
+                else:
+                    missing.append(name)
+            self.resolved[tag] = (version, user_names, missing)
+            return dict(user_names), list(missing)
+
+    def _load(self):
+        try:
+            stat = os.stat(self.config_path)
+        except OSError:
+            self.signature, self.tags, self.resolved = None, {}, {}
+            return
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self.signature:
+            return
+        try:
+            with open(self.config_path, "r", encoding="utf-8") as f:
+                tags = json.load(f).get("tags_friends", {})
+        except Exception as e:
+            # 写入过程中读取可能失败，保留上次的数据，下次查询时重试
+            logger.warning(f"[ConfigGUIWeb] Failed to load tag config: {e}")
+            return
+        self.tags = {tag: list(dict.fromkeys(names or [])) for tag, names in tags.items()}
+        self.resolved = {}
+        self.signature = signature
+        logger.debug(f"[ConfigGUIWeb] Tag index loaded, tags={len(self.tags)}")
@@ -9,10 +9,13 @@ from typing import Tuple
 
 import bridge.bridge
 import plugins
+from bot.session_manager import SessionRegistry
 from bridge.bridge import Bridge
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common import const
+from common.retry_policy import get_retry_stats
+from common.usage_ledger import UsageLedger
 from config import conf, load_config, global_config
 from plugins import *
 
@@ -65,6 +68,10 @@ COMMANDS = {
         "alias": ["reset", "重置会话"],
         "desc": "重置会话",
     },
+    "usage": {
+        "alias": ["usage", "用量"],
+        "desc": "查询今日用量",
+    },
 }
 
 ADMIN_COMMANDS = {
@@ -84,6 +91,14 @@ ADMIN_COMMANDS = {
         "alias": ["resetall", "重置所有会话"],
         "desc": "重置所有会话",
     },
+    "sessions": {
+        "alias": ["sessions", "会话统计"],
+        "desc": "查看会话内存占用",
+    },
+    "providers": {
+        "alias": ["providers", "模型状态"],
+        "desc": "查看各模型服务的延迟和错误统计",
+    },
     "scanp": {
         "alias": ["scanp", "扫描插件"],
         "desc": "扫描插件目录是否有新插件",
@@ -321,6 +336,8 @@ class Godcmd(Plugin):
                         ok, result = True, "会话已重置"
                     else:
                         ok, result = False, "当前对话机器人不支持重置会话"
+                elif cmd == "usage":
+                    ok, result = True, self.get_usage_text(e_context["context"])
                 logger.debug("[Godcmd] command: %s by %s" % (cmd, user))
             elif any(cmd in info["alias"] for info in ADMIN_COMMANDS.values()):
                 if isadmin:
@@ -345,6 +362,23 @@ class Godcmd(Plugin):
                                 ok, result = True, "重置所有会话成功"
                             else:
                                 ok, result = False, "当前对话机器人不支持重置会话"
+                        elif cmd == "sessions":
+                            stats = SessionRegistry().stats()
+                            ok = True
+                            result = f"内存会话数: {stats['sessions']}\n估算token数: {stats['tokens']}\n磁盘会话数: {stats['spilled']}\n"
+                            result += f"淘汰次数: {stats['evictions']}\n加载次数: {stats['reloads']}\n"
+                            result += f"会话数上限: {stats['max_count'] or '不限'}\ntoken上限: {stats['max_tokens'] or '不限'}"
+                        elif cmd == "providers":
+                            ok = True
+                            result = "模型服务统计："
+                            for provider, stats in Bridge().get_provider_stats().items():
+                                result += f"\n{provider}: 请求{stats['requests']}次, 错误{stats['errors']}次, 超时{stats['timeouts']}次, "
+                                result += f"p50={stats['p50']}s, p95={stats['p95']}s, {'正常' if stats['healthy'] else '冷却中'}"
+                            for provider, stats in get_retry_stats().items():
+                                result += f"\n{provider}重试: 尝试{stats['attempts']}次, 失败{stats['failures']}次, 重试{stats['retries']}次, "
+                                result += f"放弃{stats['gave_up']}次, p99={stats['p99']}s, 超时={stats['timeout']}s"
+                            flight = Bridge().get_single_flight_stats()
+                            result += f"\n合并请求: 发起{flight['leaders']}次, 共享回复{flight['shared']}次, 进行中{flight['inflight']}个"
                         elif cmd == "debug":
                             if logger.getEffectiveLevel() == logging.DEBUG:  # 判断当前日志模式是否DEBUG
                                 logger.setLevel(logging.INFO)
@@ -439,6 +473,23 @@ class Godcmd(Plugin):
         elif not self.isrunning:
             e_context.action = EventAction.BREAK_PASS
 
+    def get_usage_text(self, context) -> str:
+        names = {"session": "当前会话", "user": "你", "group": "本群"}
+        usage = UsageLedger().get_context_usage(context)
+        result = "今日用量："
+        for dim, name in names.items():
+            if dim not in usage:
+                continue
+            tokens, requests = usage[dim]
+            result += f"\n{name}: {tokens} tokens, {requests} 次提问"
+            token_budget = conf().get("daily_token_budget_" + dim, 0)
+            if token_budget:
+                result += f"，token额度 {token_budget}"
+            request_budget = conf().get("daily_request_budget_" + dim, 0)
+            if request_budget:
+                result += f"，提问额度 {request_budget}"
+        return result
+
     def authenticate(self, userid, args, isadmin, isgroup) -> Tuple[bool, str]:
         if isgroup:
             return False, "请勿在群聊中认证"
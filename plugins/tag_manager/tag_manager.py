@@ -8,13 +8,14 @@ from common.expired_dict import ExpiredDict
 from common.time_check import time_checker
 import json
 import os
-import schedule
 import time
 import threading
 from datetime import datetime, timedelta
 import inspect
 # import itchat  # 或其他微信API库
 from lib import itchat
+from common.broadcast import get_broadcast_engine
+from common.scheduler import get_scheduler, make_trigger
 from lib.itchat.content import *
 import traceback  # 在文件开头添加这个导入
 from plugins import register, Plugin  # 确保正确导入装饰器和基类
@@ -55,7 +56,8 @@ class TagManager(Plugin):
                 "$标签管理": self._handle_label_management,
                 "$定时群发": self._handle_schedule_send,
                 "$查看任务": self._handle_list_tasks,
-                "$删除任务": self._handle_delete_task
+                "$删除任务": self._handle_delete_task,
+                "$群发进度": self._handle_broadcast_progress
             }
             
             # 初始化消息记录字典，设置过期时间为3600秒（1小时）
@@ -65,10 +67,6 @@ class TagManager(Plugin):
             # 获取时区
             self.timezone = pytz.timezone(self.config.get("schedule_settings", {}).get("default_timezone", "Asia/Shanghai"))
             
-            # 启动定时任务线程
-            self.schedule_thread = threading.Thread(target=self._run_schedule, daemon=True)
-            self.schedule_thread.start()
-            
             # 恢复已保存的定时任务
             self._restore_tasks()
             
@@ -79,12 +77,11 @@ class TagManager(Plugin):
             logger.error(traceback.format_exc())
             raise e
 
-    def _run_schedule(self):
-        """运行定时任务调度器"""
-        while True:
-            schedule.run_pending()
-            time.sleep(1)
-            
+    @staticmethod
+    def _job_id(task_id):
+        """调度器中的任务ID，ConfigGUIWeb调度同一任务时使用相同的ID，避免重复执行"""
+        return f"tag_manager.{task_id}"
+
     def _restore_tasks(self):
         """恢复已保存的定时任务"""
         if "scheduled_tasks" in self.config:
@@ -112,34 +109,28 @@ class TagManager(Plugin):
                 except Exception as e:
                     logger.error(f"[TagManager] 定时任务 {task_id} 执行失败: {e}")
 
-            # 根据不同的调度类型设置任务
-            if schedule_type == "daily":
-                schedule.every().day.at(time_str).do(job).tag(task_id)
-            elif schedule_type == "weekly":
-                weekday, time = time_str.split()
-                getattr(schedule.every(), weekday.lower()).at(time).do(job).tag(task_id)
-            elif schedule_type == "workday":
-                schedule.every().day.at(time_str).do(job).tag(task_id)
-            elif schedule_type == "once":
-                schedule.every().day.at(next_run.strftime("%H:%M")).do(job).tag(task_id)
-            elif schedule_type == "cron":
-                # 对于 cron 表达式，我们需要自己计算下一次运行时间
-                def cron_job():
-                    job()
-                    # 计算下一次运行时间
-                    cron = croniter.croniter(time_str, datetime.now(self.timezone))
-                    next_run = cron.get_next(datetime)
-                    return schedule.CancelJob
-                
-                # 设置初始运行时间
-                schedule.every().day.at(next_run.strftime("%H:%M")).do(cron_job).tag(task_id)
-            
+            # 根据不同的调度类型设置触发器，由共用调度器执行
+            trigger = self._make_trigger(schedule_type, next_run, time_str)
+            if get_scheduler().add_job(self._job_id(task_id), job, trigger) is None:
+                logger.warning(f"[TagManager] 定时任务 {task_id} 的执行时间已过，不再调度")
+                return
+
             logger.info(f"[TagManager] 已添加定时任务: {task_id}, 标签:{tag}, 类型:{schedule_type}, 时间:{time_str}")
             
         except Exception as e:
             logger.error(f"[TagManager] 添加定时任务失败: {e}")
             raise e
 
+    def make_task_trigger(self, schedule_type, time_str):
+        """按任务的调度类型、时区创建触发器，返回(调度类型, 触发器)，ConfigGUIWeb调度同一任务时使用"""
+        schedule_type, next_run = self._parse_schedule_time(schedule_type, time_str)
+        return schedule_type, self._make_trigger(schedule_type, next_run, time_str)
+
+    def _make_trigger(self, schedule_type, next_run, time_str):
+        if schedule_type == "once":
+            return make_trigger("once", run_at=next_run)
+        return make_trigger(schedule_type, time_str, self.timezone)
+
     def _parse_schedule_time(self, schedule_type, time_str):
         """解析定时任务时间
         支持的格式：
@@ -160,7 +151,7 @@ class TagManager(Plugin):
                 if len(time_parts) != 2:
                     raise ValueError("时间格式错误，应为 HH:MM")
                 hour, minute = map(int, time_parts)
-                next_run = now.replace(hour=hour, minute=minute)
+                next_run = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
                 return "once", next_run
             
             elif schedule_type == "明天":
@@ -168,7 +159,7 @@ class TagManager(Plugin):
                 if len(time_parts) != 2:
                     raise ValueError("时间格式错误，应为 HH:MM")
                 hour, minute = map(int, time_parts)
-                next_run = (now + timedelta(days=1)).replace(hour=hour, minute=minute)
+                next_run = (now + timedelta(days=1)).replace(hour=hour, minute=minute, second=0, microsecond=0)
                 return "once", next_run
             
             elif schedule_type == "后天":
@@ -176,7 +167,7 @@ class TagManager(Plugin):
                 if len(time_parts) != 2:
                     raise ValueError("时间格式错误，应为 HH:MM")
                 hour, minute = map(int, time_parts)
-                next_run = (now + timedelta(days=2)).replace(hour=hour, minute=minute)
+                next_run = (now + timedelta(days=2)).replace(hour=hour, minute=minute, second=0, microsecond=0)
                 return "once", next_run
             
             elif schedule_type == "每天":
@@ -187,7 +178,7 @@ class TagManager(Plugin):
                     hour, minute = map(int, time_parts)
                     if not (0 <= hour <= 23 and 0 <= minute <= 59):
                         raise ValueError("无效的时间值")
-                    next_run = now.replace(hour=hour, minute=minute)
+                    next_run = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
                     if next_run <= now:
                         next_run += timedelta(days=1)
                     return "daily", next_run
@@ -199,7 +190,7 @@ class TagManager(Plugin):
                 if len(time_parts) != 2:
                     raise ValueError("时间格式错误，应为 HH:MM")
                 hour, minute = map(int, time_parts)
-                next_run = now.replace(hour=hour, minute=minute)
+                next_run = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
                 while next_run.weekday() > 4 or next_run <= now:  # 0-4 表示周一至周五
                     next_run += timedelta(days=1)
                 return "workday", next_run
@@ -220,7 +211,7 @@ class TagManager(Plugin):
                 days_ahead = weekdays[weekday] - current_weekday
                 if days_ahead <= 0:
                     days_ahead += 7
-                next_run = now.replace(hour=hour, minute=minute) + timedelta(days=days_ahead)
+                next_run = now.replace(hour=hour, minute=minute, second=0, microsecond=0) + timedelta(days=days_ahead)
                 return "weekly", next_run
             
             elif schedule_type == "具体日期":
@@ -489,7 +480,7 @@ class TagManager(Plugin):
             
             try:
                 # 从调度器中删除任务
-                schedule.clear(task_id)
+                get_scheduler().remove_job(self._job_id(task_id))
                 logger.info(f"[TagManager] 已从调度器中删除任务: {task_id}")
             except Exception as e:
                 logger.error(f"[TagManager] 从调度器删除任务失败: {e}")
@@ -531,64 +522,62 @@ class TagManager(Plugin):
             return Reply(ReplyType.ERROR, error_msg)
 
     def _mass_send_message(self, tag: str, message: str) -> str:
-        """群发消息到指定标签的好友"""
+        """群发消息到指定标签的好友，提交到群发引擎后立即返回，由引擎按发送上限匀速发送"""
         try:
-            # 获取该标签的所有好友
-            members = self._get_tagged_friends(tag)
-
-            success_count = 0
-            fail_count = 0
-            
-            # 遍历发送私信
-            for friend in members:
-                try:
-                    user_id = friend['UserName']  # 微信用户ID
-                    itchat.send_msg(message, toUserName=user_id)
-                    success_count += 1
-                    logger.info(f"[TagManager] 已向好友 {friend.get('NickName', user_id)} 发送消息")
-                except Exception as e:
-                    fail_count += 1
-                    error_stack = traceback.format_exc()  # 获取完整的错误栈信息
-                    logger.error(f"[TagManager] 获取标签好友失败: {e}\n错误栈:\n{error_stack}")
-                    logger.error(f"[TagManager] 向好友发送消息失败: {e}")
+            nicknames = self.config.get("tags_friends", {}).get(tag)
+            if not nicknames:
+                return f"标签 {tag} 下没有好友"
 
-            result = f"群发完成 - 成功: {success_count}, 失败: {fail_count}"
+            engine = get_broadcast_engine()
+            broadcast_id = engine.submit(tag, message, nicknames, source="tag_manager")
+            progress = engine.get_progress(broadcast_id)
+            result = (f"群发已提交 - ID: {broadcast_id}, 接收人: {progress['total']}, "
+                      f"预计 {self._format_eta(progress['eta_seconds'])} 后完成, 可使用「$群发进度 {broadcast_id}」查看进度")
             logger.info(f"[TagManager] {result}")
-            return result    
-            # TODO: 实现实际的消息发送逻辑
-            # 这里需要根据您的微信API实现具体的发送逻辑
-            
-            # return f"消息已发送给标签 '{tag}' 下的 {len(members)} 个成员"
-            
+            return result
+
         except Exception as e:
             logger.error(f"[TagManager] 群发消息失败: {e}")
             return f"群发失败: {str(e)}"
 
-    def _get_tagged_friends(self, tag_name: str):
-        """
-        获取指定标签的所有好友
-        返回 [ "userName"]
-        
-        """
+    def _handle_broadcast_progress(self, content: str) -> Reply:
+        """处理群发进度命令，不指定ID时显示最近的群发"""
         try:
+            parts = content.split(" ", 1)
+            engine = get_broadcast_engine()
+            if len(parts) == 2 and parts[1].strip():
+                progress = engine.get_progress(parts[1].strip())
+                if progress is None:
+                    return Reply(ReplyType.TEXT, f"❌ 未找到群发 {parts[1].strip()}")
+                progress_list = [progress]
+            else:
+                progress_list = engine.list_broadcasts(limit=5)
+                if not progress_list:
+                    return Reply(ReplyType.TEXT, "暂无群发记录")
 
-            friends = itchat.get_friends()    
+            lines = []
+            for progress in progress_list:
+                lines.append(
+                    f"ID: {progress['id']}\n"
+                    f"标签: {progress['tag']}\n"
+                    f"状态: {progress['status']}\n"
+                    f"成功: {progress['sent']}, 失败: {progress['failed']}, 未找到: {progress['skipped']}, "
+                    f"待发送: {progress['pending']} / 共{progress['total']}\n"
+                    f"预计剩余: {self._format_eta(progress['eta_seconds'])}"
+                )
+            return Reply(ReplyType.TEXT, "\n------------------------\n".join(lines))
 
-            logger.debug(f"[TagManager] _get_tagged_friends  friends size{friends}")
-            
-            tagged_friends = self.config["tags_friends"][tag_name]
-            result = []
-            for friend in friends:
-                if friend['NickName'] in tagged_friends:
-                    result.append(friend)
-                    
-            logger.info(f"[TagManager] 标签 {tag_name} 下有 {len(tagged_friends)} ; result {result} ;个好友")
-            return result
-            
         except Exception as e:
-            error_stack = traceback.format_exc()  # 获取完整的错误栈信息
-            logger.error(f"[TagManager] 获取标签好友失败: {e}\n错误栈:\n{error_stack}")
-            return []
+            logger.error(f"[TagManager] 查询群发进度失败: {e}")
+            return Reply(ReplyType.ERROR, f"查询群发进度失败: {str(e)}")
+
+    @staticmethod
+    def _format_eta(seconds):
+        if seconds < 60:
+            return f"{int(seconds)}秒"
+        if seconds < 3600:
+            return f"{int(seconds // 60)}分钟"
+        return f"{int(seconds // 3600)}小时{int(seconds % 3600 // 60)}分钟"
 
     def _get_user_tags(self, user_name: str):
         """获取用户的标签列表"""
@@ -0,0 +1,230 @@
+# encoding:utf-8
+
+import os
+import sqlite3
+import threading
+from lib import itchat
+from common.singleton import singleton
+from plugins.timetask.Tool import ExcelTool
+from plugins.timetask.Tool import TimeTaskModel
+
+#任务字段，顺序与 TimeTaskModel.get_formatItem 一致
+TASK_COLUMNS = ("taskId", "enable", "timeStr", "circleTimeStr", "eventStr",
+                "fromUser", "fromUser_id", "toUser", "toUser_id",
+                "other_user_nickname", "other_user_id", "isGroup", "originMsg", "is_today_consumed")
+
+
+@singleton
+class TaskStore(object):
+    """
+    定时任务的sqlite存储，替代每次操作都整体读写timeTask.xlsx
+    首次启动时导入已有的timeTask.xlsx，之后以数据库为准，Excel仅作为导入、导出的格式
+    """
+    __db_name = "timeTask.db"
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.db_path = ExcelTool().get_file_path(self.__db_name)
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self._init_db()
+        #首次启动，导入Excel中的任务
+        if self.get_meta("excel_imported") is None:
+            self.import_excel()
+
+    def _init_db(self):
+        columns = ", ".join(f"{column} TEXT" for column in TASK_COLUMNS[1:])
+        with self.lock, self.db:
+            self.db.execute(f"CREATE TABLE IF NOT EXISTS tasks (taskId TEXT PRIMARY KEY, {columns}, next_run REAL)")
+            self.db.execute(f"CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY AUTOINCREMENT, taskId TEXT, {columns})")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            #按可用状态、创建人、目标用户查询待执行任务，结果按下次执行时间排序
+            self.db.execute("DROP INDEX IF EXISTS idx_tasks_next_run")
+            self.db.execute("DROP INDEX IF EXISTS idx_tasks_other_user")
+            self.db.execute("CREATE INDEX IF NOT EXISTS idx_tasks_enable_next_run ON tasks (enable, next_run)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS idx_tasks_owner ON tasks (fromUser_id, enable, next_run)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS idx_tasks_target ON tasks (other_user_id, enable, next_run)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS idx_history_task ON history (taskId)")
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    #读取任务列表，返回元组列表（按添加顺序）
+    def get_tasks(self):
+        with self.lock:
+            return self.db.execute(f"SELECT {', '.join(TASK_COLUMNS)} FROM tasks ORDER BY rowid").fetchall()
+
+    #读取历史任务列表
+    def get_history_tasks(self):
+        with self.lock:
+            return self.db.execute(f"SELECT {', '.join(TASK_COLUMNS)} FROM history ORDER BY id").fetchall()
+
+    #查询单个任务
+    def get_task(self, taskId):
+        with self.lock:
+            return self.db.execute(f"SELECT {', '.join(TASK_COLUMNS)} FROM tasks WHERE taskId = ?", (taskId,)).fetchone()
+
+    #分页查询待执行的任务（可用且有下次执行时间），按下次执行时间排序
+    #owner：创建人ID，target：目标用户ID，同时传入时返回两者之一匹配的任务；都不传时查询全部
+    #返回（当前页的元组列表，总数）
+    def query_tasks(self, owner=None, target=None, page=1, page_size=20):
+        columns = ", ".join(TASK_COLUMNS)
+        pending = "enable = '1' AND next_run IS NOT NULL"
+        if owner is not None and target is not None:
+            #分别走创建人、目标用户的索引后合并
+            query = (f"SELECT {columns}, next_run FROM tasks WHERE fromUser_id = ? AND {pending} "
+                     f"UNION SELECT {columns}, next_run FROM tasks WHERE other_user_id = ? AND {pending}")
+            params = [owner, target]
+        elif owner is not None:
+            query, params = f"SELECT {columns}, next_run FROM tasks WHERE fromUser_id = ? AND {pending}", [owner]
+        elif target is not None:
+            query, params = f"SELECT {columns}, next_run FROM tasks WHERE other_user_id = ? AND {pending}", [target]
+        else:
+            query, params = f"SELECT {columns}, next_run FROM tasks WHERE {pending}", []
+        with self.lock:
+            total = self.db.execute(f"SELECT COUNT(*) FROM ({query})", params).fetchone()[0]
+            rows = self.db.execute(f"SELECT * FROM ({query}) ORDER BY next_run LIMIT ? OFFSET ?",
+                                   params + [page_size, (max(page, 1) - 1) * page_size]).fetchall()
+        return [row[:len(TASK_COLUMNS)] for row in rows], total
+
+    #所有任务的下次执行时间
+    def get_next_runs(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT taskId, next_run FROM tasks").fetchall())
+
+    #批量保存下次执行时间
+    def save_next_runs(self, nextRuns):
+        if len(nextRuns) <= 0:
+            return
+        with self.lock, self.db:
+            self.db.executemany("UPDATE tasks SET next_run = ? WHERE taskId = ?", [(v, k) for k, v in nextRuns.items()])
+
+    #添加任务（相同ID的任务会被覆盖）
+    def add_task(self, item):
+        with self.lock, self.db:
+            self._insert_tasks([item])
+
+    #批量写入任务
+    def _insert_tasks(self, items):
+        rows = []
+        for item in items:
+            item = self._normalize(item)
+            rows.append(item + (self._next_run(item),))
+        placeholders = ", ".join("?" * (len(TASK_COLUMNS) + 1))
+        self.db.executemany(f"INSERT OR REPLACE INTO tasks ({', '.join(TASK_COLUMNS)}, next_run) VALUES ({placeholders})", rows)
+
+    #设置任务是否可用，返回（是否存在，任务model）
+    def set_enable(self, taskId, enable: bool):
+        with self.lock, self.db:
+            item = self.get_task(taskId)
+            if item is None:
+                return False, None
+            item = (item[0], "1" if enable else "0") + tuple(item[2:])
+            self._update_task(item)
+        return True, TimeTaskModel(item, None, False)
+
+    #批量设置今天是否已消费
+    def set_today_consumed(self, taskIds, consumed: bool):
+        if len(taskIds) <= 0:
+            return
+        with self.lock, self.db:
+            for taskId in taskIds:
+                item = self.get_task(taskId)
+                if item is not None:
+                    self._update_task(tuple(item[:13]) + ("1" if consumed else "0",))
+
+    #批量保存任务状态（是否可用、今天是否已消费、下次执行时间），同一事务写入
+    def save_status(self, models, nextRuns):
+        rows = [("1" if model.enable else "0", "1" if model.is_today_consumed else "0", nextRuns.get(model.taskId), model.taskId)
+                for model in models]
+        with self.lock, self.db:
+            self.db.executemany("UPDATE tasks SET enable = ?, is_today_consumed = ?, next_run = ? WHERE taskId = ?", rows)
+
+    #更新任务（字段变化后重新计算下次执行时间）
+    def _update_task(self, item):
+        assignments = ", ".join(f"{column} = ?" for column in TASK_COLUMNS[1:])
+        self.db.execute(f"UPDATE tasks SET {assignments}, next_run = ? WHERE taskId = ?",
+                        tuple(item[1:]) + (self._next_run(item), item[0]))
+
+    #将历史任务迁移至历史表，返回最新任务列表
+    def moveTasksToHistory(self, tasks):
+        with self.lock, self.db:
+            for item in tasks:
+                item = self._normalize(item)
+                self.db.execute("DELETE FROM tasks WHERE taskId = ?", (item[0],))
+                self.db.execute(f"INSERT INTO history ({', '.join(TASK_COLUMNS)}) VALUES ({', '.join('?' * len(TASK_COLUMNS))})", item)
+        hisIds = [item[0] for item in tasks]
+        print(f"将任务表中的 过期任务 迁移至 -> 历史表 完毕~ \n 迁移的任务ID为：{hisIds}")
+        return self.get_tasks()
+
+    #更新用户ID（重新登录后，好友、群聊的ID会变化）
+    def update_userId(self):
+        datas = self.get_tasks()
+        if len(datas) <= 0:
+            return
+
+        #id字典数组：将相同目标人的ID聚合为一个数组
+        idsDic = {}
+        groupIdsDic = {}
+        for item in datas:
+            model = TimeTaskModel(item, None, False)
+            targetDic = groupIdsDic if model.isGroup else idsDic
+            targetDic.setdefault(model.other_user_nickname, []).append(model)
+
+        #原始ID ：新ID
+        oldAndNewIDDic = ExcelTool().getNewId(idsDic, groupIdsDic)
+        if len(oldAndNewIDDic) <= 0:
+            return
+
+        #机器人ID
+        robot_user_id = itchat.instance.storageClass.userName
+        rows = []
+        for item in datas:
+            model = TimeTaskModel(item, None, False)
+            oldId = model.other_user_id
+            newId = oldAndNewIDDic.get(oldId)
+            if newId is None or len(newId) <= 0:
+                continue
+            #替换原始信息中的目标ID、机器人ID
+            originMsg = model.originMsg.replace(oldId, newId)
+            originMsg = originMsg.replace(model.toUser_id, robot_user_id)
+            rows.append((newId, robot_user_id, newId, originMsg, item[0]))
+
+        #同一事务中批量更新
+        with self.lock, self.db:
+            self.db.executemany("UPDATE tasks SET fromUser_id = ?, toUser_id = ?, other_user_id = ?, originMsg = ? WHERE taskId = ?", rows)
+        print(f"[timeTask] 重新登录，更新了{len(rows)}个任务的用户ID")
+
+    #导入Excel中的任务
+    def import_excel(self):
+        excelTool = ExcelTool()
+        if os.path.exists(excelTool.get_file_path()):
+            tasks = [item for item in excelTool.readExcel() if item and item[0]]
+            histories = [self._normalize(item) for item in excelTool.readExcel(sheet_name="历史任务") if item and item[0]]
+            with self.lock, self.db:
+                self._insert_tasks(tasks)
+                self.db.executemany(f"INSERT INTO history ({', '.join(TASK_COLUMNS)}) VALUES ({', '.join('?' * len(TASK_COLUMNS))})", histories)
+            print(f"[timeTask] 导入Excel任务完毕，任务数：{len(tasks)}，历史任务数：{len(histories)}")
+        self.set_meta("excel_imported", "1")
+
+    #导出任务到Excel
+    def export_excel(self):
+        ExcelTool().writeExcel(self.get_tasks(), self.get_history_tasks())
+
+    #统一为数据库格式（Excel中的时间、日期可能被转换为datetime）
+    def _normalize(self, item):
+        return TimeTaskModel(item, None, False).get_formatItem()
+
+    #计算下次执行时间
+    def _next_run(self, item):
+        try:
+            return TimeTaskModel(item, None, False).get_next_run_time()
+        except Exception as e:
+            print(f"[timeTask] 计算任务【{item[0]}】的下次执行时间失败：{e}")
+            return None
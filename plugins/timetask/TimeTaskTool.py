@@ -1,12 +1,15 @@
 # encoding:utf-8
 
-from plugins.timetask.Tool import ExcelTool
 from plugins.timetask.Tool import TimeTaskModel
+from plugins.timetask.TaskStore import TaskStore
+from common.timer_heap import TimerHeap
+from common.scheduler import get_scheduler, make_trigger
 import logging
 import time
 import arrow
 import threading
-from typing import List
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from plugins.timetask.config import conf, load_config
 from lib import itchat
 from lib.itchat.content import *
@@ -23,114 +26,135 @@ class TaskManager(object):
         super().__init__()
         #保存定时任务回调
         self.timeTaskFunc = timeTaskFunc
-        
-        # 创建子线程
-        t = threading.Thread(target=self.pingTimeTask_in_sub_thread)
-        t.setDaemon(True) 
-        t.start()
-        
-    # 定义子线程函数
-    def pingTimeTask_in_sub_thread(self):
-        #延迟5秒后再检测，让初始化任务执行完
-        time.sleep(5)
-        
+        #任务存储
+        self.store = TaskStore()
+        #任务字典：taskId -> model
+        self.timeTasks = {}
+        #按下次执行时间排序的任务堆
+        self.scheduler = TimerHeap()
         #检测是否重新登录了
         self.isRelogin = False
-        
-        #迁移任务的标识符：用于标识在目标时间，只迁移一次
-        self.moveHistoryTask_identifier = ""
-        
-        #刷新任务的标识符：用于标识在目标时间，只刷新一次
-        self.refreshTimeTask_identifier = ""
-        
-        #存放历史数据
-        self.historyTasks = []
-        
+        #执行任务的线程池，同一接收人的任务按顺序执行
+        self.executor = ThreadPoolExecutor(max_workers=conf().get("max_workers", 4), thread_name_prefix="timetask")
+        self.recipientQueues = {}
+        self.dispatchLock = threading.Lock()
+        #执行统计：执行时间相对计划时间的延迟（秒）
+        self.metrics = {"executed": 0, "failed": 0}
+        self.lags = deque(maxlen=200)
+
+        #下次凌晨刷新、迁移历史任务的时间，初始化后设置
+        self.refresh_time = None
+        self.move_time = None
+
+        #由共用调度器驱动检测，延迟5秒后再初始化，让初始化任务执行完
+        self.jobScheduler = get_scheduler()
+        self.jobScheduler.add_job("timetask.init", self.initTimeTask, make_trigger("once", run_at=time.time() + 5),
+                                  misfire_grace_time=None, persistent=False)
+
+    #初始化：加载配置、任务数据，之后由调度器按最近的任务执行时间触发检测
+    def initTimeTask(self):
         #配置加载
         load_config()
         self.conf = conf()
         self.debug = self.conf.get("debug", False)
         #迁移任务的时间
         self.move_historyTask_time = self.conf.get("move_historyTask_time", "04:00:00")
-        #默认每秒检测一次
-        self.time_check_rate = self.conf.get("time_check_rate", 1)
-        
-        #excel创建
-        obj = ExcelTool()
-        obj.create_excel()
-        #任务数组
-        self.refreshDataFromExcel()
-        #过期任务数组、现在待消费数组、未来任务数组
-        historyArray, _, _ = self.getFuncArray(self.timeTasks)
+
+        #任务数据
+        self.refreshDataFromStore()
         #启动时，默认迁移一次过期任务
-        self.moveTask_toHistory(historyArray)
-        
-        #循环
-        while True:
-            # 定时检测
-            self.timeCheck()
-            time.sleep(int(self.time_check_rate))
-    
+        self.moveTask_toHistory()
+        #下次凌晨刷新、迁移历史任务的时间
+        self.refresh_time = self.get_next_targetTime("00:00:00")
+        self.move_time = self.get_next_targetTime(self.move_historyTask_time)
+
+        #最长60秒检测一次，用于检测重新登录；添加任务时提前唤醒
+        self.jobScheduler.add_job("timetask.check", self.pingTimeTask, make_trigger("interval", 60),
+                                  misfire_grace_time=None, persistent=False)
+        self.wakeup()
+
+    #检测任务，并设置下次检测时间
+    def pingTimeTask(self):
+        self.timeCheck()
+        if self.isRelogin:
+            #重新登录、未登录，稍后再检测
+            self.jobScheduler.reschedule_job("timetask.check", time.time() + 1)
+        else:
+            self.wakeup()
+
+    #下次检测时间：最近的任务执行时间、维护时间，最长60秒
+    def wakeup(self):
+        if self.refresh_time is None or self.isRelogin:
+            #还未初始化、重新登录中（每秒检测）
+            return
+        targetTimes = [self.refresh_time, self.move_time, time.time() + 60]
+        nextTime = self.scheduler.next_time()
+        if nextTime is not None:
+            targetTimes.append(nextTime)
+        self.jobScheduler.reschedule_job("timetask.check", min(targetTimes))
+
     #时间检查
     def timeCheck(self):
-        
+
         #检测是否重新登录了
         self.check_isRelogin()
         #重新登录、未登录，均跳过
         if self.isRelogin:
             return
-        
-        #过期任务数组、现在待消费数组、未来任务数组
-        modelArray = self.timeTasks
-        historyArray, currentExpendArray, featureArray = self.getFuncArray(modelArray)
-        
-        #存放历史数据
-        if len(historyArray) > 0:
-            for item in historyArray:
-                if item not in currentExpendArray and item not in featureArray and item not in self.historyTasks:
-                      self.historyTasks.append(item)
-        
-        #是否到了凌晨00:00 - 目标时间，刷新今天的cron任务
-        if self.is_targetTime("00:00"):
-            #刷新cron时间任务、周期任务的今天执行态
-            self.refresh_times(featureArray) 
-        elif len(self.refreshTimeTask_identifier) > 0:
-            self.refreshTimeTask_identifier = ""
-            
-        
+
+        now = time.time()
+        #是否到了凌晨00:00 - 刷新周期任务的今天执行态
+        if now >= self.refresh_time:
+            self.refresh_times()
+            self.refresh_time = self.get_next_targetTime("00:00:00")
+
         #是否到了迁移历史任务 - 目标时间
-        if self.is_targetTime(self.move_historyTask_time):
-            #迁移过期任务
-            self.moveTask_toHistory(self.historyTasks)
-        elif len(self.moveHistoryTask_identifier) > 0:
-            self.moveHistoryTask_identifier = ""
-            
-        #任务数组
-        if len(modelArray) <= 0:
-            return
-                    
-        #将数组赋值数组，提升性能(若self.timeTasks 未被多线程更新，赋值为待执行任务组)
-        timeTask_ids = '😄'.join(item.taskId for item in self.timeTasks)
-        modelArray_ids = '😄'.join(item.taskId for item in modelArray)
-        featureArray_ids = '😄'.join(item.taskId for item in featureArray)
-        if timeTask_ids == modelArray_ids and timeTask_ids != featureArray_ids:
-            #将任务数组 更新为 待执行数组； 当前任务在下面执行消费逻辑
-            self.timeTasks = featureArray
-            print(f"内存任务更新：原任务列表 -> 待执行任务列表")
-            print(f"原任务ID列表：{timeTask_ids}")
-            print(f"待执行任务ID列表：{featureArray_ids}")
-        
-        #当前无待消费任务     
-        if len(currentExpendArray) <= 0:
+        if now >= self.move_time:
+            self.moveTask_toHistory()
+            self.move_time = self.get_next_targetTime(self.move_historyTask_time)
+
+        #到期的任务
+        dueArray = self.scheduler.pop_due(now)
+        if len(dueArray) <= 0:
             if self.debug:
                 logging.info("[timetask][定时检测]：当前时刻 - 无定时任务...")
             return
-        
+
+        currentExpendArray = []
+        for taskId, run_time in dueArray:
+            model : TimeTaskModel = self.timeTasks.get(taskId)
+            if model is None:
+                continue
+            #精度为分钟，超过1分钟未执行（如未登录、时间跳变）则跳过本次
+            if now - run_time >= 60:
+                print(f"[timetask][定时检测]：任务【{taskId}】错过了执行时间，跳过本次")
+                self.scheduleTask(model, run_time + 60)
+                self.store.save_next_runs({taskId: self.scheduler.get(taskId)})
+                continue
+            currentExpendArray.append((model, run_time))
+
+        if len(currentExpendArray) <= 0:
+            return
+
+        #执行前更新任务状态、计算下次执行时间
+        for model, run_time in currentExpendArray:
+            #非cron，置为已消费
+            if not model.isCron_time():
+                model.is_today_consumed = True
+            #无后续执行日的任务，置为不可用
+            if not model.is_featureDay():
+                model.enable = False
+            if model.enable:
+                self.scheduleTask(model, run_time + 60)
+        #本次所有任务的状态一次写入
+        modelArray = [model for model, _ in currentExpendArray]
+        self.store.save_status(modelArray, {model.taskId: self.scheduler.get(model.taskId) for model in modelArray})
+
         #消费当前task
         print(f"[timetask][定时检测]：当前时刻 - 存在定时任务, 执行消费 当前时刻任务")
         self.runTaskArray(currentExpendArray)
-        
-        
+        logging.info(f"[timetask] 本次到期任务数：{len(currentExpendArray)}，执行统计：{self.get_metrics()}")
+
     #检测是否重新登录了    
     def check_isRelogin(self):
         #机器人ID
@@ -163,8 +187,8 @@ class TaskManager(object):
                 return  
         
             #取出任务中的一个模型
-            if self.timeTasks is not None and len(self.timeTasks) > 0: 
-                model : TimeTaskModel = self.timeTasks[0]
+            if self.timeTasks is not None and len(self.timeTasks) > 0:
+                model : TimeTaskModel = next(iter(self.timeTasks.values()))
                 temp_isRelogin = robot_user_id != model.toUser_id
             
                 if temp_isRelogin:
@@ -174,9 +198,9 @@ class TaskManager(object):
                     time.sleep(3)
                     
                     #更新userId
-                    ExcelTool().update_userId()
+                    self.store.update_userId()
                     #刷新数据
-                    self.refreshDataFromExcel()
+                    self.refreshDataFromStore()
                     
                     #更新为非重新登录态
                     self.isRelogin = False
@@ -185,213 +209,152 @@ class TaskManager(object):
             self.isRelogin = True      
         
             
-    #拉取Excel最新数据    
-    def refreshDataFromExcel(self):
-        tempArray = ExcelTool().readExcel()
-        self.convetDataToModelArray(tempArray) 
-        
-    #迁移历史任务   
-    def moveTask_toHistory(self, modelArray):
-        if len(modelArray) <= 0:
-            return
-          
-        #当前时间的小时：分钟
-        current_time_hour_min = arrow.now().format('HH:mm')
-        #执行中 - 标识符
-        identifier_running = f"{current_time_hour_min}_running"
-        #结束 - 标识符
-        identifier_end = f"{current_time_hour_min}_end"
-        
-        #当前状态
-        current_task_state = self.moveHistoryTask_identifier
-        
-        #未执行
-        if current_task_state == "":
-            #打印当前任务
-            new_array = [item.taskId for item in self.timeTasks]
-            print(f"[timeTask] 触发了迁移历史任务~ 当前任务ID为：{new_array}")
-            
-            #置为执行中
-            self.moveHistoryTask_identifier = identifier_running
-            #迁移任务
-            newTimeTask = ExcelTool().moveTasksToHistoryExcel(modelArray)
-            #数据刷新
-            self.convetDataToModelArray(newTimeTask)
-            
-        #执行中    
-        elif current_task_state == identifier_running:
-            return
-        
-        #执行完成
-        elif current_task_state == identifier_end:
-            self.moveHistoryTask_identifier == ""
-            
-        #容错：如果时间未跳动，则正常命中【执行完成】； 异常时间跳动时，则比较时间
-        elif "_end" in current_task_state:
-            #标识符中的时间
-            tempTimeStr = current_task_state.replace("_end", ":00")
-            current_time = arrow.now().replace(second=0, microsecond=0).time()
-            task_time = arrow.get(tempTimeStr, "HH:mm:ss").replace(second=0, microsecond=0).time()
-            tempValue = task_time < current_time
-            if tempValue:
-                self.moveHistoryTask_identifier == ""
-                
-                
-    #刷新c任务   
-    def refresh_times(self, modelArray):
-        #当前时间的小时：分钟
-        current_time_hour_min = arrow.now().format('HH:mm')
-        #执行中 - 标识符
-        identifier_running = f"{current_time_hour_min}_running"
-        #结束 - 标识符
-        identifier_end = f"{current_time_hour_min}_end"
-        
-        #当前状态
-        current_task_state = self.refreshTimeTask_identifier
-        
-        #未执行
-        if current_task_state == "":
-            #打印此时任务
-            new_array = [item.taskId for item in self.timeTasks]
-            print(f"[timeTask] 触发了凌晨刷新任务~ 当前任务ID为：{new_array}")
-            
-            #置为执行中
-            self.refreshTimeTask_identifier = identifier_running
-            #刷新任务
-            for m in modelArray:
-                taskModel : TimeTaskModel = m
-                taskModel.is_today_consumed = False
-                ExcelTool().write_columnValue_withTaskId_toExcel(taskModel.taskId, 14, "0")
-            
-            #刷新数据
-            self.refreshDataFromExcel()
-            
-        #执行中    
-        elif current_task_state == identifier_running:
+    #拉取最新数据，重建任务堆
+    def refreshDataFromStore(self):
+        tempArray = self.store.get_tasks()
+        self.convetDataToModelArray(tempArray)
+
+    #计算任务的下次执行时间并加入任务堆
+    def scheduleTask(self, model: TimeTaskModel, start=None):
+        self.scheduler.schedule(model.taskId, model.get_next_run_time(start))
+
+    #迁移历史任务（已失效、无下次执行时间的任务）
+    def moveTask_toHistory(self):
+        historyArray = [model.get_formatItem() for taskId, model in list(self.timeTasks.items()) if taskId not in self.scheduler]
+        if len(historyArray) <= 0:
             return
-        
-        #执行完成
-        elif current_task_state == identifier_end:
-            self.refreshTimeTask_identifier == ""
-            
-        #容错：如果时间未跳动，则正常命中【执行完成】； 异常时间跳动时，则比较时间
-        elif "_end" in current_task_state:
-            #标识符中的时间
-            tempTimeStr = current_task_state.replace("_end", ":00")
-            current_time = arrow.now().replace(second=0, microsecond=0).time()
-            task_time = arrow.get(tempTimeStr, "HH:mm:ss").replace(second=0, microsecond=0).time()
-            tempValue = task_time < current_time
-            if tempValue:
-                self.refreshTimeTask_identifier == ""
-       
-    #获取功能数组    
-    def getFuncArray(self, modelArray):
-        #待消费数组
-        featureArray = []
-        #当前待消费数组
-        currentExpendArray=[]
-        #过期任务数组
-        historyArray=[]
-        #遍历检查时间
-        for item in modelArray:
-            model : TimeTaskModel = item
-            if model.enable:
-                #是否现在时刻
-                is_nowTime, nowTime = model.is_nowTime()
-                #是否未来时刻
-                is_featureTime = model.is_featureTime()
-                #是否today
-                is_today = model.is_today()
-                #是否未来day
-                is_featureDay = model.is_featureDay()
-            
-                #是否历史
-                isHistory = True
-                #由于一个model既可以是当前的任务，又可能是以后得任务，所以这里对一个model同时判定现在和未来的判定
-                #是否现在时刻的任务
-                if is_nowTime and is_today:
-                    #精度为分钟，cron中消费本次任务
-                    if model.isCron_time():
-                       if nowTime in model.cron_today_times:
-                            model.cron_today_times.remove(nowTime)
-                            currentExpendArray.append(model)
-                            isHistory = False
-                        
-                    #今天未被消费
-                    elif not model.is_today_consumed:
-                        currentExpendArray.append(model)
-                        isHistory = False
-                        model.is_today_consumed = True       
-                
-                #是否当前时刻后面待消费任务
-                if (is_featureTime and is_today) or is_featureDay:
-                    featureArray.append(model)
-                    isHistory = False                     
-                
-                #存入历史数组
-                if isHistory:
-                    historyArray.append(model.get_formatItem())
-            else:
-                historyArray.append(model.get_formatItem())  
-        
-        return  historyArray, currentExpendArray, featureArray     
-        
-          
-    #执行task
-    def runTaskArray(self, modelArray):
+
+        #打印当前任务
+        print(f"[timeTask] 触发了迁移历史任务~ 当前任务ID为：{list(self.timeTasks.keys())}")
+        #迁移任务
+        self.store.moveTasksToHistory(historyArray)
+        for item in historyArray:
+            self.timeTasks.pop(item[0], None)
+        #同步导出一份Excel，便于查看
         try:
-            #执行任务列表
-            for _, model in enumerate(modelArray):
-                self.runTaskItem(model)
+            self.store.export_excel()
         except Exception as e:
-            print(f"执行定时任务，发生了错误：{e}")
-            
-                
+            print(f"[timeTask] 导出Excel失败：{e}")
+
+    #凌晨刷新周期任务的今天执行态
+    def refresh_times(self):
+        consumedArray = [model for model in list(self.timeTasks.values()) if model.is_today_consumed]
+        print(f"[timeTask] 触发了凌晨刷新任务~ 刷新的任务ID为：{[model.taskId for model in consumedArray]}")
+        #同一事务中批量更新
+        for model in consumedArray:
+            model.is_today_consumed = False
+        self.store.set_today_consumed([model.taskId for model in consumedArray], False)
+
+    #执行task：提交到线程池，同一接收人的任务排队按顺序执行
+    def runTaskArray(self, taskArray):
+        for model, run_time in taskArray:
+            key = self.get_recipientKey(model)
+            with self.dispatchLock:
+                queue = self.recipientQueues.get(key)
+                if queue is not None:
+                    #该接收人有任务正在执行，排在后面
+                    queue.append((model, run_time))
+                    continue
+                self.recipientQueues[key] = deque([(model, run_time)])
+            self.executor.submit(self.runRecipientQueue, key)
+
+    #依次执行同一接收人的任务
+    def runRecipientQueue(self, key):
+        while True:
+            with self.dispatchLock:
+                queue = self.recipientQueues[key]
+                if len(queue) <= 0:
+                    del self.recipientQueues[key]
+                    return
+                model, run_time = queue.popleft()
+            self.runTaskItem(model, run_time)
+
     #执行task
-    def runTaskItem(self, model: TimeTaskModel):
-        #非cron，置为已消费
-        if not model.isCron_time():
-            model.is_today_consumed = True
-            #置为消费
-            ExcelTool().write_columnValue_withTaskId_toExcel(model.taskId, 14, "1")
-        
+    def runTaskItem(self, model: TimeTaskModel, run_time):
+        #执行延迟
+        lag = time.time() - run_time
+        self.lags.append(lag)
+        if lag >= 60:
+            logging.warning(f"[timetask] 任务【{model.taskId}】执行延迟{lag:.1f}秒")
+
         print(f"😄执行定时任务:【{model.taskId}】，任务详情：{model.circleTimeStr} {model.timeStr} {model.eventStr}")
-        #回调定时任务执行
-        self.timeTaskFunc(model)
-        
-        #任务消费
-        if not model.is_featureDay():
-            obj = ExcelTool()
-            obj.write_columnValue_withTaskId_toExcel(model.taskId , 2, "0")
-            #刷新数据
-            self.refreshDataFromExcel()
-        
+        try:
+            #回调定时任务执行
+            self.timeTaskFunc(model)
+            with self.dispatchLock:
+                self.metrics["executed"] += 1
+        except Exception as e:
+            with self.dispatchLock:
+                self.metrics["failed"] += 1
+            print(f"执行定时任务【{model.taskId}】，发生了错误：{e}")
+
+    #接收人标识：私聊为群聊制定的任务，以群标题区分
+    def get_recipientKey(self, model: TimeTaskModel):
+        if model.isPerson_makeGrop():
+            _, groupTitle = model.get_Persion_makeGropTitle_eventStr()
+            return "group:" + groupTitle
+        return model.other_user_id
+
+    #执行统计
+    def get_metrics(self):
+        lags = sorted(self.lags)
+        with self.dispatchLock:
+            pending = sum(len(queue) for queue in self.recipientQueues.values())
+            result = dict(self.metrics, pending=pending)
+        if len(lags) > 0:
+            result["lag_avg"] = round(sum(lags) / len(lags), 2)
+            result["lag_p95"] = round(lags[min(int(len(lags) * 0.95), len(lags) - 1)], 2)
+            result["lag_max"] = round(lags[-1], 2)
+        return result
+
     #添加任务
     def addTask(self, taskModel: TimeTaskModel):
-        taskList = ExcelTool().addItemToExcel(taskModel.get_formatItem())
-        self.convetDataToModelArray(taskList)
-        return taskModel.taskId   
-    
+        self.store.add_task(taskModel.get_formatItem())
+        self.timeTasks[taskModel.taskId] = taskModel
+        #加入任务堆，并提前检测时间
+        self.scheduleTask(taskModel)
+        self.wakeup()
+        return taskModel.taskId
+
+    #取消任务，返回（是否存在，任务model）
+    def cancelTask(self, taskId):
+        isExist, taskModel = self.store.set_enable(taskId, False)
+        if isExist:
+            model = self.timeTasks.get(taskId)
+            if model is not None:
+                model.enable = False
+            self.scheduler.cancel(taskId)
+        return isExist, taskModel
+
     #model数组转换
     def convetDataToModelArray(self, dataArray):
-        tempArray = []
+        tempDic = {}
         for item in dataArray:
-            model = TimeTaskModel(item, None, False, True)
-            tempArray.append(model)
+            model = TimeTaskModel(item, None, False)
+            tempDic[model.taskId] = model
         #赋值
-        self.timeTasks = tempArray
-        
-    #是否目标时间      
-    def is_targetTime(self, timeStr):
+        self.timeTasks = tempDic
+        self.scheduler.clear()
+        for model in tempDic.values():
+            self.scheduleTask(model)
+        #保存变化的下次执行时间，用于按执行时间查询任务列表
+        savedNextRuns = self.store.get_next_runs()
+        changedNextRuns = {}
+        for taskId in tempDic.keys():
+            next_run = self.scheduler.get(taskId)
+            if savedNextRuns.get(taskId) != next_run:
+                changedNextRuns[taskId] = next_run
+        self.store.save_next_runs(changedNextRuns)
+
+    #下一个目标时间的时间戳（今天已过则为明天）
+    def get_next_targetTime(self, timeStr):
         tempTimeStr = timeStr
-        #对比精准到分（忽略秒）
-        current_time = arrow.now().format('HH:mm')
-        
         #如果是分钟
         if tempTimeStr.count(":") == 1:
            tempTimeStr = tempTimeStr + ":00"
-        
-        #转为分钟时间
-        task_time = arrow.get(tempTimeStr, "HH:mm:ss").format("HH:mm")
-        tempValue = current_time == task_time
-        return tempValue 
\ No newline at end of file
+
+        task_time = arrow.get(tempTimeStr, "HH:mm:ss")
+        target_time = arrow.now().replace(hour=task_time.hour, minute=task_time.minute, second=task_time.second, microsecond=0)
+        if target_time <= arrow.now():
+            target_time = target_time.shift(days=1)
+        return target_time.timestamp()
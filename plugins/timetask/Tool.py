@@ -15,6 +15,7 @@ from datetime import datetime
 from lib import itchat
 from lib.itchat.content import *
 from channel.chat_message import ChatMessage
+from channel.wechat.contact_index import ContactIndex
 from croniter import croniter
 import threading
 try:
@@ -225,7 +226,24 @@ class ExcelTool(object):
             return False, None
     
     
-    #获取文件路径      
+    # 整体写入任务列表、历史列表（覆盖原文件，只保存一次）
+    def writeExcel(self, tasks, historyTasks, file_name=__file_name, sheet_name=__sheet_name, history_sheet_name=__history_sheet_name):
+        workbook_file_path = self.get_file_path(file_name)
+        if os.path.exists(workbook_file_path):
+            os.remove(workbook_file_path)
+        self.create_excel(file_name, sheet_name, history_sheet_name)
+
+        wb = load_workbook(workbook_file_path)
+        ws = wb[sheet_name]
+        for item in tasks:
+            ws.append(item)
+        ws1 = wb[history_sheet_name]
+        for item in historyTasks:
+            ws1.append(item)
+        wb.save(workbook_file_path)
+        print(f"[timeTask] 导出Excel完毕，任务数：{len(tasks)}，历史任务数：{len(historyTasks)}")
+
+    #获取文件路径
     def get_file_path(self, file_name=__file_name):
         # 文件路径
         current_file = os.path.abspath(__file__)
@@ -329,65 +347,108 @@ class ExcelTool(object):
         
             
             
-    #获取新的用户ID  
+    #获取新的用户ID（按昵称在联系人索引中查找）
     def getNewId(self, idsDic, groupIdsDic):
         oldAndNewIDDic = {}
-        #好友  
-        friends = []
-        #群聊
-        chatrooms = []
-        
-        #好友处理
-        if len(idsDic) > 0:   
-            #好友处理
+        contactIndex = ContactIndex()
+        #索引为空（联系人列表还未加载），从服务器拉取一次联系人，拉取结果会通过更新事件写入索引
+        if not contactIndex.is_loaded():
             try:
-                #获取好友列表
-                friends = itchat.get_friends(update=True)[0:]
+                itchat.get_friends(update=True)
             except ZeroDivisionError:
                 # 捕获并处理 ZeroDivisionError 异常
                 print("好友列表, 错误发生")
-            
-            #获取好友 -（id组装 旧 ： 新）
-            for friend in friends:
-                #id
-                userName = friend["UserName"]
-                NickName = friend["NickName"]
-                modelArray = idsDic.get(NickName)
-                #找到了好友
-                if modelArray is not None and len(modelArray) > 0:
-                    model : TimeTaskModel = modelArray[0]
-                    oldId = model.other_user_id
-                    if oldId != userName:
-                        oldAndNewIDDic[oldId] = userName    
-         
-        #群聊处理  
-        if len(groupIdsDic) > 0:          
-            #群聊处理       
-            try:
-                #群聊 （id组装 旧 ：新）   
-                chatrooms = itchat.get_chatrooms()
-            except ZeroDivisionError:
-                # 捕获并处理 ZeroDivisionError 异常
-                print("群聊列表, 错误发生")
-            
-            #获取群聊 - 旧 ： 新
-            for chatroom in chatrooms:
-                #id
-                userName = chatroom["UserName"]
-                NickName = chatroom["NickName"]
-                modelArray = groupIdsDic.get(NickName)
-                #找到了群聊
-                if modelArray is not None and len(modelArray) > 0:
-                    model : TimeTaskModel = modelArray[0]
-                    oldId = model.other_user_id
-                    if oldId != userName:
-                        oldAndNewIDDic[oldId] = userName
-                       
-        return oldAndNewIDDic         
-        
-
-#task模型        
+
+        #好友、群聊 -（id组装 旧 ： 新）
+        for nameDic, lookup in ((idsDic, contactIndex.get_friend), (groupIdsDic, contactIndex.get_chatroom)):
+            for nickName, modelArray in nameDic.items():
+                userName = lookup(nickName)
+                if userName is None or modelArray is None or len(modelArray) <= 0:
+                    continue
+                model : TimeTaskModel = modelArray[0]
+                oldId = model.other_user_id
+                if oldId != userName:
+                    oldAndNewIDDic[oldId] = userName
+
+        return oldAndNewIDDic
+        
+
+_cron_schedules = {}
+_cron_schedules_lock = threading.Lock()
+
+
+#cron执行计划：相同表达式的任务共用，表达式只解析一次，执行时间在需要时计算
+class CronSchedule(object):
+    __slots__ = ("expression", "is_valid", "cron", "lock", "last_start", "last_next", "today", "today_times")
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.is_valid = croniter.is_valid(expression)
+        self.cron = croniter(expression) if self.is_valid else None
+        self.lock = threading.Lock()
+        #上次计算的起始时间、下次执行时间
+        self.last_start = None
+        self.last_next = None
+        #今天的执行时间点
+        self.today = None
+        self.today_times = []
+
+    #start之后（不含start）的下次执行时间戳
+    def get_next(self, start):
+        if not self.is_valid:
+            return None
+        with self.lock:
+            return self._next(start)
+
+    def _next(self, start):
+        #start在上次计算的区间内时，下次执行时间不变
+        if self.last_start is not None and self.last_start <= start < self.last_next:
+            return self.last_next
+        self.cron.set_current(arrow.get(start).to('local').datetime, force=True)
+        self.last_start, self.last_next = start, self.cron.get_next(float)
+        return self.last_next
+
+    #从start开始依次产生执行时间戳，用多少算多少
+    def iter_next(self, start):
+        next_time = self.get_next(start)
+        while next_time is not None:
+            yield next_time
+            next_time = self.get_next(next_time)
+
+    #今天的执行时间点（时:分），每天只计算一次
+    def get_today_times(self):
+        if not self.is_valid:
+            return []
+        today = arrow.now().floor('day')
+        with self.lock:
+            if self.today != today.date():
+                times = []
+                next_time = self._next(today.timestamp() - 1)
+                while arrow.get(next_time).to('local').date() == today.date():
+                    times.append(arrow.get(next_time).to('local').format('HH:mm'))
+                    next_time = self._next(next_time)
+                self.today, self.today_times = today.date(), times
+                print(f"cron表达式为：{self.expression}, 满足今天的时间节点为：{times}")
+            return self.today_times
+
+
+#获取cron表达式的执行计划
+def get_cron_schedule(expression) -> CronSchedule:
+    schedule = _cron_schedules.get(expression)
+    if schedule is None:
+        with _cron_schedules_lock:
+            schedule = _cron_schedules.get(expression)
+            if schedule is None:
+                schedule = _cron_schedules[expression] = CronSchedule(expression)
+    return schedule
+
+
+#task模型
 class TimeTaskModel:
+    __slots__ = ("isNeedCalculateCron", "taskId", "enable", "is_today_consumed", "timeStr", "circleTimeStr", "eventStr",
+                 "fromUser", "fromUser_id", "toUser", "toUser_id", "other_user_nickname", "other_user_id",
+                 "isGroup", "originMsg", "cron_expression")
+
     #Item数据排序
     #0：ID - 唯一ID (自动生成，无需填写)
     #1：是否可用 - 0/1，0=不可用，1=可用
@@ -504,38 +565,17 @@ class TimeTaskModel:
         if self.is_today_consumed:
             if self.is_today() and (self.is_nowTime() or self.is_featureTime()):
                 self.is_today_consumed = False
-                
-        #数组为空
-        self.cron_today_times = []
-        
-        #计算cron今天的时间点
-        if self.isNeedCalculateCron and self.isCron_time() and self.enable:
-            # 创建子线程
-            t = threading.Thread(target=self.get_todayCron_times)
-            t.setDaemon(True) 
-            t.start() 
-     
-    #获取今天cron时间  
+
+    #cron今天的时间点（同一表达式共用，按需计算）
+    @property
+    def cron_today_times(self):
+        return self.get_todayCron_times()
+
+    #获取今天cron时间
     def get_todayCron_times(self):
-        if not self.enable:
-              return
-          
-        self.cron_today_times = []
-        #校验cron格式
-        if self.isValid_Cron_time():
-            # 获取当前时间（忽略秒数）
-            current_time = arrow.now().replace(second=0, microsecond=0)
-            # 创建一个 croniter 对象
-            cron = croniter(self.cron_expression, current_time.datetime)
-            next_time = cron.get_next(datetime)
-            while next_time.date() == current_time.date():
-                #记录时间（时：分）
-                next_time_hour_minut = next_time.strftime('%H:%M')
-                self.cron_today_times.append(next_time_hour_minut)
-                next_time = cron.get_next(datetime)
-            
-            #打印满足今天的cron的时间点    
-            print(f"cron表达式为：{self.cron_expression}, 满足今天的时间节点为：{self.cron_today_times}")
+        if not self.enable or not self.isCron_time():
+            return []
+        return get_cron_schedule(self.cron_expression).get_today_times()
         
     #获取格式化后的Item
     def get_formatItem(self):
@@ -666,8 +706,8 @@ class TimeTaskModel:
                     #print(f"[定时任务]类型: 工作日, 非今天任务，日期信息为：{item_circle}")
                     return False    
                     
-    #是否今天的星期数       
-    def is_today_weekday(self, weekday_str):
+    #是否今天的星期数（day不为空时，判断day是否为指定的星期数）
+    def is_today_weekday(self, weekday_str, day=None):
         # 将中文数字转换为阿拉伯数字
         weekday_dict = {'一': 1, '二': 2, '三': 3, '四': 4, '五': 5, '六': 6, '日': 7}
         weekday_num = weekday_dict.get(weekday_str[-1])
@@ -675,10 +715,65 @@ class TimeTaskModel:
             return False
         
         # 判断今天是否是指定的星期几
-        today = arrow.now()
-        tempValue = today.weekday() == weekday_num - 1   
-        return tempValue   
-        
+        today = arrow.now() if day is None else day
+        tempValue = today.weekday() == weekday_num - 1
+        return tempValue
+
+    #某天是否为周期任务的执行日（不含具体日期、cron）
+    def is_circleDay(self, day):
+        item_circle = self.circleTimeStr
+        if "每天" in item_circle:
+            return True
+        elif "每周" in item_circle or "每星期" in item_circle:
+            return self.is_today_weekday(item_circle, day)
+        elif "工作日" in item_circle:
+            return day.weekday() < 5
+        return False
+
+    #下次执行时间（时间戳，精确到分钟），无下次执行时返回None
+    #start：从该时间戳开始计算，默认为当前时间
+    def get_next_run_time(self, start=None):
+        if not self.enable:
+            return None
+
+        # 当前时间（忽略秒数）
+        current_time = (arrow.now() if start is None else arrow.get(start).to('local')).floor('minute')
+
+        #cron
+        if self.isCron_time():
+            # 从上一分钟末开始计算，当前分钟也算作下次执行时间
+            return get_cron_schedule(self.cron_expression).get_next(current_time.timestamp() - 1)
+
+        #时间
+        tempTimeStr = self.timeStr
+        if tempTimeStr.count(":") == 1:
+            tempTimeStr = tempTimeStr + ":00"
+        try:
+            task_time = arrow.get(tempTimeStr, "HH:mm:ss")
+        except Exception:
+            return None
+
+        #具体日期
+        if self.is_valid_date(self.circleTimeStr):
+            try:
+                days = [arrow.get(self.circleTimeStr, 'YYYY-MM-DD').replace(tzinfo=current_time.tzinfo)]
+            except Exception:
+                return None
+        else:
+            # 周期任务，最多往后找一周
+            days = [current_time.shift(days=i) for i in range(8)]
+            days = [day for day in days if self.is_circleDay(day)]
+
+        for day in days:
+            run_time = day.replace(hour=task_time.hour, minute=task_time.minute, second=0, microsecond=0)
+            if run_time < current_time:
+                continue
+            # 今天已被消费
+            if run_time.date() == arrow.now().date() and self.is_today_consumed:
+                continue
+            return run_time.timestamp()
+        return None
+
     #日期是否格式正确
     def is_valid_date(self, date_string):
         pattern = re.compile(r'^\d{4}-\d{2}-\d{2}$')
@@ -823,7 +918,7 @@ class TimeTaskModel:
     
     #是否正确的cron格式
     def isValid_Cron_time(self):
-        tempValue = croniter.is_valid(self.cron_expression)
+        tempValue = get_cron_schedule(self.cron_expression).is_valid
         return tempValue
     
     #获取 cron表达式
@@ -865,17 +960,8 @@ class TimeTaskModel:
             tempRoomId = ""
             #群聊处理       
             try:
-                #群聊  
-                chatrooms = itchat.get_chatrooms()
-                #获取群聊
-                for chatroom in chatrooms:
-                    #id
-                    userName = chatroom["UserName"]
-                    NickName = chatroom["NickName"]
-                    if NickName == groupTitle:
-                        tempRoomId = userName
-                        break
-                    
+                #按群名称在联系人索引中查找
+                tempRoomId = ContactIndex().get_chatroom(groupTitle) or ""
                 return tempRoomId
             except Exception as e:
                 print(f"[{channel_name}通道] 通过 群Title 获取群ID发生错误，错误信息为：{e}")
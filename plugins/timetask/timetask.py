@@ -12,7 +12,7 @@ from lib import itchat
 from lib.itchat.content import *
 import re
 import arrow
-from plugins.timetask.Tool import ExcelTool
+from plugins.timetask.TaskStore import TaskStore
 from bridge.bridge import Bridge
 import config as RobotConfig
 import requests
@@ -93,7 +93,7 @@ class timetask(Plugin):
         wordsArray = content.split(" ")
         #任务编号
         taskId = wordsArray[1]
-        isExist, taskModel = ExcelTool().write_columnValue_withTaskId_toExcel(taskId, 2, "0")
+        isExist, taskModel = self.taskManager.cancelTask(taskId)
         taskContent = "未知"
         if taskModel:
             taskContent = f"{taskModel.circleTimeStr} {taskModel.timeStr} {taskModel.eventStr}"
@@ -113,28 +113,26 @@ class timetask(Plugin):
         #拼接提示
         reply_text = reply_text + tempStr
         #回复
-        self.replay_use_default(reply_text, e_context)  
-        
-        #刷新内存列表
-        self.taskManager.refreshDataFromExcel()
+        self.replay_use_default(reply_text, e_context)
         
         
     #获取任务列表
     def get_timeTaskList(self, content, e_context: EventContext):
-        
-        #任务列表
-        taskArray = ExcelTool().readExcel()
-        tempArray = []
-        for item in taskArray:
-            model = TimeTaskModel(item, None, False)
-            if model.enable and model.taskId and len(model.taskId) > 0:
-                isToday = model.is_today()
-                is_now, _ = model.is_nowTime()
-                isNowOrFeatureTime = model.is_featureTime() or is_now
-                isCircleFeatureDay = model.is_featureDay()
-                if (isToday and isNowOrFeatureTime) or isCircleFeatureDay:
-                    tempArray.append(model)
-        
+        #页码：$time 任务列表 2
+        wordsArray = content.split(" ")
+        page = 1
+        if len(wordsArray) > 1 and wordsArray[1].isdigit():
+            page = max(int(wordsArray[1]), 1)
+        page_size = self.conf.get("task_list_page_size", 20)
+
+        #任务列表：默认查看所有任务，关闭is_list_all_tasks后只查看当前会话创建的、或发给当前会话的任务
+        if self.conf.get("is_list_all_tasks", True):
+            taskArray, total = TaskStore().query_tasks(page=page, page_size=page_size)
+        else:
+            msg: ChatMessage = e_context["context"]["msg"]
+            taskArray, total = TaskStore().query_tasks(owner=msg.from_user_id, target=msg.other_user_id, page=page, page_size=page_size)
+        tempArray = [TimeTaskModel(item, None, False) for item in taskArray]
+
         #回消息
         reply_text = ""
         tempStr = ""
@@ -144,24 +142,30 @@ class timetask(Plugin):
         else:
             tempStr = self.get_default_remind(TimeTaskRemindType.TaskList_Success)
             reply_text = "⏰定时任务列表如下：\n\n"
-            #根据时间排序
-            sorted_times = sorted(tempArray, key=lambda x: self.custom_sort(x.timeStr))
-            for model in sorted_times:
+            #已按下次执行时间排序
+            for model in tempArray:
                 taskModel : TimeTaskModel = model
                 tempTimeStr = f"{taskModel.circleTimeStr} {taskModel.timeStr}"
                 if taskModel.isCron_time():
                     tempTimeStr = f"{taskModel.circleTimeStr}"
-                reply_text = reply_text + f"【{taskModel.taskId}】@{taskModel.fromUser}: {tempTimeStr} {taskModel.eventStr}\n"   
-            #移除最后一个换行    
+                reply_text = reply_text + f"【{taskModel.taskId}】@{taskModel.fromUser}: {tempTimeStr} {taskModel.eventStr}\n"
+            #分页
+            page_count = (total + page_size - 1) // page_size
+            if page_count > 1:
+                command_prefix = self.conf.get("command_prefix", "$time")
+                reply_text = reply_text + f"\n第{page}/{page_count}页，共{total}个任务"
+                if page < page_count:
+                    reply_text = reply_text + f"，下一页：{command_prefix} 任务列表 {page + 1}"
+            #移除最后一个换行
             reply_text = reply_text.rstrip('\n')
-            
+
         #拼接提示
         reply_text = reply_text + tempStr
-        
+
         #回复
-        self.replay_use_default(reply_text, e_context)    
-        
-          
+        self.replay_use_default(reply_text, e_context)
+
+
     #添加任务
     def add_timeTask(self, content, e_context: EventContext):
         #失败时，默认提示
@@ -490,15 +494,6 @@ class timetask(Plugin):
                 return prefix
         return None
 
-    # 自定义排序函数，将字符串解析为 arrow 对象，并按时间进行排序
-    def custom_sort(self, time):
-        #cron - 排列最后
-        if time.startswith("cron"):
-            return arrow.get("23:59:59", "HH:mm:ss")
-        
-        #普通时间
-        return arrow.get(time, "HH:mm:ss")
-    
     # 默认的提示
     def get_default_remind(self, currentType: TimeTaskRemindType):
         # 指令前缀
@@ -574,7 +569,7 @@ class timetask(Plugin):
         tempStr1 = h_str1 + codeStr1 + taskId1 + exampleStr1
         
         h_str2 = "🎉功能三：获取任务列表\n"
-        codeStr2 = f"【指令】：{command_prefix} 任务列表\n"
+        codeStr2 = f"【指令】：{command_prefix} 任务列表 页码（页码可不填）\n"
         exampleStr2 = f"\n👉示例：{command_prefix} 任务列表\n\n\n"
         tempStr2 = h_str2 + codeStr2 + exampleStr2
         